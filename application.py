@@ -6,8 +6,16 @@ import tornado.ioloop
 import tornado.options
 import tornado.web
 from tornado.options import define, options
-from utils import Config, get_mysql_monitor_config, get_mysql_cluster_info
+from utils import Config, get_mysql_monitor_config, get_mysql_cluster_info, K8S_CLIENT_REGISTRY
 from service.mysql_monitor_service import MysqlMonitorService
+from service.mysql_pool import MYSQL_POOLS
+from service.mysql_status import MYSQL_STATUS_SAMPLER
+from service.replication_monitor import REPLICATION_MONITOR
+from service.executor import BLOCKING_EXECUTOR
+from service.informer import INFORMER_MANAGER
+from service.node_sampler import NODE_SAMPLER
+from service.node_service import NODE_PUSH
+from service.usage_history import USAGE_HISTORY
 
 define("port", default='8000', help='Port number to use for connection')
 
@@ -19,10 +27,62 @@ _config_obj = Config()
 os.path.isdir(_config_path) and [_config_obj.append_config(os.path.join(_config_path, _config_name))
                                  for _config_name in os.listdir(_config_path)]
 
+# k8s客户端缓存
+K8S_CLIENT_REGISTRY.configure(
+    ttl=_config_obj.get_conf(_section='ops', _key='k8s_client_ttl', conf_type=int, default=None),
+    max_size=_config_obj.get_conf(_section='ops', _key='k8s_client_cache_size', conf_type=int, default=None))
+
+# informer本地缓存，开启后deployment、pod、node的查询优先从本地缓存读取
+INFORMER_MANAGER.configure(
+    enabled=_config_obj.get_conf(_section='ops', _key='k8s_informer', conf_type=bool, default=False))
+
+# 阻塞调用执行层
+BLOCKING_EXECUTOR.configure(
+    max_workers=_config_obj.get_conf(_section='ops', _key='executor_workers', conf_type=int, default=None),
+    target_limit={
+        'k8s': _config_obj.get_conf(_section='ops', _key='k8s_concurrency', conf_type=int, default=None),
+        'db': _config_obj.get_conf(_section='ops', _key='db_concurrency', conf_type=int, default=None)
+    })
+
+# 节点使用信息后台采集，/statistics从快照返回
+NODE_SAMPLER.configure(
+    interval=_config_obj.get_conf(_section='ops', _key='node_sample_interval', conf_type=int, default=None),
+    enabled=_config_obj.get_conf(_section='ops', _key='node_sampler', conf_type=bool, default=True))
+
+# 节点监控服务推送模式，心跳超时（秒）为空时按节点的推送间隔 * 3计算；未配置token时不接收推送
+NODE_PUSH.configure(
+    heartbeat=_config_obj.get_conf(_section='ops', _key='node_push_heartbeat', conf_type=int, default=None),
+    token=_config_obj.get_conf(_section='ops', _key='node_push_token', default=None))
+
+# 节点、pod使用历史持久化到/var/data，重启后恢复
+USAGE_HISTORY.configure(
+    persist=_config_obj.get_conf(_section='ops', _key='usage_persist', conf_type=bool, default=True),
+    path=_config_obj.get_conf(_section='ops', _key='usage_data_path', default=None))
+
+# Mysql连接池，按(host, port, user, db)共享
+MYSQL_POOLS.configure(
+    size=_config_obj.get_conf(_section='ops', _key='db_pool_size', conf_type=int, default=None),
+    idle=_config_obj.get_conf(_section='ops', _key='db_pool_idle', conf_type=int, default=None),
+    timeout=_config_obj.get_conf(_section='ops', _key='db_pool_timeout', conf_type=int, default=None))
+
+# Mysql状态后台采集，get_status_rates等从采集结果计算
+MYSQL_STATUS_SAMPLER.configure(
+    interval=_config_obj.get_conf(_section='ops', _key='db_status_interval', conf_type=int, default=None),
+    enabled=_config_obj.get_conf(_section='ops', _key='db_status_sampler', conf_type=bool, default=True))
+
 # DB初始化
 _db_service = MysqlMonitorService(**get_mysql_monitor_config(_config_obj)) \
     if _config_obj.get_conf(_section='ops', _key='monitor', default=False) else None
 
+_db_cluster = get_mysql_cluster_info(_config_obj) \
+    if _config_obj.get_conf(_section='ops', _key='mysql_cluster') else None
+
+# 主从同步后台监控，/db_cluster_monitor从最新结果返回
+REPLICATION_MONITOR.configure(
+    db_cluster=_db_cluster,
+    interval=_config_obj.get_conf(_section='ops', _key='replication_interval', conf_type=int, default=None),
+    enabled=_config_obj.get_conf(_section='ops', _key='replication_monitor', conf_type=bool, default=True))
+
 _monitor_list = _config_obj.get_conf(_section='ops', _key='monitor_list', default=None).split(',') \
     if _config_obj.get_conf(_section='ops', _key='monitor_list', default=None) else None
 
@@ -35,22 +95,30 @@ def start_app():
         # not use for now
         (r"/update_deployments", handler.UpdateDeploymentHandler),
         (r"/set_new_image", handler.SetImageHandler),
+        (r"/rollout_status", handler.RolloutStatusHandler),
+        (r"/usage_history", handler.UsageHistoryHandler),
+        (r"/node_ingest", handler.NodeIngestHandler),
         (r"/statistics", handler.StatisticsHandler,
          dict(monitor_list=_monitor_list,
               monitor_port=_config_obj.get_conf(_section='ops', _key='monitor_port', default=8000))),
         (r"/ping", handler.PingHandler),
         (r"/", handler.PingHandler),
         (r"/k8s_manage", handler.K8sManageHandler),
+        (r"/k8s_manage_batch", handler.K8sManageBatchHandler),
         (r"/db_monitor", handler.MysqlMonitorHandler, dict(db=_db_service)),
-        (r"/db_cluster_monitor", handler.MysqlClusterMonitorHandler,
-         dict(
-             db_cluster=get_mysql_cluster_info(_config_obj)
-             if _config_obj.get_conf(_section='ops', _key='mysql_cluster') else None))
+        (r"/db_monitor_batch", handler.MysqlMonitorBatchHandler, dict(db=_db_service)),
+        (r"/db_cluster_monitor", handler.MysqlClusterMonitorHandler, dict(db_cluster=_db_cluster))
     ])
 
-    http_server = tornado.httpserver.HTTPServer(app, xheaders=True)
+    # decompress_request：解压gzip压缩的请求体（节点批量推送）
+    http_server = tornado.httpserver.HTTPServer(app, xheaders=True, decompress_request=True)
     port = options.port
     http_server.listen(port)
+    NODE_SAMPLER.start()
+    USAGE_HISTORY.start()
+    MYSQL_POOLS.start()
+    MYSQL_STATUS_SAMPLER.start()
+    REPLICATION_MONITOR.start()
     logging.info("application started on port {}".format(port))
     tornado.ioloop.IOLoop.instance().start()
 
@@ -1,13 +1,23 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import json
 import logging
 import sys
+import time
 from typing import Optional, Awaitable
 
 import tornado.web
+from tornado.escape import json_encode
+from tornado.iostream import StreamClosedError
+
+from service.executor import BLOCKING_EXECUTOR
+
+BATCH_MAX_CALLS = 50  # 批量接口一次最多的调用数
 
 
 class BaseHandler(tornado.web.RequestHandler):
+    # 是否在日志中记录请求体，高频的上报接口关闭
+    log_body = True
 
     def initialize(self, **kwargs):
         """
@@ -21,7 +31,7 @@ class BaseHandler(tornado.web.RequestHandler):
         pass
 
     def prepare(self):
-        logging.info("request.body: {}".format(self.request.body))
+        self.log_body and logging.info("request.body: {}".format(self.request.body))
         try:
             setattr(self, 'params', json.loads(self.request.body.decode("utf-8", "ignore"), strict=False))
         except ValueError:
@@ -33,3 +43,130 @@ class BaseHandler(tornado.web.RequestHandler):
         if self._finished:
             return
         self.send_error(500, exc_info=sys.exc_info())
+
+    @staticmethod
+    async def run_blocking(key: tuple, func, *args, **kwargs):
+        """
+        将阻塞调用放到执行层的线程池中执行，按目标限制并发
+        :param key: (目标类型, 目标标识)，一般取service的concurrency_key
+        :param func:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return await BLOCKING_EXECUTOR.run(key, func, *args, **kwargs)
+
+    async def run_batch(self, calls: list, get_service, functions: frozenset):
+        """
+        并发执行一批调用，按请求顺序返回每个调用的结果、错误及耗时
+        depends_on中列出的调用成功后才开始，依赖失败时不执行；只能依赖之前的调用
+        依赖优先按声明的id查找，没有调用声明该id时整数按序号查找
+        :param calls: [{'id':, 'function_name':, 'function_params':, 'depends_on': []}]，id不能重复
+        :param get_service: get_service(call)返回执行该调用的service
+        :param functions: 允许调用的方法，只包含返回json结构的方法
+        :return: [{'index':, 'id':, 'function_name':, 'success':, 'data':, 'msg':, 'elapsed':}]
+        """
+        _ids = {}
+        for _index, _call in enumerate(calls):
+            if 'id' not in _call:
+                continue
+            if isinstance(_call['id'], bool) or not isinstance(_call['id'], (str, int)):
+                raise ValueError(f"id of call {_index} must be a string or an integer")
+            if _call['id'] in _ids:
+                raise ValueError(f"duplicate id {_call['id']}")
+            _ids[_call['id']] = _index
+        _tasks = []
+        for _index, _call in enumerate(calls):
+            _depends, _error = [], None
+            if not isinstance(_call.get('depends_on') or [], list):
+                _error = 'depends_on must be a list'
+            for _ref in _call.get('depends_on') or [] if not _error else []:
+                _target = None if isinstance(_ref, bool) or not isinstance(_ref, (str, int)) else \
+                    _ids[_ref] if _ref in _ids else _ref if isinstance(_ref, int) else None
+                if _target is None or not 0 <= _target < _index:
+                    _error = f'depends_on {_ref} is not an earlier call'
+                    break
+                _depends.append(_tasks[_target])
+            _tasks.append(asyncio.ensure_future(
+                self._run_call(_index, _call, _depends, _error, get_service, functions)))
+        return list(await asyncio.gather(*_tasks))
+
+    async def _run_call(self, index: int, call: dict, depends: list, error: str, get_service, functions: frozenset):
+        _name = call.get('function_name')
+        _result = {'index': index, 'id': call.get('id'), 'function_name': _name, 'success': False}
+        _start = time.time()
+        try:
+            if error:
+                raise ValueError(error)
+            if depends:
+                await asyncio.wait(depends)
+                if not all([_.result()['success'] for _ in depends]):
+                    raise ValueError('dependency failed')
+                _start = time.time()
+            if _name not in functions:
+                raise ValueError(f'function_name {_name} is not allowed in batch')
+            _service = get_service(call)
+            _data = await self.run_blocking(_service.concurrency_key, getattr(_service, _name),
+                                            **(call.get('function_params') or {}))
+            if not isinstance(_data, (dict, list, str, int, float, bool, type(None))):
+                raise TypeError(f'{_name} returned {type(_data).__name__}, not a json value')
+            _result['data'] = _data
+            _result['success'] = True
+            getattr(_service, 'cache_info', None) and _result.update(cache=_service.cache_info)
+        except Exception as e:
+            logging.error(f'batch call {index} {_name} failed:{e}')
+            _result.update(data='', msg=str(e))
+        _result['elapsed'] = round(time.time() - _start, 3)
+        return _result
+
+    async def write_batch(self, get_service, functions: frozenset):
+        """
+        批量接口：请求体为{"calls": [...]}，返回{"success": 全部成功, "data": [每个调用的结果], "elapsed":}
+        :param get_service:
+        :param functions: 允许调用的方法
+        :return:
+        """
+        _calls = (getattr(self, 'params') or {}).get('calls')
+        if not isinstance(_calls, list) or not _calls or not all([isinstance(_, dict) for _ in _calls]):
+            self.write({"success": False, "data": "", "msg": "calls must be a non-empty list"})
+            return
+        if len(_calls) > BATCH_MAX_CALLS:
+            self.write({"success": False, "data": "", "msg": f"at most {BATCH_MAX_CALLS} calls per batch"})
+            return
+        _start = time.time()
+        try:
+            _results = await self.run_batch(_calls, get_service, functions)
+        except ValueError as e:
+            self.write({"success": False, "data": "", "msg": str(e)})
+            return
+        logging.info("batch: {}".format([(_['function_name'], _['success'], _['elapsed']) for _ in _results]))
+        self.write({"success": all([_['success'] for _ in _results]), "data": _results,
+                    "elapsed": round(time.time() - _start, 3)})
+
+    async def write_json_stream(self, key: tuple, pages):
+        """
+        分块写回分页结果，格式为{"data": [...], "success": true}
+        每页在执行层中获取、转换后立即写出并flush，中途异常时以"success": false结束
+        :param key: (目标类型, 目标标识)
+        :param pages: 逐页返回list的生成器
+        :return:
+        """
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write('{"data": [')
+        _first = True
+        try:
+            while True:
+                _page = await self.run_blocking(key, next, pages, None)
+                if _page is None:
+                    break
+                if _page:
+                    self.write(('' if _first else ', ') + json_encode(_page)[1:-1])
+                    _first = False
+                await self.flush()
+            self.write('], "success": true}')
+        except StreamClosedError:
+            logging.warning('client closed while streaming')
+            pages.close()
+        except Exception as e:
+            logging.exception(e)
+            self.write(f'], "success": false, "msg": {json_encode(str(e))}}}')
@@ -2,8 +2,39 @@
 
 from handlers.base import BaseHandler
 import logging
+from datetime import timedelta
+from tornado.escape import json_encode
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.queues import Queue
+from tornado.util import TimeoutError
+from service.rollout import ROLLOUT_DEADLINE
 from service.k8s_service import K8sService
-from service.node_service import NodeService
+from service.node_service import NodeService, sort_pods, NODE_POD_SORT_KEYS, NODE_PUSH, NODE_PUSH_TOKEN_HEADER
+from service.node_sampler import NODE_SAMPLER
+from service.node_aggregation import aggregate_node_usage, NODE_GROUP_LABELS
+from service.usage_history import USAGE_HISTORY
+from service.replication_monitor import REPLICATION_MONITOR, check_replication, summarize
+from service.mysql_monitor_service import SQL_STREAM_MAX_BYTES
+from utils import get_client
+
+ROLLOUT_HEARTBEAT = 15  # 发布进度推送的心跳间隔（秒）
+# 批量接口允许调用的方法：只包含返回json结构的方法，不含生成器、内部对象及track_rollout等长时间运行的方法
+K8S_BATCH_FUNCTIONS = frozenset([
+    'get_cluster_version', 'get_source_status', 'list_node', 'label_node', 'list_namespace',
+    'list_config_map', 'patch_config_map', 'update_config_map',
+    'list_pod_for_all_namespaces', 'list_namespaced_pod', 'read_namespaced_pod', 'read_namespaced_pod_log',
+    'delete_namespaced_pod', 'exec_command_on_pod',
+    'list_daemon_set_for_all_namespaces', 'list_namespaced_daemon_set', 'read_namespaced_daemon_set',
+    'list_ingress_for_all_namespaces', 'list_namespaced_ingress', 'read_namespaced_ingress', 'patch_namespaced_ingress',
+    'list_deployment_for_all_namespaces', 'list_namespaced_deployment', 'read_namespaced_deployment',
+    'patch_namespaced_deployment_scale', 'patch_namespaced_deployment_image', 'replace_namespaced_deployment',
+    'set_new_version_by_deploy', 'set_new_version_by_deploy_list', 'set_new_version_by_image_name',
+    'set_attr_by_deploy'
+])
+MYSQL_BATCH_FUNCTIONS = frozenset([
+    'get_version', 'get_status', 'get_status_rates', 'get_status_history', 'get_long_queries', 'execute_sql'
+])
 
 
 class PingHandler(BaseHandler):
@@ -23,7 +54,10 @@ class UpdateDeploymentHandler(BaseHandler):
         new_image = getattr(self, 'params').get("new_image")
         if not all([config, name, namespace, new_image]):
             self.write({"success": False, "data": "", "msg": "incomplete arguments"})
-        data = K8sService(kubeconfig=config).patch_namespaced_deployment_image(
+            return
+        _service = K8sService(kubeconfig=config)
+        data = await self.run_blocking(
+            _service.concurrency_key, _service.patch_namespaced_deployment_image,
             name=name, namespace=namespace, new_image=new_image)
         logging.info("result: {}".format(data))
         self.write({"success": True, "data": data})
@@ -39,7 +73,10 @@ class SetImageHandler(BaseHandler):
         new_image = getattr(self, 'params').get('new_image')
         if not all([config, namespace, new_image]):
             self.write({"success": False, "data": "", "msg": "incomplete arguments"})
-        data = K8sService(kubeconfig=config).set_new_version_by_image_name(namespace=namespace, new_image=new_image)
+            return
+        _service = K8sService(kubeconfig=config)
+        data = await self.run_blocking(
+            _service.concurrency_key, _service.set_new_version_by_image_name, namespace=namespace, new_image=new_image)
         self.write({"success": True, "data": data})
 
 
@@ -50,27 +87,179 @@ class ListDeploymentHandler(BaseHandler):
         namespace = getattr(self, 'params').get("namespace", None)
         client = K8sService(kubeconfig=config)
         if namespace:
-            data = client.list_namespaced_deployment(namespace)
+            data = await self.run_blocking(client.concurrency_key, client.list_namespaced_deployment, namespace)
+        elif getattr(self, 'params').get("stream"):
+            # 分页获取并分块写回
+            await self.write_json_stream(client.concurrency_key, client._iter_deployment_for_all_namespaces())
+            return
         else:
-            data = client.list_deployment_for_all_namespaces()
+            data = await self.run_blocking(client.concurrency_key, client.list_deployment_for_all_namespaces)
         logging.info("result: {}".format(data))
-        self.write({"success": True, "data": data})
+        _result = {"success": True, "data": data}
+        # 从informer本地缓存读取时返回数据新鲜度
+        client.cache_info and _result.update(cache=client.cache_info)
+        self.write(_result)
+
+
+class RolloutStatusHandler(BaseHandler):
+    """
+    通过deployment watch跟踪发布进度，以分块的ndjson或SSE推送进度事件，最后一个事件为done
+    """
+
+    async def post(self):
+        config = getattr(self, 'params').get("config")
+        deployments = getattr(self, 'params').get("deployments")
+        if not all([config, deployments]):
+            self.write({"success": False, "data": "", "msg": "incomplete arguments"})
+            return
+        _sse = getattr(self, 'params').get("format") == 'sse' \
+            or 'text/event-stream' in self.request.headers.get('Accept', '')
+        self.set_header('Content-Type', 'text/event-stream' if _sse else 'application/x-ndjson')
+        self.set_header('Cache-Control', 'no-cache')
+
+        _service = K8sService(kubeconfig=config)
+        _queue = Queue()
+        _io_loop = IOLoop.current()
+        self._tracker = await self.run_blocking(
+            _service.concurrency_key, _service.track_rollout, deployments=deployments,
+            on_event=lambda _event: _io_loop.add_callback(_queue.put_nowait, _event),
+            deadline=float(getattr(self, 'params').get("deadline") or ROLLOUT_DEADLINE))
+        try:
+            while True:
+                try:
+                    _event = await _queue.get(timeout=timedelta(seconds=ROLLOUT_HEARTBEAT))
+                except TimeoutError:
+                    # 心跳，避免中间代理断开空闲连接
+                    self.write(': heartbeat\n\n' if _sse else json_encode({'type': 'heartbeat'}) + '\n')
+                    await self.flush()
+                    continue
+                self.write(f"event: {_event['type']}\ndata: {json_encode(_event)}\n\n" if _sse
+                           else json_encode(_event) + '\n')
+                await self.flush()
+                if _event['type'] == 'done':
+                    break
+        except StreamClosedError:
+            logging.warning('client closed while tracking rollout')
+        finally:
+            self._tracker.stop()
+
+    def on_connection_close(self):
+        hasattr(self, '_tracker') and self._tracker.stop()
 
 
 class StatisticsHandler(BaseHandler):
 
     async def post(self):
-        if hasattr(self, 'monitor_list') and getattr(self, 'monitor_list'):
-            self.write(
-                {
-                    'success': True,
-                    'data': NodeService(getattr(self, 'params').get('config')).get_node_hard_usage(
-                        monitor_list=getattr(self, 'monitor_list'),
-                        monitor_port=getattr(self, 'monitor_port') if hasattr(self, 'monitor_port') else 8000
-                    )
-                })
+        # 节点下的pod按使用量排序：cpu、memory
+        _sort_by = getattr(self, 'params').get('sort_by') or 'cpu'
+        if _sort_by not in NODE_POD_SORT_KEYS:
+            self.write({"success": False, "data": "", "msg": f"sort_by must be one of {NODE_POD_SORT_KEYS}"})
+            return
+        _monitor_list = getattr(self, 'monitor_list') if hasattr(self, 'monitor_list') else None
+        _monitor_port = getattr(self, 'monitor_port') if hasattr(self, 'monitor_port') else 8000
+        if NODE_SAMPLER.enabled:
+            # 从后台采集的快照返回，max_age（秒）指定可接受的最大快照时间，超过时先采集一次
+            _max_age = getattr(self, 'params').get('max_age')
+            _snapshot = await NODE_SAMPLER.get(
+                getattr(self, 'params').get('config'), monitor_list=_monitor_list, monitor_port=_monitor_port,
+                max_age=float(_max_age) if _max_age is not None else None)
+            _result = {'success': _snapshot['error'] is None or bool(_snapshot['data']),
+                       'data': [dict(_node, pods=sort_pods(_node.get('pods') or [], _sort_by))
+                                for _node in _snapshot['data']] if _sort_by != 'cpu' else _snapshot['data'],
+                       'sampled_at': _snapshot['sampled_at'],
+                       'age': _snapshot['age'],
+                       'msg': _snapshot['error']}
         else:
-            self.write({"success": True, "data": NodeService(getattr(self, 'params').get('config')).get_node_info()})
+            _service = NodeService(getattr(self, 'params').get('config'))
+            if _monitor_list:
+                _data = await self.run_blocking(
+                    _service.concurrency_key, _service.get_node_hard_usage, monitor_list=_monitor_list,
+                    monitor_port=_monitor_port, sort_by=_sort_by)
+            else:
+                _data = await self.run_blocking(_service.concurrency_key, _service.get_node_info, sort_by=_sort_by)
+            _result = {"success": True, "data": _data}
+        await self.add_aggregation(_result)
+        self.write(_result)
+
+    async def add_aggregation(self, result: dict):
+        """
+        在结果中加入服务端汇总：集群合计、按节点标签分组、使用率百分位数及异常节点
+        summary_only为true时只返回汇总，不返回每个节点的数据
+        :param result:
+        :return:
+        """
+        _params = getattr(self, 'params')
+        _group_by = _params.get('group_by') or NODE_GROUP_LABELS
+        _group_by = [_group_by] if isinstance(_group_by, str) else _group_by
+        _service = NodeService(_params.get('config'))
+        try:
+            _labels = await self.run_blocking(_service.concurrency_key, _service.get_node_labels)
+        except Exception as e:
+            logging.error(f'get node labels failed:{e}')
+            _labels = {}
+        result['aggregation'] = await self.run_blocking(
+            ('usage', _service.client.key), aggregate_node_usage, result['data'], labels=_labels, group_by=_group_by)
+        _params.get('summary_only') and result.pop('data')
+
+
+class NodeIngestHandler(BaseHandler):
+    """
+    节点监控服务推送模式的接收接口，请求体可gzip压缩（Content-Encoding: gzip）：
+    {"host": 节点ip, "interval": 推送间隔, "sent_at": 发送时间, "samples": [采样]}
+    请求头需携带[ops] node_push_token配置的共享token
+    """
+    log_body = False
+
+    async def post(self):
+        if not NODE_PUSH.authorize(self.request.headers.get(NODE_PUSH_TOKEN_HEADER)):
+            logging.warning(f'unauthorized node push from {self.request.remote_ip}')
+            self.set_status(403)
+            self.write({"success": False, "data": "", "msg": "invalid or missing node push token"})
+            return
+        _params = getattr(self, 'params')
+        if not _params or not isinstance(_params.get('samples'), list):
+            self.write({"success": False, "data": "", "msg": "incomplete arguments"})
+            return
+        # 未指定host时使用来源ip，NAT后的节点需指定与monitor_list一致的ip
+        _host = _params.get('host') or self.request.remote_ip
+        try:
+            # 写入使用历史（含分段文件）在执行层中进行
+            _accepted = await self.run_blocking(('usage', 'push'), NODE_PUSH.ingest, _host, _params['samples'],
+                                                interval=_params.get('interval'), sent_at=_params.get('sent_at'))
+        except (KeyError, TypeError, ValueError, ZeroDivisionError) as e:
+            logging.error(f'invalid samples from {_host}:{e!r}')
+            self.write({"success": False, "data": "", "msg": f"invalid samples: {e!r}"})
+            return
+        self.write({"success": True, "data": {"host": _host, "accepted": _accepted}})
+
+
+class UsageHistoryHandler(BaseHandler):
+    """
+    节点、pod资源使用历史查询，数据来自后台采集
+    """
+
+    async def post(self):
+        config = getattr(self, 'params').get("config")
+        if not config:
+            self.write({"success": False, "data": "", "msg": "incomplete arguments"})
+            return
+        _params = getattr(self, 'params')
+        _cluster = get_client(kubeconfig=config).key
+        try:
+            if _params.get("top"):
+                data = await self.run_blocking(
+                    ('usage', _cluster), USAGE_HISTORY.top, _cluster, kind=_params.get("kind", 'node'),
+                    metric=_params.get("metric", 'cpu'), start=_params.get("start"), end=_params.get("end"),
+                    agg=_params.get("agg", 'avg'), k=int(_params.get("top")))
+            else:
+                data = await self.run_blocking(
+                    ('usage', _cluster), USAGE_HISTORY.query, _cluster, kind=_params.get("kind", 'node'),
+                    names=_params.get("names"), start=_params.get("start"), end=_params.get("end"),
+                    step=_params.get("step"), agg=_params.get("agg", 'avg'), metrics=_params.get("metrics"))
+        except ValueError as e:
+            self.write({"success": False, "data": "", "msg": str(e)})
+            return
+        self.write({"success": True, "data": data})
 
 
 class K8sManageHandler(BaseHandler):
@@ -83,11 +272,25 @@ class K8sManageHandler(BaseHandler):
 
         if not all([config, name]):
             self.write({"success": False, "data": "", "msg": "incomplete arguments"})
+            return
+
+        if name.startswith('_'):
+            # 私有方法（如分页生成器_iter_*）不对外调用
+            self.write({"success": False, "data": "", "msg": f"invalid function_name {name}"})
+            return
 
-        func = getattr(K8sService(kubeconfig=config), name)
-        data = func(**params)
+        _service = K8sService(kubeconfig=config)
+        if getattr(self, 'params').get("stream") and name.startswith('list_') \
+                and hasattr(_service, name.replace('list_', '_iter_', 1)):
+            # 支持分页的list接口，分页获取并分块写回
+            await self.write_json_stream(
+                _service.concurrency_key, getattr(_service, name.replace('list_', '_iter_', 1))(**(params or {})))
+            return
+        data = await self.run_blocking(_service.concurrency_key, getattr(_service, name), **(params or {}))
         logging.info("result: {}".format(data))
-        self.write({"success": True, "data": data})
+        _result = {"success": True, "data": data}
+        _service.cache_info and _result.update(cache=_service.cache_info)
+        self.write(_result)
 
 
 class MysqlMonitorHandler(BaseHandler):
@@ -98,45 +301,120 @@ class MysqlMonitorHandler(BaseHandler):
         Handler作为一个分发器
         :return:
         """
-        _func = getattr(getattr(self, 'db'), getattr(self, 'params').get('function_name'))
-        self.write(_func(**getattr(self, 'params').get('function_params')))
+        _db = getattr(self, 'db')
+        if getattr(self, 'params').get('function_name') == 'execute_sql' and getattr(self, 'params').get('stream'):
+            _stream = getattr(self, 'params').get('stream')
+            await self.write_sql_stream(_db, getattr(self, 'params').get('function_params'),
+                                        _stream if isinstance(_stream, dict) else {})
+            return
+        _func = getattr(_db, getattr(self, 'params').get('function_name'))
+        self.write(await self.run_blocking(
+            _db.concurrency_key, _func, **getattr(self, 'params').get('function_params')))
+
+    async def write_sql_stream(self, db, function_params: dict, options: dict):
+        """
+        流式写回execute_sql的结果，每批读取后立即写出并flush
+        format为ndjson时第一行为{"fields": []}，之后每行一条记录，最后一行为汇总；
+        否则为{"fields": [], "data": [...], "rows":, "truncated":, "success": true}
+        columnar为true时记录为按fields顺序的数组，不重复字段名；写出的字节数超过max_bytes时停止
+        :param db:
+        :param function_params: sql_str、db_name
+        :param options: {'format':, 'columnar':, 'batch_size':, 'max_rows':, 'max_bytes':, 'timeout':}
+        :return:
+        """
+        _ndjson = options.get('format') == 'ndjson'
+        _max_bytes = int(options.get('max_bytes') or SQL_STREAM_MAX_BYTES)
+        _pages = db.iter_sql(**function_params, columnar=bool(options.get('columnar')),
+                             **{_k: options[_k] for _k in ('batch_size', 'max_rows', 'timeout') if _k in options})
+        _opened, _first, _rows, _bytes, _truncated = False, True, 0, 0, None
+        try:
+            while True:
+                _page = await self.run_blocking(db.concurrency_key, next, _pages, None)
+                if _page is None:
+                    break
+                if 'fields' in _page:
+                    self.set_header('Content-Type', 'application/x-ndjson' if _ndjson
+                                    else 'application/json; charset=UTF-8')
+                    self.write(json_encode(_page) + '\n' if _ndjson
+                               else f'{{"fields": {json_encode(_page["fields"])}, "data": [')
+                    _opened = True
+                elif 'rows' in _page:
+                    _chunk = ''.join([json_encode(_) + '\n' for _ in _page['rows']]) if _ndjson \
+                        else ('' if _first else ', ') + json_encode(_page['rows'])[1:-1]
+                    if _bytes + len(_chunk) > _max_bytes:
+                        # 超出时逐行写到上限为止
+                        for _row in _page['rows']:
+                            _chunk = json_encode(_row) + '\n' if _ndjson \
+                                else ('' if _first else ', ') + json_encode(_row)
+                            if _bytes + len(_chunk) > _max_bytes:
+                                break
+                            self.write(_chunk)
+                            _first, _rows, _bytes = False, _rows + 1, _bytes + len(_chunk)
+                        _truncated = 'max_bytes'
+                        break
+                    self.write(_chunk)
+                    _first, _rows, _bytes = False, _rows + len(_page['rows']), _bytes + len(_chunk)
+                else:
+                    _truncated = _page['summary']['truncated']
+                await self.flush()
+            _summary = {'rows': _rows, 'bytes': _bytes, 'truncated': _truncated, 'success': True}
+            self.write(json_encode(_summary) + '\n' if _ndjson else '], ' + json_encode(_summary)[1:])
+        except StreamClosedError:
+            logging.warning('client closed while streaming sql result')
+        except Exception as e:
+            logging.exception(e)
+            if not _opened:
+                self.write({"success": False, "data": "", "msg": str(e)})
+            else:
+                _error = {'rows': _rows, 'success': False, 'msg': str(e)}
+                self.write(json_encode(_error) + '\n' if _ndjson else '], ' + json_encode(_error)[1:])
+        finally:
+            # 提前结束时关闭生成器，释放（关闭）未读完结果集的连接
+            await self.run_blocking(db.concurrency_key, _pages.close)
+
+
+class K8sManageBatchHandler(BaseHandler):
+
+    async def post(self):
+        """
+        批量调用K8sService：{"config":, "calls": [{"function_name":, "function_params":, "id":, "depends_on":}]}
+        每个调用可单独指定config，同一config共用缓存的client
+        :return:
+        """
+        _config = (getattr(self, 'params') or {}).get('config')
+        await self.write_batch(lambda _call: K8sService(kubeconfig=_call.get('config') or _config),
+                               K8S_BATCH_FUNCTIONS)
+
+
+class MysqlMonitorBatchHandler(BaseHandler):
+
+    async def post(self):
+        """
+        批量调用MysqlMonitorService：{"calls": [{"function_name":, "function_params":, "id":, "depends_on":}]}
+        不支持流式执行
+        :return:
+        """
+        if getattr(self, 'db') is None:
+            self.write({"success": False, "data": "", "msg": "db monitor is not enabled"})
+            return
+        await self.write_batch(lambda _call: getattr(self, 'db'), MYSQL_BATCH_FUNCTIONS)
 
 
 class MysqlClusterMonitorHandler(BaseHandler):
     """
     完成MysqlCluster、Mysql主从的存活监控及主从同步监控
+    开启后台监控时直接返回最新的检查结果及延迟趋势，否则并发检查所有节点
     """
 
     async def get(self):
         if getattr(self, 'db_cluster'):
-            from service.mysql_monitor_service import MysqlMonitorService
-            _db_cluster = getattr(self, 'db_cluster')
-            _db_info = {
-                'success': [],
-                'error': []
-            }
-            for _ in _db_cluster['mysql_node_list']:
-                try:
-                    _db_cli = MysqlMonitorService(
-                        host=_[0],
-                        port=int(_[1]),
-                        user_name=_db_cluster['mysql_cluster_user'],
-                        password=_db_cluster['mysql_cluster_password'],
-                        db_name='mysql'
-                    )
-                    _syn_info = _db_cli.execute_sql('show slave status;')
-                    if _syn_info['data'] and _syn_info['data'][0]['Slave_IO_Running'] \
-                            and _syn_info['data'][0]['Slave_SQL_Running'] \
-                            and _syn_info['data'][0]['Last_Errno'] == 0 \
-                            and _syn_info['data'][0]['Last_SQL_Errno'] == 0:
-                        _db_info['success'].append(f'{_[0]}:{_[1]}')
-
-                    logging.info(_syn_info)
-                except Exception as e:
-                    logging.error(f'{_[0]}:{_[1]}DB connect error!!!')
-                    _db_info['error'].append(f'{_[0]}{_[1]}@{e}')
-                else:
-                    del _db_cli
-            self.write(_db_info)
+            if REPLICATION_MONITOR.active:
+                # max_age（秒）指定可接受的最大结果时间，超过时先检查一次
+                _max_age = self.get_argument('max_age', None)
+                self.write(await REPLICATION_MONITOR.get(max_age=float(_max_age) if _max_age is not None else None))
+                return
+            _nodes = await self.run_blocking(('db', 'replication'), check_replication, getattr(self, 'db_cluster'))
+            logging.info(_nodes)
+            self.write(summarize(_nodes))
         else:
             self.write({'success': [], 'error': []})
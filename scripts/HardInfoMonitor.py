@@ -3,16 +3,65 @@
 # Time: 2020/7/7 18:05
 # File: hard_info.py
 
+import gzip
+import json
 import logging
+import os
+import re
+import struct
+import threading
+import time
+import urllib.request
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
 # from typing import Optional, Awaitable
 
 import tornado.httpserver
 import tornado.ioloop
 import tornado.options
 import tornado.web
+from tornado.escape import json_encode
 from tornado.options import define, options
 import psutil
 
+SAMPLE_INTERVAL = 5  # 后台采样间隔（秒）
+DISK_TIMEOUT = 2  # 单个挂载点disk_usage的超时时间（秒），NFS等挂载点无响应时不阻塞采样
+CPU_IDLE_FIELDS = ('idle', 'iowait')
+DELTA_HISTORY = 32  # 保留的历史采样数，since超出范围时返回全量
+PUSH_INTERVAL = 15  # 推送模式下批量推送的间隔（秒）
+PUSH_BUFFER = 720  # 推送失败时最多缓存的采样数，超过时丢弃最早的
+PUSH_TIMEOUT = 10  # 推送请求的超时时间（秒）
+PUSH_TOKEN_HEADER = 'X-Node-Push-Token'  # 携带共享token的请求头，与部署服务的node_push_token一致
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+CGROUP_DISCOVER_INTERVAL = 30  # 重新扫描pod cgroup目录的间隔（秒）
+CGROUP_READ_SIZE = 8192  # 单个统计文件一次读取的最大字节数
+CGROUP_POD_PATTERN = re.compile(r'pod([0-9a-f]{8}[-_][0-9a-f]{4}[-_][0-9a-f]{4}[-_][0-9a-f]{4}[-_][0-9a-f]{12})(\.slice)?$')
+CGROUP_CONTAINER_PREFIXES = ('cri-containerd-', 'docker-', 'crio-', 'libpod-')
+# 统计文件：{类型: (v1控制器, 候选文件名)}，v2所有文件在同一目录下
+CGROUP_V1_FILES = {
+    'cpu': (('cpuacct', 'cpu,cpuacct'), ('cpuacct.usage',)),
+    'throttle': (('cpu', 'cpu,cpuacct'), ('cpu.stat',)),
+    'memory': (('memory',), ('memory.usage_in_bytes',)),
+    'memory_stat': (('memory',), ('memory.stat',)),
+    'io_bytes': (('blkio',), ('blkio.throttle.io_service_bytes_recursive', 'blkio.throttle.io_service_bytes')),
+    'io_ops': (('blkio',), ('blkio.throttle.io_serviced_recursive', 'blkio.throttle.io_serviced'))
+}
+CGROUP_V2_FILES = {'cpu': 'cpu.stat', 'memory': 'memory.current', 'memory_stat': 'memory.stat', 'io': 'io.stat'}
+
+# 紧凑二进制格式（小端，固定结构），与service/node_service.py中的解码保持一致：
+# 头部：magic(2s) 版本(B) 保留(B) 序号(I) 采样时间(d) cpu核数(H) cpu使用率(f) loadavg(3f)
+# 内存：total used free available(4Q) percent(f) swap_total swap_used swap_free(3Q) swap_percent(f)
+# 磁盘：个数(H)，每个磁盘为 挂载点长度(H) 挂载点(utf-8) total used free(3Q) percent(f) stale(B)
+BINARY_CONTENT_TYPE = 'application/x-hardinfo'
+BINARY_MAGIC = b'HI'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<2sBBIdHf3f')
+BINARY_MEMORY = struct.Struct('<4Qf3Qf')
+BINARY_COUNT = struct.Struct('<H')
+BINARY_DISK = struct.Struct('<3QfB')
+
 
 class HardInfoUtils(object):
 
@@ -24,10 +73,79 @@ class HardInfoUtils(object):
             'DISK': HardInfoUtils.get_disk_usage()
         }
 
+    @staticmethod
+    def get_cpu_rate(previous, current):
+        """
+        根据两次cpu_times(percpu=True)采样计算区间内的cpu使用率
+        :param previous:
+        :param current:
+        :return: (总使用率0-1, 每个cpu各状态的百分比，与cpu_times_percent(percpu=True)的结构一致)
+        """
+        _busy, _total, _detail = 0.0, 0.0, []
+        for _prev, _cur in zip(previous, current):
+            _delta = [max(_c - _p, 0.0) for _p, _c in zip(_prev, _cur)]
+            # guest时间已包含在user、nice中，与psutil一致不重复计算
+            _cpu_total = sum([_d for _f, _d in zip(_cur._fields, _delta) if _f not in ('guest', 'guest_nice')])
+            _cpu_idle = sum([_d for _f, _d in zip(_cur._fields, _delta) if _f in CPU_IDLE_FIELDS])
+            _busy += _cpu_total - _cpu_idle
+            _total += _cpu_total
+            _detail.append([round(_d * 100.0 / _cpu_total, 1) if _cpu_total else 0.0 for _d in _delta])
+        return (round(_busy / _total, 4) if _total else 0.0), _detail
+
+    @staticmethod
+    def pack(info: dict, seq: int = 0, timestamp: float = 0):
+        """
+        将采样结果编码为紧凑二进制格式，不含每个cpu的detail
+        :param info:
+        :param seq:
+        :param timestamp:
+        :return:
+        """
+        _cpu, _memory, _disk = info['CPU'], info['MEMORY'], info['DISK']
+        _buffer = [
+            BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0, seq, timestamp, _cpu['total'], _cpu['usage'],
+                               *_cpu['loadavg']),
+            BINARY_MEMORY.pack(_memory['total'], _memory['used'], _memory['free'], _memory['available'],
+                               _memory['percent'], _memory['swap_total'], _memory['swap_used'], _memory['swap_free'],
+                               _memory['swap_percent']),
+            BINARY_COUNT.pack(len(_disk))
+        ]
+        for _mountpoint, _usage in _disk.items():
+            _name = _mountpoint.encode('utf-8')
+            _buffer.extend([BINARY_COUNT.pack(len(_name)), _name, BINARY_DISK.pack(
+                _usage['total'], _usage['used'], _usage['free'], _usage['percent'], bool(_usage.get('stale')))])
+        return b''.join(_buffer)
+
+    @staticmethod
+    def flatten(info: dict, prefix: tuple = ()):
+        """
+        展开为{路径: 值}，路径为key的元组（挂载点中含有/），list作为整体比较
+        :param info:
+        :param prefix:
+        :return:
+        """
+        _result = {}
+        for _key, _value in info.items():
+            if isinstance(_value, dict):
+                _result.update(HardInfoUtils.flatten(_value, prefix + (_key,)))
+            else:
+                _result[prefix + (_key,)] = _value
+        return _result
+
+    @staticmethod
+    def unflatten(flat: dict):
+        _result = {}
+        for _path, _value in flat.items():
+            _node = _result
+            for _key in _path[:-1]:
+                _node = _node.setdefault(_key, {})
+            _node[_path[-1]] = _value
+        return _result
+
     @staticmethod
     def get_cpu_usage():
         """
-        获取CPU使用情况
+        获取CPU使用情况（两次调用之间的使用率，后台采样模式下使用HardInfoSampler的区间使用率）
         :return:
         """
         return {
@@ -81,24 +199,539 @@ class HardInfoUtils(object):
         return _disk_info
 
 
+def stat_field(data: bytes, name: bytes):
+    """
+    从"名称 值"格式的统计内容（cpu.stat、memory.stat）中取出一个字段，不解析整个文件
+    :param data:
+    :param name:
+    :return:
+    """
+    _index = data.find(name + b' ')
+    while _index > 0 and data[_index - 1] != 10:
+        _index = data.find(name + b' ', _index + 1)
+    if _index < 0:
+        return None
+    _end = data.find(b'\n', _index)
+    return int(data[_index + len(name) + 1:_end if _end >= 0 else None])
+
+
+class CgroupStats(object):
+    """
+    读取pod及容器cgroup的cpu、内存、io统计（cgroup v1/v2）
+    发现cgroup时打开统计文件并保持fd，每次采样对每个文件只做一次pread，cgroup目录按间隔重新扫描；
+    cpu、io为两次采样之间的速率，内存为当前值，working_set与kubelet一致为usage - inactive_file
+    """
+
+    def __init__(self, root: str = CGROUP_ROOT):
+        self.root = root
+        self.version = 2 if os.path.exists(os.path.join(root, 'cgroup.controllers')) else 1
+        # {(pod uid, 容器id): {'path':, 'qos':, 'fds': {类型: fd}}}，pod本身的容器id为None
+        self.cgroups = {}
+        self._previous = {}
+        self._discovered_at = 0
+        self._raise_fd_limit()
+
+    @staticmethod
+    def _raise_fd_limit():
+        """
+        每个cgroup保持4~6个fd，节点上有数百个容器时超过默认的1024
+        :return:
+        """
+        try:
+            import resource
+            _soft, _hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if _hard == resource.RLIM_INFINITY or _hard > _soft:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (65536 if _hard == resource.RLIM_INFINITY else _hard, _hard))
+        except (ImportError, ValueError, OSError) as e:
+            logging.warning(f'raise fd limit failed:{e}')
+
+    def _base(self, controller: str = None):
+        if self.version == 2:
+            return self.root
+        for _name in CGROUP_V1_FILES[controller][0]:
+            if os.path.isdir(os.path.join(self.root, _name)):
+                return os.path.join(self.root, _name)
+        return None
+
+    def discover(self):
+        """
+        扫描kubepods下的pod及容器cgroup，打开新cgroup的统计文件，关闭已删除cgroup的fd
+        :return:
+        """
+        _base = self._base('memory')
+        _found = {}
+
+        def walk(_path, _relative, _depth):
+            try:
+                _entries = [_ for _ in os.scandir(_path) if _.is_dir(follow_symlinks=False)]
+            except OSError:
+                return
+            for _entry in _entries:
+                _match = CGROUP_POD_PATTERN.search(_entry.name)
+                if _match:
+                    _uid = _match.group(1).replace('_', '-')
+                    _pod_path = os.path.join(_relative, _entry.name)
+                    _qos = 'besteffort' if 'besteffort' in _pod_path else \
+                        'burstable' if 'burstable' in _pod_path else 'guaranteed'
+                    try:
+                        _containers = [_ for _ in os.scandir(_entry.path) if _.is_dir(follow_symlinks=False)]
+                    except OSError:
+                        # 两次扫描之间pod已被删除
+                        continue
+                    _found[(_uid, None)] = (_pod_path, _qos)
+                    for _container in _containers:
+                        _found[(_uid, self.container_id(_container.name))] = (
+                            os.path.join(_pod_path, _container.name), _qos)
+                elif _depth < 2 and (_depth > 0 or _entry.name.startswith('kubepods')):
+                    walk(_entry.path, os.path.join(_relative, _entry.name), _depth + 1)
+
+        _base and walk(_base, '', 0)
+        for _key in [_ for _ in self.cgroups if _ not in _found]:
+            self._close(_key)
+        for _key, (_path, _qos) in _found.items():
+            if _key not in self.cgroups:
+                self.cgroups[_key] = {'path': _path, 'qos': _qos, 'fds': self._open(_path)}
+        self._discovered_at = time.time()
+
+    @staticmethod
+    def container_id(name: str):
+        for _prefix in CGROUP_CONTAINER_PREFIXES:
+            if name.startswith(_prefix):
+                name = name[len(_prefix):]
+        return name[:-len('.scope')] if name.endswith('.scope') else name
+
+    def _open(self, path: str):
+        _fds = {}
+        if self.version == 2:
+            _candidates = {_kind: [os.path.join(self.root, path, _file)] for _kind, _file in CGROUP_V2_FILES.items()}
+        else:
+            _candidates = {_kind: [os.path.join(self._base(_kind) or '', path, _file) for _file in _files]
+                           for _kind, (_, _files) in CGROUP_V1_FILES.items()}
+        for _kind, _files in _candidates.items():
+            for _file in _files:
+                try:
+                    _fds[_kind] = os.open(_file, os.O_RDONLY)
+                    break
+                except OSError:
+                    continue
+        return _fds
+
+    def _close(self, key):
+        for _fd in self.cgroups.pop(key)['fds'].values():
+            try:
+                os.close(_fd)
+            except OSError:
+                pass
+        self._previous.pop(key, None)
+
+    def _read(self, fds: dict):
+        """
+        读取一个cgroup的累计计数
+        :param fds:
+        :return: {'cpu_usec':, 'nr_periods':, 'nr_throttled':, 'memory':, 'inactive_file':, 'rbytes':, ...}
+        """
+        _data = {_kind: os.pread(_fd, CGROUP_READ_SIZE, 0) for _kind, _fd in fds.items()}
+        _counters = {}
+        if self.version == 2:
+            _cpu = _data.get('cpu')
+            if _cpu:
+                _counters.update(cpu_usec=stat_field(_cpu, b'usage_usec'), nr_periods=stat_field(_cpu, b'nr_periods'),
+                                 nr_throttled=stat_field(_cpu, b'nr_throttled'))
+            _inactive = b'inactive_file'
+            if 'io' in _data:
+                _io = dict.fromkeys(('rbytes', 'wbytes', 'rios', 'wios'), 0)
+                for _token in _data['io'].split():
+                    _name, _, _value = _token.partition(b'=')
+                    _name = _name.decode()
+                    if _name in _io:
+                        _io[_name] += int(_value)
+                _counters.update(_io)
+        else:
+            'cpu' in _data and _counters.update(cpu_usec=int(_data['cpu']) // 1000)
+            if 'throttle' in _data:
+                _counters.update(nr_periods=stat_field(_data['throttle'], b'nr_periods'),
+                                 nr_throttled=stat_field(_data['throttle'], b'nr_throttled'))
+            _inactive = b'total_inactive_file'
+            for _kind, _read, _write in (('io_bytes', 'rbytes', 'wbytes'), ('io_ops', 'rios', 'wios')):
+                if _kind not in _data:
+                    continue
+                _parts = _data[_kind].split()
+                # 每个设备为"major:minor Read 值"，最后一行为"Total 值"
+                _counters[_read] = sum([int(_parts[_i + 2]) for _i in range(0, len(_parts) - 2)
+                                        if _parts[_i + 1] == b'Read' and b':' in _parts[_i]])
+                _counters[_write] = sum([int(_parts[_i + 2]) for _i in range(0, len(_parts) - 2)
+                                         if _parts[_i + 1] == b'Write' and b':' in _parts[_i]])
+        'memory' in _data and _counters.update(memory=int(_data['memory']))
+        'memory_stat' in _data and _counters.update(inactive_file=stat_field(_data['memory_stat'], _inactive))
+        return _counters
+
+    @staticmethod
+    def _rate(current: dict, previous: dict, name: str, seconds: float, scale: float = 1.0):
+        if not previous or seconds <= 0 or current.get(name) is None or previous.get(name) is None \
+                or current[name] < previous[name]:
+            return None
+        return round((current[name] - previous[name]) * scale / seconds, 6)
+
+    def sample(self):
+        """
+        采样所有pod及容器cgroup
+        :return: {pod uid: {'qos':, 'cpu':, 'memory':, 'io':, 'containers': {容器id: {'cpu':, 'memory':, 'io':}}}}
+        """
+        if time.time() - self._discovered_at > CGROUP_DISCOVER_INTERVAL:
+            self.discover()
+        _now = time.time()
+        _pods = {}
+        for _key, _cgroup in list(self.cgroups.items()):
+            try:
+                _counters = self._read(_cgroup['fds'])
+            except (OSError, ValueError):
+                # cgroup已删除，下一次扫描前不再读取
+                self._close(_key)
+                continue
+            _previous = self._previous.get(_key)
+            _seconds = _now - _previous[0] if _previous else 0
+            _previous = _previous[1] if _previous else None
+            self._previous[_key] = (_now, _counters)
+            _periods = self._rate(_counters, _previous, 'nr_periods', 1)
+            _throttled = self._rate(_counters, _previous, 'nr_throttled', 1)
+            _memory = _counters.get('memory')
+            _stats = {
+                'cpu': {
+                    'usage': self._rate(_counters, _previous, 'cpu_usec', _seconds, 1e-6),
+                    'throttled': round(_throttled / _periods, 4) if _periods else None
+                },
+                'memory': {
+                    'usage': _memory,
+                    'working_set': max(_memory - (_counters.get('inactive_file') or 0), 0)
+                    if _memory is not None else None
+                },
+                'io': {
+                    'read_bytes': self._rate(_counters, _previous, 'rbytes', _seconds),
+                    'write_bytes': self._rate(_counters, _previous, 'wbytes', _seconds),
+                    'read_ops': self._rate(_counters, _previous, 'rios', _seconds),
+                    'write_ops': self._rate(_counters, _previous, 'wios', _seconds)
+                }
+            }
+            _pod = _pods.setdefault(_key[0], {'containers': {}})
+            if _key[1] is None:
+                _pod.update(_stats, qos=_cgroup['qos'])
+            else:
+                _pod['containers'][_key[1]] = _stats
+        return _pods
+
+
+class HardInfoSampler(object):
+    """
+    后台采样：定时采集cpu、内存、磁盘，cpu为两次采样之间的区间使用率
+    采样结果预先序列化，请求直接返回缓存的payload；
+    disk_usage在工作线程中执行并设置超时，无响应的挂载点沿用上一次的结果并标记stale
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL, pusher=None, cgroups=None):
+        self.interval = interval
+        self.pusher = pusher
+        self.cgroups = cgroups
+        self.sampled_at = None
+        # 当前采样：{'seq':, 'etag':, 'payload': json, 'binary':, 'flat':}，整体替换，请求线程只读
+        self.current = None
+        # pod及容器cgroup的当前采样：{'etag':, 'payload': json}
+        self.cgroup_current = None
+        self.seq = 0
+        self._history = deque(maxlen=DELTA_HISTORY)
+        self._cpu_times = None
+        self._disks = {}
+        self._pending = {}
+        self._stopped = threading.Event()
+
+    def start(self):
+        self._cpu_times = psutil.cpu_times(percpu=True)
+        # 首次采样前等待一小段时间，保证启动后立即有可用的cpu区间使用率
+        time.sleep(0.5)
+        self.sample()
+        threading.Thread(target=self._run, name='hard-info-sampler', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                logging.exception(e)
+
+    def sample(self):
+        _cpu_times = psutil.cpu_times(percpu=True)
+        _usage, _detail = HardInfoUtils.get_cpu_rate(self._cpu_times, _cpu_times)
+        self._cpu_times = _cpu_times
+        self.sampled_at = time.time()
+        self.seq += 1
+        _info = {
+            'CPU': {
+                'total': psutil.cpu_count(),
+                'usage': _usage,
+                'detail': _detail,
+                'loadavg': list(psutil.getloadavg())
+            },
+            'MEMORY': HardInfoUtils.get_memory_usage(),
+            'DISK': self.get_disk_usage(),
+            'TIMESTAMP': self.sampled_at,
+            'SEQ': self.seq
+        }
+        self.current = {
+            'seq': self.seq,
+            'etag': f'"{self.seq}-{int(self.sampled_at)}"',
+            'payload': json_encode(_info),
+            'binary': HardInfoUtils.pack(_info, self.seq, self.sampled_at),
+            'flat': HardInfoUtils.flatten(_info)
+        }
+        self._history.append(self.current)
+        # 推送时不带每个cpu的detail，服务端不使用
+        self.pusher and self.pusher.add(dict(_info, CPU={_k: _v for _k, _v in _info['CPU'].items() if _k != 'detail'}))
+        self.cgroups is not None and self.sample_cgroups()
+
+    def sample_cgroups(self):
+        _start = time.time()
+        _pods = self.cgroups.sample()
+        self.cgroup_current = {
+            'etag': self.current['etag'],
+            'payload': json_encode({
+                'VERSION': self.cgroups.version,
+                'TIMESTAMP': self.sampled_at,
+                'SEQ': self.seq,
+                'CGROUPS': len(self.cgroups.cgroups),
+                'COST': round(time.time() - _start, 6),
+                'PODS': _pods
+            })
+        }
+
+    def delta(self, since: int):
+        """
+        返回自序号since以来变化的字段，since不在保留的历史中时返回None
+        :param since:
+        :return:
+        """
+        _current = self.current
+        _base = [_ for _ in list(self._history) if _['seq'] == since]
+        if not _base:
+            return None
+        _old, _new = _base[0]['flat'], _current['flat']
+        return {
+            'SEQ': _current['seq'],
+            'SINCE': since,
+            'DELTA': HardInfoUtils.unflatten({_k: _v for _k, _v in _new.items() if _old.get(_k) != _v}),
+            'REMOVED': [list(_k) for _k in _old if _k not in _new]
+        }
+
+    @staticmethod
+    def _call_in_thread(func, *args):
+        """
+        在守护线程中执行可能无响应的调用，挂起的线程不会阻塞进程退出
+        :param func:
+        :param args:
+        :return: Future
+        """
+        _future = Future()
+
+        def run():
+            try:
+                _future.set_result(func(*args))
+            except Exception as e:
+                _future.set_exception(e)
+
+        threading.Thread(target=run, name=f'disk-usage-{args[0] if args else ""}', daemon=True).start()
+        return _future
+
+    def get_disk_usage(self):
+        """
+        并发获取各挂载点的使用情况，超时的挂载点在上一次调用返回前不再重复提交
+        :return:
+        """
+        _mountpoints = [_.mountpoint for _ in psutil.disk_partitions()]
+        _submitted = []
+        for _mountpoint in _mountpoints:
+            if _mountpoint not in self._pending:
+                self._pending[_mountpoint] = self._call_in_thread(psutil.disk_usage, _mountpoint)
+                _submitted.append(_mountpoint)
+        _deadline = time.time() + DISK_TIMEOUT
+        _disk_info = {}
+        for _mountpoint in _mountpoints:
+            _future = self._pending[_mountpoint]
+            try:
+                # 上一次采样时已超时的挂载点不再等待
+                _usage = _future.result(timeout=max(_deadline - time.time(), 0) if _mountpoint in _submitted else 0)
+                self._disks[_mountpoint] = {
+                    'total': _usage.total,
+                    'used': _usage.used,
+                    'free': _usage.free,
+                    'percent': _usage.percent / 100.0
+                }
+                _disk_info[_mountpoint] = self._disks[_mountpoint]
+            except FutureTimeoutError:
+                logging.warning(f'disk_usage of {_mountpoint} timeout')
+                if _mountpoint in self._disks:
+                    _disk_info[_mountpoint] = dict(self._disks[_mountpoint], stale=True)
+                continue
+            except Exception as e:
+                logging.error(f'disk_usage of {_mountpoint} failed:{e}')
+            self._pending.pop(_mountpoint, None)
+        return _disk_info
+
+
+class HardInfoPusher(object):
+    """
+    推送模式：收集后台采样，按固定间隔gzip压缩后批量推送到部署服务的/node_ingest
+    推送失败的采样保留到下一次推送，缓存满时丢弃最早的
+    """
+
+    def __init__(self, url: str, host: str = None, interval: float = PUSH_INTERVAL, token: str = None):
+        self.url = url
+        self.host = host
+        self.token = token
+        self.interval = interval
+        self._buffer = deque(maxlen=PUSH_BUFFER)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def add(self, sample: dict):
+        with self._lock:
+            self._buffer.append(sample)
+
+    def start(self):
+        threading.Thread(target=self._run, name='hard-info-pusher', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.push()
+
+    def push(self):
+        """
+        推送缓存的所有采样，网络错误时放回缓存，服务端拒绝的批次丢弃
+        :return:
+        """
+        with self._lock:
+            _samples = list(self._buffer)
+            self._buffer.clear()
+        if not _samples:
+            return
+        _body = gzip.compress(json_encode({
+            'host': self.host,
+            'interval': self.interval,
+            'sent_at': time.time(),
+            'samples': _samples
+        }).encode('utf-8'))
+        _request = urllib.request.Request(self.url, data=_body, method='POST', headers={
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip',
+            PUSH_TOKEN_HEADER: self.token or ''
+        })
+        try:
+            with urllib.request.urlopen(_request, timeout=PUSH_TIMEOUT) as _response:
+                _result = json.loads(_response.read().decode('utf-8'))
+        except Exception as e:
+            if isinstance(e, urllib.error.HTTPError) and e.code == 403:
+                # token错误，重试不会成功
+                logging.error(f'push rejected by {self.url}: invalid or missing token (--push_token)')
+                return
+            logging.warning(f'push {len(_samples)} samples to {self.url} failed:{e}')
+            with self._lock:
+                self._buffer = deque(_samples + list(self._buffer), maxlen=PUSH_BUFFER)
+            return
+        if not _result.get('success'):
+            logging.error(f'push rejected by {self.url}:{_result.get("msg")}')
+
+
 class HardInfoHandler(tornado.web.RequestHandler):
 
     # def data_received(self, chunk: bytes) -> Optional[Awaitable[None]]:
     #     pass
 
+    def initialize(self, sampler=None):
+        self.sampler = sampler
+
     def get(self):
+        """
+        后台采样模式下：
+        If-None-Match与当前ETag一致时返回304；
+        Accept包含application/x-hardinfo或format=binary时返回紧凑二进制格式；
+        since=<序号>时只返回该序号之后变化的字段
+        :return:
+        """
+        _current = self.sampler.current if self.sampler is not None else None
+        if _current is not None:
+            self.set_header('ETag', _current['etag'])
+            self.set_header('X-Sequence', str(_current['seq']))
+            if self.request.headers.get('If-None-Match') == _current['etag']:
+                self.set_status(304)
+                return
+            if self.get_argument('format', None) == 'binary' \
+                    or BINARY_CONTENT_TYPE in self.request.headers.get('Accept', ''):
+                self.set_header('Content-Type', BINARY_CONTENT_TYPE)
+                self.write(_current['binary'])
+                return
+            self.set_header('Content-Type', 'application/json; charset=UTF-8')
+            _since = self.get_argument('since', None)
+            _delta = self.sampler.delta(int(_since)) if _since and _since.isdigit() else None
+            self.write(json_encode(_delta) if _delta is not None else _current['payload'])
+            return
         _hard_info = HardInfoUtils.get_hard_info()
         self.write(_hard_info)
 
 
+class CgroupStatsHandler(tornado.web.RequestHandler):
+
+    def initialize(self, sampler=None):
+        self.sampler = sampler
+
+    def get(self):
+        """
+        pod及容器cgroup的使用量，与主机采样同时采集，key为pod uid及容器id
+        :return:
+        """
+        _current = self.sampler.cgroup_current if self.sampler is not None else None
+        if _current is None:
+            self.set_status(404)
+            self.write({'error': 'cgroup stats disabled, background sampling and --cgroup are required'})
+            return
+        self.set_header('ETag', _current['etag'])
+        if self.request.headers.get('If-None-Match') == _current['etag']:
+            self.set_status(304)
+            return
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(_current['payload'])
+
+
 define("port", default='8000', help='Port number to use for connection')
+define("interval", default=SAMPLE_INTERVAL, type=float, help='Background sampling interval in seconds, 0 to disable')
+define("cgroup", default=True, type=bool, help='Sample pod and container cgroups')
+define("cgroup_root", default=CGROUP_ROOT, help='Mount point of the cgroup filesystem')
+define("push_url", default=None, help='Push samples to this url (e.g. http://deploy-server:8000/node_ingest)')
+define("push_interval", default=PUSH_INTERVAL, type=float, help='Push interval in seconds')
+define("push_host", default=None, help='Node ip reported when pushing, defaults to the source ip seen by the server')
+define("push_token", default=os.environ.get('NODE_PUSH_TOKEN'),
+       help='Shared token of the ingest endpoint (node_push_token), defaults to $NODE_PUSH_TOKEN')
 
 tornado.options.parse_command_line()
 
 
 def start_app():
+    _pusher = None
+    if options.push_url:
+        if options.interval <= 0:
+            raise ValueError('push mode requires background sampling (--interval > 0)')
+        _pusher = HardInfoPusher(options.push_url, host=options.push_host, interval=options.push_interval,
+                                 token=options.push_token).start()
+    _cgroups = CgroupStats(options.cgroup_root) if options.cgroup and os.path.isdir(options.cgroup_root) else None
+    _sampler = HardInfoSampler(interval=options.interval, pusher=_pusher, cgroups=_cgroups).start() \
+        if options.interval > 0 else None
     app = tornado.web.Application(handlers=[
-        (r"/", HardInfoHandler)
+        (r"/", HardInfoHandler, dict(sampler=_sampler)),
+        (r"/cgroup", CgroupStatsHandler, dict(sampler=_sampler))
     ])
 
     http_server = tornado.httpserver.HTTPServer(app, xheaders=True)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado.ioloop import IOLoop
+from tornado.locks import Semaphore
+
+EXECUTOR_MAX_WORKERS = 64  # 阻塞调用线程池大小
+EXECUTOR_TARGET_LIMIT = {
+    'k8s': 8,  # 每个集群的并发上限
+    'db': 4,  # 每个数据库的并发上限
+    'http': 16
+}
+EXECUTOR_DEFAULT_LIMIT = 8
+
+
+class BlockingExecutor(object):
+    """
+    阻塞调用执行层：kubernetes、pymysql、requests等同步调用统一放到有界线程池中执行，
+    并按目标（集群、数据库）限制并发，避免阻塞IOLoop及单个目标占满线程池
+    """
+
+    def __init__(self, max_workers: int = EXECUTOR_MAX_WORKERS, target_limit: dict = None):
+        self.max_workers = max_workers
+        self.target_limit = dict(EXECUTOR_TARGET_LIMIT, **(target_limit or {}))
+        self._executor = None
+        self._semaphores = {}
+
+    def configure(self, max_workers: int = None, target_limit: dict = None):
+        """
+        调整线程池大小及各类目标的并发上限，需在首次调用前执行
+        :param max_workers:
+        :param target_limit: {'k8s': 8, 'db': 4}
+        :return:
+        """
+        self.max_workers = max_workers or self.max_workers
+        self.target_limit.update({_k: _v for _k, _v in (target_limit or {}).items() if _v})
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='blocking')
+        return self._executor
+
+    def _get_semaphore(self, key: tuple):
+        """
+        key为(目标类型, 目标标识)，如('k8s', kubeconfig_hash)、('db', 'host:port')
+        :param key:
+        :return:
+        """
+        if key not in self._semaphores:
+            self._semaphores[key] = Semaphore(self.target_limit.get(key[0], EXECUTOR_DEFAULT_LIMIT))
+        return self._semaphores[key]
+
+    async def run(self, key: tuple, func, *args, **kwargs):
+        """
+        在线程池中执行阻塞调用，同一目标的并发数受限
+        :param key: (目标类型, 目标标识)
+        :param func:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        async with self._get_semaphore(key):
+            logging.debug(f'run {getattr(func, "__name__", func)} on {key}')
+            return await IOLoop.current().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+
+BLOCKING_EXECUTOR = BlockingExecutor()
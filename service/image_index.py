@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+
+CONTAINER_TYPES = ('containers', 'initContainers')
+
+
+def parse_image(image: str):
+    """
+    解析镜像名称为(仓库, tag)，支持带端口的仓库地址及digest
+    eg: host:5000/app:1.0 ==> ('host:5000/app', '1.0')
+        host:5000/app ==> ('host:5000/app', None)
+        app@sha256:abc ==> ('app', 'sha256:abc')
+    :param image:
+    :return:
+    """
+    _name, _, _digest = image.partition('@')
+    _colon = _name.rfind(':')
+    if _colon > _name.rfind('/'):
+        return _name[:_colon], _digest or _name[_colon + 1:]
+    return _name, _digest or None
+
+
+def iter_image_containers(deploy: dict):
+    """
+    遍历deployment（原始json）中的所有容器及初始化容器
+    :param deploy:
+    :return: generator of (仓库, 容器类型, 容器名称)
+    """
+    _spec = deploy['spec']['template']['spec']
+    for _type in CONTAINER_TYPES:
+        for _container in _spec.get(_type) or []:
+            yield parse_image(_container['image'])[0], _type, _container['name']
+
+
+def index_by_repository(deploy: dict):
+    """
+    informer索引函数：deployment中用到的镜像仓库
+    :param deploy:
+    :return:
+    """
+    return list({_repository for _repository, _, _ in iter_image_containers(deploy)})
+
+
+def build_image_index(deployments):
+    """
+    构建镜像仓库到使用它的容器的索引
+    :param deployments: deployment原始json的可迭代对象
+    :return: {仓库: [(namespace, deployment, 容器类型, 容器名称)]}
+    """
+    _index = defaultdict(list)
+    for _deploy in deployments:
+        for _repository, _type, _container in iter_image_containers(_deploy):
+            _index[_repository].append(
+                (_deploy['metadata'].get('namespace'), _deploy['metadata']['name'], _type, _container))
+    return dict(_index)
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+
+from kubernetes.client.rest import ApiException
+from kubernetes.watch.watch import iter_resp_lines
+
+from service.image_index import index_by_repository
+
+INFORMER_WATCH_TIMEOUT = 300  # 单次watch请求的超时时间（秒），到期后按resourceVersion续watch
+INFORMER_SYNC_WAIT = 5  # 首次读取时等待全量同步完成的时间（秒），超时则回退到直接查询api-server
+INFORMER_MAX_BACKOFF = 30  # watch异常后重试的最大间隔（秒）
+
+
+def _pod_spec(_obj):
+    """
+    获取pod或工作负载中的pod spec
+    :param _obj:
+    :return:
+    """
+    _spec = _obj.get('spec') or {}
+    return (_spec.get('template') or {}).get('spec') or {} if 'template' in _spec else _spec
+
+
+def index_by_namespace(_obj):
+    return [_obj['metadata'].get('namespace')]
+
+
+def index_by_name(_obj):
+    return [_obj['metadata']['name']]
+
+
+def index_by_node(_obj):
+    return [(_obj.get('spec') or {}).get('nodeName')]
+
+
+def index_by_image(_obj):
+    _spec = _pod_spec(_obj)
+    return [_c.get('image') for _c in (_spec.get('containers') or []) + (_spec.get('initContainers') or [])]
+
+
+class Informer(object):
+    """
+    单个资源的informer：全量list后通过watch按resourceVersion增量维护本地缓存，410 Gone时重新list
+    本地缓存保存原始json，并按namespace、name、node、image等维护索引
+    """
+
+    def __init__(self, name: str, list_func, indexers: dict):
+        """
+        :param name: 资源名称，如pods
+        :param list_func: 集群级别的list方法，如CoreV1Api().list_pod_for_all_namespaces
+        :param indexers: {索引名: 从对象中取索引值列表的函数}
+        """
+        self.name = name
+        self.list_func = list_func
+        self.indexers = indexers
+        self.store = {}
+        self.indexes = {_index: defaultdict(set) for _index in indexers}
+        self.resource_version = None
+        self.last_sync = None
+        self.last_event = None
+        self.watching = False
+        self.synced = threading.Event()
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._listeners = []
+
+    @staticmethod
+    def get_key(_obj):
+        return _obj['metadata'].get('namespace'), _obj['metadata']['name']
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f'informer-{self.name}', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def add_listener(self, listener):
+        """
+        注册变更回调，listener(event_type, new_obj, old_obj)，在informer线程中调用
+        :param listener:
+        :return:
+        """
+        self._listeners.append(listener)
+
+    def wait_synced(self, timeout: float = INFORMER_SYNC_WAIT):
+        return self.synced.wait(timeout)
+
+    def _run(self):
+        _backoff = 1
+        while not self._stopped.is_set():
+            try:
+                self._list()
+                while not self._stopped.is_set():
+                    self._watch()
+                    _backoff = 1
+            except _ResourceExpired:
+                logging.info(f'informer {self.name} resourceVersion expired, relist')
+                continue
+            except Exception as e:
+                logging.error(f'informer {self.name} failed:{e}')
+            finally:
+                self.watching = False
+            self._stopped.wait(_backoff + random.random())
+            _backoff = min(_backoff * 2, INFORMER_MAX_BACKOFF)
+
+    def _list(self):
+        _response = self.list_func(_preload_content=False)
+        try:
+            _result = json.loads(_response.data)
+        finally:
+            _response.release_conn()
+        # list结果中的item不含kind/apiVersion，与watch、read的结果保持一致
+        _kind = _result.get('kind', '')[:-4] if _result.get('kind', '').endswith('List') else None
+        _store = {}
+        for _obj in _result['items']:
+            _kind and _obj.setdefault('kind', _kind)
+            _obj.setdefault('apiVersion', _result.get('apiVersion'))
+            _store[self.get_key(_obj)] = _obj
+        with self._lock:
+            self.store = _store
+            self.indexes = {_index: defaultdict(set) for _index in self.indexers}
+            [self._index(_key, _obj) for _key, _obj in _store.items()]
+            self.resource_version = _result['metadata']['resourceVersion']
+            self.last_sync = self.last_event = time.time()
+        self.synced.set()
+        self._notify('SYNC', None, None)
+        logging.info(f'informer {self.name} synced {len(_store)} items at {self.resource_version}')
+
+    def _watch(self):
+        try:
+            _response = self.list_func(
+                watch=True, resource_version=self.resource_version, timeout_seconds=INFORMER_WATCH_TIMEOUT,
+                _preload_content=False, _request_timeout=(10, INFORMER_WATCH_TIMEOUT + 30))
+        except ApiException as e:
+            if e.status == 410:
+                raise _ResourceExpired()
+            raise
+        self.watching = True
+        try:
+            for _line in iter_resp_lines(_response):
+                if self._stopped.is_set():
+                    return
+                self._handle_event(json.loads(_line))
+        finally:
+            self.watching = False
+            _response.release_conn()
+
+    def _handle_event(self, _event: dict):
+        _type, _obj = _event['type'], _event['object']
+        if _type == 'ERROR':
+            if _obj.get('code') == 410:
+                raise _ResourceExpired()
+            raise Exception(_obj.get('message'))
+        _key = self.get_key(_obj) if _type != 'BOOKMARK' else None
+        with self._lock:
+            _old = self.store.get(_key)
+            if _type != 'BOOKMARK':
+                _old and self._unindex(_key, _old)
+                if _type == 'DELETED':
+                    self.store.pop(_key, None)
+                else:
+                    self.store[_key] = _obj
+                    self._index(_key, _obj)
+            self.resource_version = _obj['metadata']['resourceVersion']
+            self.last_event = time.time()
+        _type != 'BOOKMARK' and self._notify(_type, _obj, _old)
+
+    def _notify(self, _type, _obj, _old):
+        for _listener in self._listeners:
+            try:
+                _listener(_type, _obj, _old)
+            except Exception as e:
+                logging.error(f'informer {self.name} listener failed:{e}')
+
+    def _index(self, _key, _obj):
+        for _index, _func in self.indexers.items():
+            [self.indexes[_index][_value].add(_key) for _value in _func(_obj)]
+
+    def _unindex(self, _key, _obj):
+        for _index, _func in self.indexers.items():
+            for _value in _func(_obj):
+                _keys = self.indexes[_index].get(_value)
+                if _keys is not None:
+                    _keys.discard(_key)
+                    _keys or self.indexes[_index].pop(_value)
+
+    def list(self, index: str = None, value=None):
+        """
+        从本地缓存获取对象，按(namespace, name)排序，与api-server返回顺序一致
+        :param index: 索引名称，为空时返回全部
+        :param value: 索引值
+        :return:
+        """
+        with self._lock:
+            _keys = self.indexes[index].get(value, ()) if index else self.store.keys()
+            return [self.store[_key] for _key in sorted(_keys, key=lambda _: (_[0] or '', _[1]))]
+
+    def get(self, name: str, namespace: str = None):
+        return self.store.get((namespace, name))
+
+    def freshness(self):
+        """
+        本地缓存的新鲜度，watch正常时数据与api-server基本一致
+        :return:
+        """
+        _now = time.time()
+        return {
+            'source': 'informer',
+            'resource': self.name,
+            'resource_version': self.resource_version,
+            'watching': self.watching,
+            'last_sync': self.last_sync,
+            'last_event': self.last_event,
+            'age': 0 if self.watching else round(_now - (self.last_event or _now), 3)
+        }
+
+
+class _ResourceExpired(Exception):
+    pass
+
+
+class InformerManager(object):
+    """
+    按集群管理informer，每种资源在首次读取时才启动
+    K8sClient被淘汰时停止该集群下的informer
+    """
+
+    INDEXERS = {
+        'pods': {'namespace': index_by_namespace, 'node': index_by_node, 'image': index_by_image},
+        'deployments': {'namespace': index_by_namespace, 'name': index_by_name, 'image': index_by_image,
+                        'repository': index_by_repository},
+        'nodes': {'name': index_by_name},
+        'ingresses': {'namespace': index_by_namespace}
+    }
+
+    def __init__(self, enabled: bool = False, sync_wait: float = INFORMER_SYNC_WAIT):
+        self.enabled = enabled
+        self.sync_wait = sync_wait
+        self._lock = threading.Lock()
+
+    def configure(self, enabled: bool = None, sync_wait: float = None):
+        self.enabled = self.enabled if enabled is None else enabled
+        self.sync_wait = sync_wait or self.sync_wait
+
+    def get_informer(self, k8s_client, resource: str, list_func, wait: bool = True):
+        """
+        获取集群的informer，未启用或未在等待时间内完成同步时返回None
+        :param k8s_client: utils.K8sClient
+        :param resource: pods、deployments、nodes、ingresses
+        :param list_func: 集群级别的list方法
+        :param wait: 是否等待首次同步完成
+        :return:
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            _informers = k8s_client.get_cached('informers', dict, ttl=float('inf'))
+            if resource not in _informers:
+                _informers[resource] = Informer(
+                    name=resource, list_func=list_func, indexers=self.INDEXERS[resource]).start()
+                k8s_client.close_callbacks.append(_informers[resource].stop)
+        _informer = _informers[resource]
+        return _informer if _informer.wait_synced(self.sync_wait if wait else 0) else None
+
+
+INFORMER_MANAGER = InformerManager()
@@ -1,15 +1,34 @@
 # -*- coding: utf-8 -*-
 
+import json
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from utils import get_client
 from kubernetes.stream import stream
-from kubernetes.client import ExtensionsV1beta1IngressBackend, ExtensionsV1beta1HTTPIngressPath
+from kubernetes.client import ExtensionsV1beta1IngressBackend, ExtensionsV1beta1HTTPIngressPath, AppsV1Api
+from kubernetes.client import V1NodeSystemInfo
+from kubernetes.client.rest import ApiException
 from utils import K8S_CLUSTER_V1API_VERSION
 from utils import K8S_CLUSTER_LOWEST_VERSION
 from utils import K8S_SOURCE_TYPE_DEPLOY
 from utils import k8s_object_dict
+from utils import k8s_raw_dict
+from utils import k8s_timestamp
 from utils import K8S_OBJ_NODE
+from utils import K8S_LIST_PAGE_SIZE
+from utils import K8S_ROLLOUT_CONCURRENCY
+from utils import K8S_IMAGE_INDEX_TTL
+from service.executor import BLOCKING_EXECUTOR
+from service.informer import INFORMER_MANAGER
+from service.image_index import parse_image, iter_image_containers, build_image_index
+from service.rollout import RolloutTracker, ROLLOUT_DEADLINE
+
+# 每个集群同时进行的patch数，所有批量更新请求共用，上限与执行层的k8s并发上限一致
+K8S_PATCH_SEMAPHORES = {}
+K8S_PATCH_LOCK = threading.Lock()
 
 
 class K8sService(object):
@@ -17,17 +36,82 @@ class K8sService(object):
     目前采用的API版本均为CoreV1Api，1.17版本deployment的调整暂未支持（已支持）
     """
 
-    def __init__(self, kubeconfig):
+    def __init__(self, kubeconfig, raw_json: bool = True):
+        """
+        :param kubeconfig:
+        :param raw_json: 查询类接口直接解析响应json，跳过OpenAPI模型反序列化；False时使用原模型路径
+        """
         self.client = get_client(kubeconfig)
+        self.concurrency_key = ('k8s', self.client.key)
+        self.raw_json = raw_json
+        # 最近一次从informer本地缓存读取时的数据新鲜度
+        self.cache_info = None
+
+    def _request_json(self, _func, **kwargs):
+        """
+        调用k8s接口，返回json结构（dict/list）的结果
+        raw_json模式下请求时_preload_content=False，只解析一次响应体；否则反序列化成模型后再转回json结构
+        :param _func: k8s api方法
+        :param kwargs:
+        :return:
+        """
+        if not self.raw_json:
+            return self.client.api_client.sanitize_for_serialization(_func(**kwargs))
+        _response = _func(_preload_content=False, **kwargs)
+        try:
+            return json.loads(_response.data)
+        finally:
+            _response.release_conn()
+
+    def _iter_pages(self, _func, limit: int = K8S_LIST_PAGE_SIZE, **kwargs):
+        """
+        通过limit/continue分页调用k8s list接口，逐页返回items
+        :param _func: k8s api list方法
+        :param limit: 每页数量
+        :param kwargs:
+        :return: generator
+        """
+        _continue = None
+        while True:
+            _params = dict(kwargs, _continue=_continue) if _continue else kwargs
+            _page = self._request_json(_func, limit=limit, **_params)
+            yield _page['items']
+            _continue = (_page.get('metadata') or {}).get('continue')
+            if not _continue:
+                break
+
+    def _cached_items(self, resource: str, list_func, index: str = None, value=None):
+        """
+        从informer本地缓存获取原始json对象，未启用informer或未完成同步时返回None
+        :param resource: pods、deployments、nodes、ingresses
+        :param list_func: 集群级别的list方法
+        :param index: 索引名称
+        :param value: 索引值
+        :return:
+        """
+        _informer = INFORMER_MANAGER.get_informer(self.client, resource, list_func)
+        if _informer is None:
+            return None
+        self.cache_info = _informer.freshness()
+        return _informer.list(index, value)
+
+    @staticmethod
+    def _deploy_type(_api, _name: str = 'Deployment'):
+        """
+        获取api对象对应的deployment模型名称
+        :param _api:
+        :param _name: Deployment、DeploymentSpec
+        :return:
+        """
+        return f'V1{_name}' if isinstance(_api, AppsV1Api) else f'ExtensionsV1beta1{_name}'
 
     def get_cluster_version(self):
         """
-        获取集群版本信息，临时方案根据node列表上的第一个node的kubelet版本
+        获取集群版本信息，通过/version接口获取并按集群缓存
         :return:
         """
-        api = self.client.CoreV1Api()
-        node_list = api.list_node()
-        return {'version': node_list.items[0].status.node_info.kubelet_version if node_list.items else None}
+        return self.client.get_cached(
+            'cluster_version', lambda: {'version': self.client.VersionApi().get_code().git_version})
 
     def get_api_obj(self, source_type: str = 'DEPLOYMENT'):
         """
@@ -36,12 +120,16 @@ class K8sService(object):
         :param source_type:
         :return:
         """
-        _version_info = self.get_cluster_version()
-        _version = int(_version_info['version'].split('.')[1]) \
-            if _version_info['version'] else K8S_CLUSTER_LOWEST_VERSION
-        return self.client.AppsV1Api() \
-            if _version >= K8S_CLUSTER_V1API_VERSION and source_type == K8S_SOURCE_TYPE_DEPLOY \
-            else self.client.ExtensionsV1beta1Api()
+
+        def create_api_obj():
+            _version_info = self.get_cluster_version()
+            _version = int(_version_info['version'].split('.')[1]) \
+                if _version_info['version'] else K8S_CLUSTER_LOWEST_VERSION
+            return self.client.AppsV1Api() \
+                if _version >= K8S_CLUSTER_V1API_VERSION and source_type == K8S_SOURCE_TYPE_DEPLOY \
+                else self.client.ExtensionsV1beta1Api()
+
+        return self.client.get_cached(f'api_obj:{source_type}', create_api_obj)
 
     def list_node(self):
         """
@@ -49,17 +137,20 @@ class K8sService(object):
         :return:
         """
         _api = self.client.CoreV1Api()
-        node_list = _api.list_node()
+        _items = self._cached_items('nodes', _api.list_node)
+        node_list = {'items': _items} if _items is not None else self._request_json(_api.list_node)
         return [
             {
-                'name': i.metadata.name,
-                'image_list': [_image.names[1] if len(_image.names) == 2 else _image.names[0] for _image in
-                               i.status.images],
-                'node_info': i.status.node_info.to_dict(),
-                'capacity': i.status.capacity,
-                'labels': i.metadata.labels
+                'name': i['metadata']['name'],
+                'image_list': [_image['names'][1] if len(_image['names']) == 2 else _image['names'][0] for _image in
+                               i['status'].get('images') or []],
+                # 与to_dict()一致，使用属性名作为key
+                'node_info': {_attr: i['status']['nodeInfo'].get(_label)
+                              for _attr, _label in V1NodeSystemInfo.attribute_map.items()},
+                'capacity': i['status'].get('capacity'),
+                'labels': i['metadata'].get('labels')
             }
-            for i in node_list.items]
+            for i in node_list['items']]
 
     def label_node(self, node: str, label_dict: dict):
         """
@@ -132,24 +223,35 @@ class K8sService(object):
         获取一个集群所有命名空间下的pod实例
         :return:
         """
+        return [_ for _page in self._iter_pod_for_all_namespaces() for _ in _page]
+
+    def _iter_pod_for_all_namespaces(self, limit: int = K8S_LIST_PAGE_SIZE):
+        """
+        分页获取一个集群所有命名空间下的pod实例，每页转换后返回
+        :param limit:
+        :return: generator
+        """
         api = self.client.CoreV1Api()
-        pods = api.list_pod_for_all_namespaces()
-        return [
-            {
-                "name": i.metadata.name,
-                "namespace": i.metadata.namespace,
-                "node_name": i.spec.node_name,
-                "host_ip": i.status.host_ip,
-                "pod_ip": i.status.pod_ip,
-                "ready": i.status.container_statuses[0].ready if i.status.container_statuses else True,
-                # 状态
-                "phase": i.status.phase,
-                "restart_count": i.status.container_statuses[0].restart_count if i.status.container_statuses else 0,
-                "start_time": i.status.start_time.strftime("%Y-%m-%d %H:%M:%S"),
-                "image": i.status.container_statuses[0].image if i.status.container_statuses else None,
-            }
-            for i in pods.items
-        ]
+        for _items in self._iter_pages(api.list_pod_for_all_namespaces, limit=limit):
+            yield [
+                {
+                    "name": i['metadata']['name'],
+                    "namespace": i['metadata'].get('namespace'),
+                    "node_name": i['spec'].get('nodeName'),
+                    "host_ip": i['status'].get('hostIP'),
+                    "pod_ip": i['status'].get('podIP'),
+                    "ready": i['status']['containerStatuses'][0]['ready']
+                    if i['status'].get('containerStatuses') else True,
+                    # 状态
+                    "phase": i['status'].get('phase'),
+                    "restart_count": i['status']['containerStatuses'][0]['restartCount']
+                    if i['status'].get('containerStatuses') else 0,
+                    "start_time": k8s_timestamp(i['status'].get('startTime')),
+                    "image": i['status']['containerStatuses'][0]['image']
+                    if i['status'].get('containerStatuses') else None,
+                }
+                for i in _items
+            ]
 
     def list_namespaced_pod(self, namespace='default'):
         """
@@ -158,20 +260,23 @@ class K8sService(object):
         :return:
         """
         api = self.client.CoreV1Api()
-        pods = api.list_namespaced_pod(namespace=namespace)
+        _items = self._cached_items('pods', api.list_pod_for_all_namespaces, 'namespace', namespace)
+        pods = {'items': _items} if _items is not None \
+            else self._request_json(api.list_namespaced_pod, namespace=namespace)
         return [{
-            "name": i.metadata.name,
-            "namespace": i.metadata.namespace,
-            "node_name": i.spec.node_name,
-            "host_ip": i.status.host_ip,
-            "pod_ip": i.status.pod_ip,
-            "start_time": i.status.start_time.strftime("%Y-%m-%d %H:%M:%S") if i.status.start_time else None,
-            "phase": i.status.phase,
-            "ready": i.status.container_statuses[0].ready if i.status.container_statuses else True,
-            "restart_count": i.status.container_statuses[0].restart_count if i.status.container_statuses else 0,
-            "image": i.status.container_statuses[0].image if i.status.container_statuses else None,
-
-        } for i in pods.items]
+            "name": i['metadata']['name'],
+            "namespace": i['metadata'].get('namespace'),
+            "node_name": i['spec'].get('nodeName'),
+            "host_ip": i['status'].get('hostIP'),
+            "pod_ip": i['status'].get('podIP'),
+            "start_time": k8s_timestamp(i['status'].get('startTime')),
+            "phase": i['status'].get('phase'),
+            "ready": i['status']['containerStatuses'][0]['ready'] if i['status'].get('containerStatuses') else True,
+            "restart_count": i['status']['containerStatuses'][0]['restartCount']
+            if i['status'].get('containerStatuses') else 0,
+            "image": i['status']['containerStatuses'][0]['image'] if i['status'].get('containerStatuses') else None,
+
+        } for i in pods['items']]
 
     def read_namespaced_pod(self, name, namespace='default'):
         """
@@ -181,8 +286,8 @@ class K8sService(object):
         :return:
         """
         api = self.client.CoreV1Api()
-        _res = api.read_namespaced_pod(name=name, namespace=namespace)
-        return k8s_object_dict(_res) if _res else None
+        _res = self._request_json(api.read_namespaced_pod, name=name, namespace=namespace)
+        return k8s_raw_dict(_res, 'V1Pod') if _res else None
 
     def read_namespaced_pod_log(self, name, namespace='default', tail_lines=None, since_seconds=None):
         """
@@ -220,16 +325,24 @@ class K8sService(object):
         获取一个集群所有命名空间下的daemonset
         :return:
         """
+        return [_ for _page in self._iter_daemon_set_for_all_namespaces() for _ in _page]
+
+    def _iter_daemon_set_for_all_namespaces(self, limit: int = K8S_LIST_PAGE_SIZE):
+        """
+        分页获取一个集群所有命名空间下的daemonset，每页转换后返回
+        :param limit:
+        :return: generator
+        """
         api = self.client.ExtensionsV1beta1Api()
-        deployments = api.list_daemon_set_for_all_namespaces(pretty=True)
-        return [{
-            "name": i.metadata.name,
-            "namespace": i.metadata.namespace,
-            "image": i.spec.template.spec.containers[0].image,
-            "desired": i.status.desired_number_scheduled,
-            "current": i.status.current_number_scheduled,  # i.status.number_available
-            "template": k8s_object_dict(i.spec),
-        } for i in deployments.items]
+        for _items in self._iter_pages(api.list_daemon_set_for_all_namespaces, limit=limit):
+            yield [{
+                "name": i['metadata']['name'],
+                "namespace": i['metadata'].get('namespace'),
+                "image": i['spec']['template']['spec']['containers'][0]['image'],
+                "desired": i['status'].get('desiredNumberScheduled'),
+                "current": i['status'].get('currentNumberScheduled'),  # i.status.number_available
+                "template": k8s_raw_dict(i['spec'], 'V1beta1DaemonSetSpec'),
+            } for i in _items]
 
     def list_namespaced_daemon_set(self, namespace='default'):
         """
@@ -238,17 +351,17 @@ class K8sService(object):
         :return:
         """
         api = self.client.ExtensionsV1beta1Api()
-        deployments = api.list_namespaced_daemon_set(namespace=namespace, pretty=True)
+        deployments = self._request_json(api.list_namespaced_daemon_set, namespace=namespace)
         return [
             {
-                "name": i.metadata.name,
-                "namespace": i.metadata.namespace,
-                "image": i.spec.template.spec.containers[0].image,
-                "desired": i.status.desired_number_scheduled,
-                "current": i.status.current_number_scheduled,  # i.status.number_available
-                "template": k8s_object_dict(i.spec),
+                "name": i['metadata']['name'],
+                "namespace": i['metadata'].get('namespace'),
+                "image": i['spec']['template']['spec']['containers'][0]['image'],
+                "desired": i['status'].get('desiredNumberScheduled'),
+                "current": i['status'].get('currentNumberScheduled'),  # i.status.number_available
+                "template": k8s_raw_dict(i['spec'], 'V1beta1DaemonSetSpec'),
             }
-            for i in deployments.items
+            for i in deployments['items']
         ]
 
     def read_namespaced_daemon_set(self, name, namespace='default'):
@@ -259,22 +372,30 @@ class K8sService(object):
         :return:
         """
         api = self.client.ExtensionsV1beta1Api()
-        _ds = api.read_namespaced_daemon_set(name=name, namespace=namespace)
-        return k8s_object_dict(_ds)
+        _ds = self._request_json(api.read_namespaced_daemon_set, name=name, namespace=namespace)
+        return k8s_raw_dict(_ds, 'V1beta1DaemonSet')
 
     def list_ingress_for_all_namespaces(self):
         """
         获取一个集群下所有命名空间下的ingress
         :return:
         """
+        return [_ for _page in self._iter_ingress_for_all_namespaces() for _ in _page]
+
+    def _iter_ingress_for_all_namespaces(self, limit: int = K8S_LIST_PAGE_SIZE):
+        """
+        分页获取一个集群下所有命名空间下的ingress，每页转换后返回
+        :param limit:
+        :return: generator
+        """
         api = self.client.ExtensionsV1beta1Api()
-        ingress_obj = api.list_ingress_for_all_namespaces()
-        return [{
-            "name": i.metadata.name,
-            "namespace": i.metadata.namespace,
-            "annotations": i.metadata.annotations,
-            "spec": k8s_object_dict(i.spec),
-        } for i in ingress_obj.items]
+        for _items in self._iter_pages(api.list_ingress_for_all_namespaces, limit=limit):
+            yield [{
+                "name": i['metadata']['name'],
+                "namespace": i['metadata'].get('namespace'),
+                "annotations": i['metadata'].get('annotations'),
+                "spec": k8s_raw_dict(i['spec'], 'ExtensionsV1beta1IngressSpec'),
+            } for i in _items]
 
     def list_namespaced_ingress(self, namespace='default'):
         """
@@ -283,13 +404,15 @@ class K8sService(object):
         :return:
         """
         api = self.client.ExtensionsV1beta1Api()
-        ingress_obj = api.list_namespaced_ingress(namespace=namespace)
+        _items = self._cached_items('ingresses', api.list_ingress_for_all_namespaces, 'namespace', namespace)
+        ingress_obj = {'items': _items} if _items is not None \
+            else self._request_json(api.list_namespaced_ingress, namespace=namespace)
         return [{
-            "name": i.metadata.name,
-            "namespace": i.metadata.namespace,
-            "annotations": i.metadata.annotations,
-            "spec": k8s_object_dict(i.spec),
-        } for i in ingress_obj.items]
+            "name": i['metadata']['name'],
+            "namespace": i['metadata'].get('namespace'),
+            "annotations": i['metadata'].get('annotations'),
+            "spec": k8s_raw_dict(i['spec'], 'ExtensionsV1beta1IngressSpec'),
+        } for i in ingress_obj['items']]
 
     def patch_namespaced_ingress(self, name: str, location: str, service: dict, host: str = None,
                                  namespace: str = 'default'):
@@ -330,30 +453,85 @@ class K8sService(object):
         :return:
         """
         api = self.client.ExtensionsV1beta1Api()
-        i = api.read_namespaced_ingress(name=name, namespace=namespace)
+        i = self._request_json(api.read_namespaced_ingress, name=name, namespace=namespace)
         return {
-            "name": i.metadata.name,
-            "namespace": i.metadata.namespace,
-            "annotations": i.metadata.annotations,
-            "spec": k8s_object_dict(i.spec),
+            "name": i['metadata']['name'],
+            "namespace": i['metadata'].get('namespace'),
+            "annotations": i['metadata'].get('annotations'),
+            "spec": k8s_raw_dict(i['spec'], 'ExtensionsV1beta1IngressSpec'),
         }
 
-    def set_new_version_by_deploy_list(self, deploy_dict: dict, namespace: str = 'default'):
+    def set_new_version_by_deploy_list(self, deploy_dict: dict, namespace: str = 'default',
+                                       concurrency: int = K8S_ROLLOUT_CONCURRENCY):
         """
-        批量更新deploy镜像
-        :param deploy_dict: {deploy_name:image}
+        批量更新deploy镜像，并发发送只包含镜像的patch，无需先读取deployment
+        :param deploy_dict: {deploy_name:image}更新第一个容器；或{deploy_name:{container_name:image}}按容器名更新
         :param namespace:
-        :return:
+        :param concurrency: 并发数
+        :return: 每个deployment的更新结果
+        """
+        return self._patch_deployments(
+            [{'name': _deploy, 'namespace': namespace, 'image': _image, 'body': self.get_image_patch(_image)}
+             for _deploy, _image in deploy_dict.items()],
+            concurrency=concurrency)
+
+    def _patch_semaphore(self):
+        with K8S_PATCH_LOCK:
+            if self.client.key not in K8S_PATCH_SEMAPHORES:
+                K8S_PATCH_SEMAPHORES[self.client.key] = threading.BoundedSemaphore(
+                    BLOCKING_EXECUTOR.target_limit['k8s'])
+            return K8S_PATCH_SEMAPHORES[self.client.key]
+
+    def _patch_deployments(self, patch_list: list, concurrency: int = K8S_ROLLOUT_CONCURRENCY):
+        """
+        并发patch多个deployment
+        本方法在执行层中运行，patch由单独的线程发出；同一集群所有请求的patch共用一个信号量，
+        同时进行的patch数不超过执行层的k8s并发上限（EXECUTOR_TARGET_LIMIT['k8s']），与请求数无关
+        :param patch_list: [{'name':, 'namespace':, 'image':, 'body': patch}]
+        :param concurrency: 本次请求的并发数，不超过k8s并发上限
+        :return: 每个deployment的更新结果
         """
         _api = self.get_api_obj()
-
-        def update_image(_deploy, _image):
-            _deploy_obj = _api.read_namespaced_deployment(name=_deploy, namespace=namespace)
-            _deploy_obj.spec.template.spec.containers[0].image = _image
-            _api.patch_namespaced_deployment(name=_deploy, namespace=namespace, body=_deploy_obj)
-
-        [update_image(_deploy=_, _image=x) for _, x in deploy_dict.items()]
-        return {'success': True}
+        _semaphore = self._patch_semaphore()
+
+        def patch(_item):
+            _start = time.time()
+            _result = {'name': _item['name'], 'namespace': _item['namespace'], 'image': _item['image'],
+                       'success': True}
+            try:
+                with _semaphore:
+                    _api.patch_namespaced_deployment(
+                        name=_item['name'], namespace=_item['namespace'], body=_item['body'],
+                        _preload_content=False).release_conn()
+            except ApiException as e:
+                logging.error(f"set image of {_item['namespace']}/{_item['name']} failed:{e.status} {e.reason}")
+                _result.update(success=False, msg=f'{e.status} {e.reason}')
+            except Exception as e:
+                logging.error(f"set image of {_item['namespace']}/{_item['name']} failed:{e}")
+                _result.update(success=False, msg=str(e))
+            _result['elapsed'] = round(time.time() - _start, 3)
+            return _result
+
+        if not patch_list:
+            return {'success': True, 'data': []}
+        _workers = max(min(int(concurrency or 1), BLOCKING_EXECUTOR.target_limit['k8s'], len(patch_list)), 1)
+        with ThreadPoolExecutor(max_workers=_workers, thread_name_prefix='deploy-patch') as _pool:
+            _result_list = list(_pool.map(patch, patch_list))
+        return {'success': all([_['success'] for _ in _result_list]), 'data': _result_list}
+
+    @staticmethod
+    def get_image_patch(image):
+        """
+        生成只修改镜像的patch
+        image为str时生成json patch，替换第一个容器的镜像（与原先按containers[0]修改一致）；
+        image为{container_name: image}时生成strategic merge patch，按容器名合并
+        :param image:
+        :return:
+        """
+        if isinstance(image, dict):
+            return {'spec': {'template': {'spec': {
+                'containers': [{'name': _name, 'image': _image} for _name, _image in image.items()]}}}}
+        return [{'op': 'replace', 'path': '/spec/template/spec/containers/0/image', 'value': image}]
 
     def set_new_version_by_deploy(self, new_image: str, deploy_name: str, namespace: str = 'default'):
         """
@@ -401,84 +579,143 @@ class K8sService(object):
         logging.info(_res)
         return {'success': True}
 
-    def set_new_version_by_image_name(self, namespace, new_image):
+    def get_image_index(self, namespace: str = None, refresh: bool = False):
         """
-        根据相同的镜像名称 更新对应deployment的镜像版本号
+        镜像仓库到使用它的容器的索引，按K8S_IMAGE_INDEX_TTL缓存
+        指定namespace时只list该命名空间（只有命名空间权限的kubeconfig也可使用），否则整个集群一次list构建
         :param namespace:
-        :param new_image:
-        :return:
+        :param refresh: 丢弃缓存重新构建
+        :return: {仓库: [(namespace, deployment, 容器类型, 容器名称)]}
         """
-        name, new_version = new_image.split(":")[0], new_image.split(":")[1]
-        logging.info("set_new_version_by_image_name")
         _api = self.get_api_obj()
-        logging.info("set_new_version_by_image_name_get_api_obj")
-        deployments = _api.list_namespaced_deployment(namespace)
-        # logging.info(f"set_new_version_by_image_name_list_namespaced_deployment{len(deployments)}")
-        for i in deployments.items:
-            deployment_name = i.metadata.name
-            logging.info(f"deployment_name:{deployment_name}")
-            names = i.spec.template.spec.containers[0].image.split(":")
-            if len(names) < 2:
-                logging.error(f"wrong format:{deployment_name}:{names}")
-                continue
-            image_name, image_version = names[0], names[1]
-            if image_name != name:
-                continue
-            # Update container image
-            i.spec.template.spec.containers[0].image = new_image
-            # Update the deployment
-            logging.info(f"set_new_version_by_image_name_patch_namespaced_deployment{deployment_name}:{new_image}")
-            api_response = _api.patch_namespaced_deployment(
-                name=deployment_name,
-                namespace=namespace,
-                body=i)
-            logging.info(f"set_new_image:{i}")
-            logging.info("Deployment updated. status='{}'".format(str(api_response.status)))
+        _name = f'image_index:{namespace}' if namespace else 'image_index'
+        refresh and self.client.invalidate(_name)
+        _pages = (lambda: self._iter_pages(_api.list_namespaced_deployment, namespace=namespace)) if namespace \
+            else (lambda: self._iter_pages(_api.list_deployment_for_all_namespaces))
+        return self.client.get_cached(
+            _name, lambda: build_image_index(_ for _page in _pages() for _ in _page), ttl=K8S_IMAGE_INDEX_TTL)
+
+    def find_image_containers(self, repository: str, namespaces: set = None, refresh: bool = False):
+        """
+        查找使用指定镜像仓库的所有容器（含初始化容器）
+        启用informer时从deployment informer的仓库索引实时获取，否则使用缓存的镜像索引：
+        只有一个命名空间时使用该命名空间的索引，否则使用集群索引，没有集群级别的list权限时逐个命名空间构建
+        :param repository: 不含tag的镜像仓库，如host:5000/app
+        :param namespaces: 为空时查找整个集群
+        :param refresh: 不使用缓存的镜像索引
+        :return: [(namespace, deployment, 容器类型, 容器名称)]
+        """
+        _api = self.get_api_obj()
+        _items = self._cached_items('deployments', _api.list_deployment_for_all_namespaces, 'repository', repository)
+        if _items is None:
+            if namespaces is not None and len(namespaces) == 1:
+                return self.get_image_index(next(iter(namespaces)), refresh=refresh).get(repository, [])
+            try:
+                return self.get_image_index(refresh=refresh).get(repository, [])
+            except ApiException as e:
+                if e.status != 403 or namespaces is None:
+                    raise
+            return [_ for _ns in sorted(namespaces)
+                    for _ in self.get_image_index(_ns, refresh=refresh).get(repository, [])]
+        return [(_['metadata'].get('namespace'), _['metadata']['name'], _type, _container)
+                for _ in _items
+                for _repository, _type, _container in iter_image_containers(_)
+                if _repository == repository]
+
+    def set_new_version_by_image_name(self, namespace, new_image, concurrency: int = K8S_ROLLOUT_CONCURRENCY):
+        """
+        根据相同的镜像名称 更新对应deployment的镜像版本号
+        所有容器及初始化容器中使用该镜像仓库的都会更新
+        :param namespace: 命名空间，支持单个、列表，为*时更新整个集群
+        :param new_image:
+        :param concurrency: 并发数
+        :return: 每个deployment的更新结果
+        """
+        _repository, _ = parse_image(new_image)
+        _namespaces = None if namespace in ('*', None) \
+            else {namespace} if isinstance(namespace, str) else set(namespace)
+        _containers = [_ for _ in self.find_image_containers(_repository, _namespaces)
+                       if _namespaces is None or _[0] in _namespaces]
+        if not _containers:
+            # 镜像索引构建后新建的deployment不在索引中，没有匹配时重新构建一次
+            _containers = [_ for _ in self.find_image_containers(_repository, _namespaces, refresh=True)
+                           if _namespaces is None or _[0] in _namespaces]
+        _patch_dict = {}
+        for _ns, _deploy, _type, _container in _containers:
+            _patch_dict.setdefault((_ns, _deploy), {'containers': [], 'initContainers': []})[_type].append(
+                {'name': _container, 'image': new_image})
+        logging.info(f"set_new_version_by_image_name:{new_image} {sorted(_patch_dict)}")
+        return self._patch_deployments(
+            [{'name': _deploy, 'namespace': _ns, 'image': new_image,
+              'body': {'spec': {'template': {'spec': {_k: _v for _k, _v in _containers.items() if _v}}}}}
+             for (_ns, _deploy), _containers in _patch_dict.items()],
+            concurrency=concurrency)
+
+    def track_rollout(self, deployments: list, on_event, deadline: float = ROLLOUT_DEADLINE):
+        """
+        通过watch跟踪deployment的发布进度，进度事件通过on_event回调推送
+        :param deployments: [{'name':, 'namespace':, 'timeout': 单个deployment超时时间（秒）}]
+        :param on_event: 事件回调，在watch线程中调用
+        :param deadline: 整体截止时间（秒）
+        :return: RolloutTracker
+        """
+        return RolloutTracker(self.get_api_obj(), deployments, on_event, deadline=deadline).start()
 
     def list_namespaced_deployment(self, namespace='default'):
         _api = self.get_api_obj()
-        deployments = _api.list_namespaced_deployment(namespace=namespace, pretty=True)
-        logging.info(f"list_namespaced_deployment:{deployments}")
+        _items = self._cached_items('deployments', _api.list_deployment_for_all_namespaces, 'namespace', namespace)
+        deployments = {'items': _items} if _items is not None \
+            else self._request_json(_api.list_namespaced_deployment, namespace=namespace)
+        logging.info(f"list_namespaced_deployment:{namespace} {len(deployments['items'])}")
+        _spec_type = self._deploy_type(_api, 'DeploymentSpec')
         return [
             {
-                "name": i.metadata.name,
-                "namespace": i.metadata.namespace,
-                "image": i.spec.template.spec.containers[0].image,
+                "name": i['metadata']['name'],
+                "namespace": i['metadata'].get('namespace'),
+                "image": i['spec']['template']['spec']['containers'][0]['image'],
                 # 期望的副本数
-                "replicas": i.spec.replicas,
+                "replicas": i['spec'].get('replicas'),
                 # 期望的副本数
-                "desired": i.spec.replicas,
+                "desired": i['spec'].get('replicas'),
                 # 当前的副本数
-                "current": i.status.available_replicas,
+                "current": i['status'].get('availableReplicas'),
                 # 以下注释不返回
                 # "strategy": i.spec.strategy.to_dict(),
-                "template": k8s_object_dict(i.spec),
+                "template": k8s_raw_dict(i['spec'], _spec_type),
                 # "container0": json.dumps(i.spec.template.spec.containers[0].to_dict())
             }
-            for i in deployments.items
+            for i in deployments['items']
         ]
 
     def list_deployment_for_all_namespaces(self):
+        return [_ for _page in self._iter_deployment_for_all_namespaces() for _ in _page]
+
+    def _iter_deployment_for_all_namespaces(self, limit: int = K8S_LIST_PAGE_SIZE):
+        """
+        分页获取一个集群所有命名空间下的deployment，每页转换后返回
+        :param limit:
+        :return: generator
+        """
         _api = self.get_api_obj()
-        deployments = _api.list_deployment_for_all_namespaces(pretty=True)
-        return [
-            {
-                "name": i.metadata.name,
-                "namespace": i.metadata.namespace,
-                "image": i.spec.template.spec.containers[0].image,
-                # 期望的副本数
-                "replicas": i.spec.replicas,
-                # 期望的副本数
-                "desired": i.spec.replicas,
-                # 当前的副本数
-                "current": i.status.available_replicas,
-                # 以下注释不返回
-                # "strategy": i.spec.strategy.to_dict(),
-                # "template": i.spec.template.spec.to_dict(),
-                # "container0": json.dumps(i.spec.template.spec.containers[0].to_dict())
-            }
-            for i in deployments.items
-        ]
+        for _items in self._iter_pages(_api.list_deployment_for_all_namespaces, limit=limit):
+            yield [
+                {
+                    "name": i['metadata']['name'],
+                    "namespace": i['metadata'].get('namespace'),
+                    "image": i['spec']['template']['spec']['containers'][0]['image'],
+                    # 期望的副本数
+                    "replicas": i['spec'].get('replicas'),
+                    # 期望的副本数
+                    "desired": i['spec'].get('replicas'),
+                    # 当前的副本数
+                    "current": i['status'].get('availableReplicas'),
+                    # 以下注释不返回
+                    # "strategy": i.spec.strategy.to_dict(),
+                    # "template": i.spec.template.spec.to_dict(),
+                    # "container0": json.dumps(i.spec.template.spec.containers[0].to_dict())
+                }
+                for i in _items
+            ]
 
     def read_namespaced_deployment(self, name, namespace='default'):
         """
@@ -488,7 +725,13 @@ class K8sService(object):
         :return:
         """
         _api = self.get_api_obj()
-        return k8s_object_dict(_api.read_namespaced_deployment(name=name, namespace=namespace))
+        _items = self._cached_items('deployments', _api.list_deployment_for_all_namespaces, 'name', name)
+        _deploy = next((_ for _ in _items or [] if _['metadata'].get('namespace') == namespace), None)
+        if _deploy is None:
+            # 缓存中不存在（如刚创建）时直接查询
+            self.cache_info = None
+            _deploy = self._request_json(_api.read_namespaced_deployment, name=name, namespace=namespace)
+        return k8s_raw_dict(_deploy, self._deploy_type(_api))
 
     def patch_namespaced_deployment_scale(self, name, namespace, new_replicas):
         """
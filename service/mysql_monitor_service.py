@@ -3,13 +3,30 @@
 # Time: 2020/5/21 15:43
 # File: mysql_monitor_service.py
 
-import pymysql
 import logging
 import datetime
 import decimal
+import re
 
+import pymysql
 from pymysql.constants import ER
 
+from service.mysql_pool import MYSQL_POOLS, is_connection_error
+from service.mysql_status import MYSQL_STATUS_SAMPLER
+
+SQL_STREAM_BATCH = 500  # 流式执行时每批读取的行数
+SQL_STREAM_MAX_ROWS = 100000  # 流式执行默认最多返回的行数
+SQL_STREAM_MAX_BYTES = 64 << 20  # 流式执行默认最多返回的字节数
+SQL_STATEMENT_TIMEOUT = 30  # 流式执行的语句超时时间（秒）
+SQL_RETRY_PATTERN = re.compile(r'\s*(select|show)\b', re.IGNORECASE)  # 连接断开时可以重试的只读语句
+
+
+def parse_value(_value):
+    return _value.strftime('%Y-%m-%d %H:%M:%S') \
+        if isinstance(_value, datetime.datetime) else _value.strftime('%Y-%m-%d') \
+        if isinstance(_value, datetime.date) else float(_value) \
+        if isinstance(_value, decimal.Decimal) else _value
+
 
 class MysqlMonitorService(object):
     """
@@ -18,7 +35,7 @@ class MysqlMonitorService(object):
 
     def __init__(self, host: str, port: int, user_name: str, password: str, db_name: str = None):
         """
-        初始化Mysql链接参数
+        初始化Mysql链接参数，连接从按(host, port, user, db)共享的连接池中借出，创建时不建立连接
         :param host:
         :param port:
         :param user_name:
@@ -32,64 +49,50 @@ class MysqlMonitorService(object):
         }
         if db_name:
             self._conn_info['database'] = db_name
-        self.db_conn = pymysql.connect(**self._conn_info)
-        self.cursor = self.db_conn.cursor()
+        self.concurrency_key = ('db', f'{host}:{port}')
+        self.pool = MYSQL_POOLS.get(self._conn_info)
 
-    def reconnect(self):
+    def get_pool(self, db_name: str = None):
         """
-        重连，依据self._conn_info中参数
+        指定数据库的连接池，连接建立时即选择数据库，不在共享的连接上切换
+        :param db_name:
         :return:
         """
-        self.db_conn = pymysql.connect(**self._conn_info)
-        self.cursor = self.db_conn.cursor()
+        if not db_name or db_name == self._conn_info.get('database'):
+            return self.pool
+        return MYSQL_POOLS.get(dict(self._conn_info, database=db_name))
 
     def get_version(self):
         """
         获取数据库版本信息
         :return:
         """
-        return {'data': self.db_conn.get_server_info()}
-
-    def __change_db(self, db_name: str):
-        """
-        切换数据库
-        :param db_name:
-        :return:
-        """
-        self.db_conn.select_db(db=db_name)
-        self.cursor = self.db_conn.cursor()
+        with self.pool.connection() as _conn:
+            return {'data': _conn.get_server_info()}
 
     def __execute_sql(self, sql_str: str, db_name: str = None):
         """
-        执行指定的sql语句
+        执行指定的sql语句，只读语句执行中连接断开时换一个连接重试一次
+        其他语句可能在连接断开前已经提交（autocommit），不重试
         :param sql_str:
         :param db_name:
         :return:
         """
-
-        def parse_value(_value):
-
-            return _value.strftime('%Y-%m-%d %H:%M:%S') \
-                if isinstance(_value, datetime.datetime) else _value.strftime('%Y-%m-%d') \
-                if isinstance(_value, datetime.date) else float(_value) \
-                if isinstance(_value, decimal.Decimal) else _value
-
-        db_name and self.__change_db(db_name=db_name)
-        try:
-            self.cursor.execute(sql_str)
-        except pymysql.err.ProgrammingError as e:
-            # 重连，若指定db则不会出现连接失效报错
-            logging.error(e)
-            self.reconnect()
-            self.cursor.execute(sql_str)
-        except Exception as e1:
-            logging.error(e1)
-            if e1.args[0] == ER.NO_DB_ERROR:
-                self.reconnect()
-                self.cursor.execute(sql_str)
-        _result_list = self.cursor.fetchall()
-        _field_list = [_des[0] for _des in self.cursor.description] if _result_list else []
-        self.cursor.close()
+        _pool = self.get_pool(db_name)
+        for _retry in (True, False):
+            _conn = None
+            try:
+                with _pool.connection() as _conn, _conn.cursor() as _cursor:
+                    _cursor.execute(sql_str)
+                    _result_list = _cursor.fetchall()
+                    _field_list = [_des[0] for _des in _cursor.description] if _result_list else []
+                break
+            except Exception as e:
+                # 建立连接失败时不重试
+                if not (_retry and _conn is not None and is_connection_error(e)
+                        and SQL_RETRY_PATTERN.match(sql_str)):
+                    raise
+                logging.error(f'connection lost, retry:{e}')
         return {
             'data': [
                 {
@@ -108,6 +111,32 @@ class MysqlMonitorService(object):
         logging.info(_result_list)
         return {'data': _result_list}
 
+    def get_status_rates(self):
+        """
+        由后台采集的global status计算每秒速率：QPS、TPS、各类语句、buffer pool命中率、线程使用率等，
+        current为最近一个采集区间，avg为1m/5m/15m的移动平均
+        :return:
+        """
+        return {'data': MYSQL_STATUS_SAMPLER.rates(self)}
+
+    def get_status_history(self, metrics: list = None, window: float = None):
+        """
+        每个采集区间的速率序列
+        :param metrics: 指标列表，默认全部
+        :param window: 最近多少秒，默认全部
+        :return:
+        """
+        return {'data': MYSQL_STATUS_SAMPLER.history(self, metrics=metrics, seconds=window)}
+
+    def get_long_queries(self, limit: int = 10, min_time: float = 0):
+        """
+        最近一次采集时运行时间最长的语句（不含Sleep）
+        :param limit:
+        :param min_time: 最短运行时间（秒）
+        :return:
+        """
+        return {'data': MYSQL_STATUS_SAMPLER.long_queries(self, limit=int(limit), min_time=float(min_time))}
+
     def execute_sql(self, sql_str: str, db_name: str = None):
         """
         指定数据库执行SQL
@@ -117,3 +146,64 @@ class MysqlMonitorService(object):
         :return:
         """
         return self.__execute_sql(sql_str=sql_str, db_name=db_name)
+
+    @staticmethod
+    def __set_timeout(conn, timeout: float):
+        """
+        设置会话的语句超时：MySQL 5.7.8+为max_execution_time（毫秒，仅对SELECT生效），MariaDB为max_statement_time（秒）
+        :param conn:
+        :param timeout: 秒
+        :return: 设置的变量名，都不支持时为None
+        """
+        for _variable, _value in (('max_execution_time', int(timeout * 1000)), ('max_statement_time', timeout)):
+            try:
+                with conn.cursor() as _cursor:
+                    _cursor.execute(f'SET SESSION {_variable} = %s', (_value,))
+                return _variable
+            except pymysql.err.MySQLError as e:
+                if e.args[0] != ER.UNKNOWN_SYSTEM_VARIABLE:
+                    raise
+        logging.warning('statement timeout is not supported by the server')
+        return None
+
+    def iter_sql(self, sql_str: str, db_name: str = None, batch_size: int = SQL_STREAM_BATCH,
+                 max_rows: int = SQL_STREAM_MAX_ROWS, timeout: float = SQL_STATEMENT_TIMEOUT, columnar: bool = False):
+        """
+        流式执行SQL：SSCursor逐批从服务端读取，不在内存中缓存整个结果集
+        未读完的结果集（超过max_rows或调用方提前停止）会阻塞连接，结束后关闭连接而不归还连接池
+        :param sql_str:
+        :param db_name:
+        :param batch_size: 每批行数
+        :param max_rows: 最多返回的行数
+        :param timeout: 语句超时时间（秒）
+        :param columnar: 为true时每行为按字段顺序的数组，否则为{字段: 值}
+        :return: 生成器，依次返回{'fields': []}、多个{'rows': []}、{'summary': {'rows':, 'truncated':}}
+        """
+        _pool = self.get_pool(db_name)
+        _conn = _pool.acquire()
+        _reusable = False
+        try:
+            _timeout_variable = timeout and self.__set_timeout(_conn, timeout)
+            _cursor = _conn.cursor(pymysql.cursors.SSCursor)
+            _cursor.execute(sql_str)
+            _fields = [_des[0] for _des in _cursor.description or []]
+            yield {'fields': _fields}
+            _count = 0
+            while not max_rows or _count < max_rows:
+                _rows = _cursor.fetchmany(min(batch_size, max_rows - _count) if max_rows else batch_size)
+                if not _rows:
+                    break
+                _count += len(_rows)
+                yield {'rows': [[parse_value(_) for _ in _row] for _row in _rows] if columnar else
+                       [{_field: parse_value(_value) for _field, _value in zip(_fields, _row)} for _row in _rows]}
+            _truncated = 'max_rows' if _fields and max_rows and _count >= max_rows \
+                and _cursor.fetchone() is not None else None
+            if not _truncated:
+                _cursor.close()
+                if _timeout_variable:
+                    with _conn.cursor() as _reset:
+                        _reset.execute(f'SET SESSION {_timeout_variable} = DEFAULT')
+                _reusable = True
+            yield {'summary': {'rows': _count, 'truncated': _truncated}}
+        finally:
+            _pool.release(_conn, discard=not _reusable)
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import pymysql
+from pymysql.constants import CR
+from tornado.ioloop import PeriodicCallback
+
+MYSQL_POOL_SIZE = 8  # 每个(host, port, user, db)的最大连接数
+MYSQL_POOL_IDLE = 300  # 空闲超过该时间（秒）的连接关闭
+MYSQL_POOL_LIFETIME = 3600  # 连接的最长使用时间（秒），到期后归还时关闭
+MYSQL_POOL_TIMEOUT = 10  # 连接数已满时等待空闲连接的时间（秒）
+MYSQL_POOL_PRUNE_INTERVAL = 60  # 清理空闲连接的间隔（秒）
+MYSQL_CONNECT_TIMEOUT = 5  # 建立连接的超时时间（秒）
+MYSQL_READ_TIMEOUT = 60  # 读取结果的超时时间（秒），服务端无响应时借出的连接不会一直阻塞
+MYSQL_WRITE_TIMEOUT = 30  # 发送请求的超时时间（秒）
+# 连接已断开的错误码，执行中遇到时丢弃连接
+MYSQL_CONNECTION_ERRORS = (CR.CR_SERVER_GONE_ERROR, CR.CR_SERVER_LOST, CR.CR_CONN_HOST_ERROR, CR.CR_CONNECTION_ERROR)
+
+
+def is_connection_error(e: Exception):
+    return isinstance(e, pymysql.err.InterfaceError) or \
+        (isinstance(e, pymysql.err.OperationalError) and e.args and e.args[0] in MYSQL_CONNECTION_ERRORS)
+
+
+class MysqlConnectionPool(object):
+    """
+    单个(host, port, user, db)的有界连接池，线程安全
+    借出时ping检查连接，失效的连接丢弃后重新获取；空闲连接后进先出，长时间空闲的连接由定时清理关闭
+    连接为autocommit，归还后不会残留未结束的事务（及其一致性读快照）
+    """
+
+    def __init__(self, conn_info: dict, size: int = MYSQL_POOL_SIZE, idle: float = MYSQL_POOL_IDLE,
+                 timeout: float = MYSQL_POOL_TIMEOUT):
+        self.conn_info = conn_info
+        self.size = size
+        self.idle = idle
+        self.timeout = timeout
+        self.closed = False
+        # 空闲连接：(连接, 归还时间)
+        self._idle = deque()
+        # 已建立（含借出中）的连接数及各连接的建立时间
+        self._open = 0
+        self._created = {}
+        self._cond = threading.Condition()
+
+    @property
+    def name(self):
+        return f"{self.conn_info['user']}@{self.conn_info['host']}:{self.conn_info['port']}/" \
+               f"{self.conn_info.get('database') or ''}"
+
+    def _connect(self):
+        return pymysql.connect(**dict(self.conn_info, autocommit=True, connect_timeout=MYSQL_CONNECT_TIMEOUT,
+                                      read_timeout=MYSQL_READ_TIMEOUT, write_timeout=MYSQL_WRITE_TIMEOUT))
+
+    def acquire(self):
+        """
+        借出一个连接，优先使用最近归还的空闲连接，连接数已满时等待
+        :return:
+        """
+        _deadline = time.time() + self.timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._open >= self.size:
+                    _remaining = _deadline - time.time()
+                    if _remaining <= 0:
+                        raise TimeoutError(f'no idle connection in pool {self.name} after {self.timeout}s')
+                    self._cond.wait(_remaining)
+                if self._idle:
+                    _conn = self._idle.pop()[0]
+                else:
+                    # 先占用名额，在锁外建立连接
+                    _conn = None
+                    self._open += 1
+            if _conn is None:
+                try:
+                    _conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._open -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._created[id(_conn)] = time.time()
+                return _conn
+            try:
+                _conn.ping(reconnect=False)
+                return _conn
+            except Exception as e:
+                logging.warning(f'discard broken connection of pool {self.name}:{e}')
+                self._discard(_conn)
+
+    def release(self, conn, discard: bool = False):
+        """
+        归还连接，出错、已断开、超过最长使用时间或连接池已关闭时直接关闭
+        :param conn:
+        :param discard:
+        :return:
+        """
+        _now = time.time()
+        with self._cond:
+            if not (discard or self.closed or not conn.open
+                    or _now - self._created.get(id(conn), _now) > MYSQL_POOL_LIFETIME):
+                self._idle.append((conn, _now))
+                self._cond.notify()
+                return
+        self._discard(conn)
+
+    def _discard(self, conn):
+        with self._cond:
+            self._created.pop(id(conn), None)
+            self._open -= 1
+            self._cond.notify()
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        """
+        with pool.connection() as conn: 借出连接，结束时归还，连接错误时丢弃
+        :return:
+        """
+        _conn = self.acquire()
+        try:
+            yield _conn
+        except Exception as e:
+            self.release(_conn, discard=is_connection_error(e))
+            raise
+        self.release(_conn)
+
+    def prune(self, now: float = None):
+        """
+        关闭空闲超时的连接
+        :param now:
+        :return: 关闭的连接数
+        """
+        _now = now or time.time()
+        with self._cond:
+            _expired = [_conn for _conn, _returned in self._idle if _now - _returned > self.idle]
+            self._idle = deque([_ for _ in self._idle if _now - _[1] <= self.idle])
+        [self._discard(_conn) for _conn in _expired]
+        return len(_expired)
+
+    def close(self):
+        """
+        关闭空闲连接，借出中的连接归还时关闭
+        :return:
+        """
+        with self._cond:
+            self.closed = True
+            _idle, self._idle = [_conn for _conn, _ in self._idle], deque()
+        [self._discard(_conn) for _conn in _idle]
+
+    def stats(self):
+        with self._cond:
+            return {'size': self.size, 'open': self._open, 'idle': len(self._idle)}
+
+
+class MysqlPoolRegistry(object):
+    """
+    按(host, port, user, db)缓存连接池，同一数据库的所有MysqlMonitorService共用
+    """
+
+    def __init__(self, size: int = MYSQL_POOL_SIZE, idle: float = MYSQL_POOL_IDLE, timeout: float = MYSQL_POOL_TIMEOUT):
+        self.size = size
+        self.idle = idle
+        self.timeout = timeout
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._callback = None
+
+    def configure(self, size: int = None, idle: float = None, timeout: float = None):
+        self.size = size or self.size
+        self.idle = idle or self.idle
+        self.timeout = timeout or self.timeout
+
+    def start(self):
+        """
+        在IOLoop中定时清理空闲连接
+        :return:
+        """
+        if self._callback is None:
+            self._callback = PeriodicCallback(self.prune, MYSQL_POOL_PRUNE_INTERVAL * 1000)
+            self._callback.start()
+        return self
+
+    def get(self, conn_info: dict) -> MysqlConnectionPool:
+        """
+        获取连接池，同一key密码变更时重建
+        :param conn_info: pymysql.connect的参数
+        :return:
+        """
+        _key = (conn_info['host'], int(conn_info['port']), conn_info['user'], conn_info.get('database'))
+        with self._lock:
+            _pool = self._pools.get(_key)
+            if _pool is not None and _pool.conn_info != conn_info:
+                _pool.close()
+                _pool = None
+            if _pool is None:
+                _pool = self._pools[_key] = MysqlConnectionPool(
+                    dict(conn_info), size=self.size, idle=self.idle, timeout=self.timeout)
+            return _pool
+
+    def prune(self):
+        with self._lock:
+            _pools = list(self._pools.values())
+        _closed = sum([_pool.prune() for _pool in _pools])
+        _closed and logging.info(f'closed {_closed} idle mysql connections')
+
+    def stats(self):
+        with self._lock:
+            return {_pool.name: _pool.stats() for _pool in self._pools.values()}
+
+
+MYSQL_POOLS = MysqlPoolRegistry()
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import threading
+import time
+import warnings
+
+import numpy as np
+from tornado.ioloop import PeriodicCallback
+
+from service.executor import BLOCKING_EXECUTOR
+from service.usage_history import to_json_array
+
+MYSQL_STATUS_INTERVAL = 10  # 后台采集global status的间隔（秒）
+MYSQL_STATUS_JITTER = 0.1
+MYSQL_STATUS_SLOTS = 360  # 保留的采样数，默认间隔下为1小时
+MYSQL_STATUS_IDLE = 600  # 超过该时间（秒）没有被查询的数据库停止采集
+MYSQL_STATUS_WINDOWS = (('1m', 60), ('5m', 300), ('15m', 900))  # 移动平均的时间窗口
+MYSQL_PROCESSLIST_LIMIT = 50  # 每次采集保留的运行中的语句数
+MYSQL_PROCESSLIST_INFO = 1024  # 语句文本保留的最大长度
+
+# 采集的global status变量，Uptime用于判断实例重启（计数器归零）
+MYSQL_STATUS_VARIABLES = (
+    'Uptime', 'Questions', 'Com_select', 'Com_insert', 'Com_update', 'Com_delete', 'Com_commit', 'Com_rollback',
+    'Innodb_buffer_pool_read_requests', 'Innodb_buffer_pool_reads', 'Threads_connected', 'Threads_running',
+    'Threads_created', 'Connections', 'Aborted_connects', 'Slow_queries', 'Bytes_received', 'Bytes_sent',
+    'Created_tmp_disk_tables', 'Innodb_row_lock_waits', 'max_connections'
+)
+# 每秒速率：{指标: 累加的计数器}
+MYSQL_RATE_METRICS = {
+    'qps': ('Questions',),
+    'tps': ('Com_commit', 'Com_rollback'),
+    'select': ('Com_select',),
+    'insert': ('Com_insert',),
+    'update': ('Com_update',),
+    'delete': ('Com_delete',),
+    'slow_queries': ('Slow_queries',),
+    'connections': ('Connections',),
+    'aborted_connects': ('Aborted_connects',),
+    'threads_created': ('Threads_created',),
+    'bytes_received': ('Bytes_received',),
+    'bytes_sent': ('Bytes_sent',),
+    'tmp_disk_tables': ('Created_tmp_disk_tables',),
+    'row_lock_waits': ('Innodb_row_lock_waits',)
+}
+MYSQL_GAUGE_METRICS = ('threads_connected', 'threads_running', 'thread_usage')
+MYSQL_STATUS_METRICS = tuple(MYSQL_RATE_METRICS) + ('buffer_pool_hit_rate',) + MYSQL_GAUGE_METRICS
+MYSQL_PROCESSLIST_SQL = f"""
+select id, user, host, db, command, time, state, left(info, {MYSQL_PROCESSLIST_INFO}) as info
+from information_schema.processlist
+where command not in ('Sleep', 'Daemon', 'Binlog Dump', 'Binlog Dump GTID') and id != connection_id()
+order by time desc limit {MYSQL_PROCESSLIST_LIMIT};
+"""
+
+
+class MysqlStatusHistory(object):
+    """
+    global status计数器的环形缓冲：times[采样]，values[采样, 变量]，变量按MYSQL_STATUS_VARIABLES顺序
+    """
+
+    def __init__(self, slots: int = MYSQL_STATUS_SLOTS):
+        self.times = np.zeros(slots, dtype=np.float64)
+        self.values = np.full((slots, len(MYSQL_STATUS_VARIABLES)), np.nan, dtype=np.float64)
+        self.count = 0
+
+    def append(self, timestamp: float, status: dict):
+        _i = self.count % len(self.times)
+        self.times[_i] = timestamp
+        self.values[_i] = [status.get(_, np.nan) for _ in MYSQL_STATUS_VARIABLES]
+        self.count += 1
+
+    def ordered(self):
+        """
+        按时间顺序返回所有采样
+        :return: (times, values)
+        """
+        _slots = len(self.times)
+        if self.count <= _slots:
+            return self.times[:self.count], self.values[:self.count]
+        _order = np.roll(np.arange(_slots), -(self.count % _slots))
+        return self.times[_order], self.values[_order]
+
+    def column(self, values, name: str):
+        return values[..., MYSQL_STATUS_VARIABLES.index(name)]
+
+    def derive(self):
+        """
+        计算相邻两次采样之间的各指标，所有区间一次完成
+        实例重启（Uptime变小）所在的区间计为无效
+        :return: (区间结束时间, 区间秒数, 计数器差值{指标: []}, 是否有效, 采样值)
+        """
+        _times, _values = self.ordered()
+        _dt = np.diff(_times)
+        _delta = np.diff(_values, axis=0)
+        _valid = (_dt > 0) & (_delta[:, MYSQL_STATUS_VARIABLES.index('Uptime')] >= 0)
+        _counters = {_metric: sum([self.column(_delta, _) for _ in _variables])
+                     for _metric, _variables in MYSQL_RATE_METRICS.items()}
+        _counters['buffer_pool_reads'] = self.column(_delta, 'Innodb_buffer_pool_reads')
+        _counters['buffer_pool_read_requests'] = self.column(_delta, 'Innodb_buffer_pool_read_requests')
+        return _times[1:], _dt, _counters, _valid, _values
+
+    @staticmethod
+    def _hit_rate(reads, requests):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(requests > 0, 1 - reads / requests, np.nan)
+
+    def series(self):
+        """
+        每个区间的速率及采样时的状态值
+        :return: (时间, {指标: 数组})
+        """
+        _times, _dt, _counters, _valid, _values = self.derive()
+        _dt = np.where(_valid, _dt, np.nan)
+        _series = {_metric: _counters[_metric] / _dt for _metric in MYSQL_RATE_METRICS}
+        _series['buffer_pool_hit_rate'] = np.where(_valid, self._hit_rate(
+            _counters['buffer_pool_reads'], _counters['buffer_pool_read_requests']), np.nan)
+        _series.update(self.gauges(_values[1:]))
+        return _times, _series
+
+    def gauges(self, values):
+        _connected = self.column(values, 'Threads_connected')
+        _max = self.column(values, 'max_connections')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            _usage = np.where(_max > 0, _connected / _max, np.nan)
+        return {
+            'threads_connected': _connected,
+            'threads_running': self.column(values, 'Threads_running'),
+            'thread_usage': _usage
+        }
+
+    def window_average(self, seconds: float):
+        """
+        时间窗口内的平均值：计数器为窗口内差值之和 / 有效时间之和，状态值为窗口内的均值
+        :param seconds:
+        :return: {指标: 值}
+        """
+        _times, _dt, _counters, _valid, _values = self.derive()
+        _selected = _valid & (_times >= _times[-1] - seconds) if len(_times) else _valid
+        _seconds = _dt[_selected].sum()
+        _result = {_metric: _counters[_metric][_selected].sum() / _seconds if _seconds else np.nan
+                   for _metric in MYSQL_RATE_METRICS}
+        _result['buffer_pool_hit_rate'] = self._hit_rate(
+            _counters['buffer_pool_reads'][_selected].sum(), _counters['buffer_pool_read_requests'][_selected].sum())
+        _samples = _values[1:][_times >= _times[-1] - seconds] if len(_times) else _values[:0]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            _result.update({_metric: np.nanmean(_value) if len(_value) else np.nan
+                            for _metric, _value in self.gauges(_samples).items()})
+        return _result
+
+
+def _json_metrics(metrics: dict):
+    return {_k: (None if np.isnan(_v) else round(float(_v), 6)) for _k, _v in metrics.items()}
+
+
+class MysqlStatusSampler(object):
+    """
+    Mysql状态后台采集：按固定间隔（带抖动）采集global status及information_schema.processlist，
+    计数器保存在环形缓冲中，查询时计算每秒速率、移动平均及当前运行时间最长的语句
+    数据库在首次查询时注册，长时间无人查询时自动移除
+    """
+
+    def __init__(self, interval: int = MYSQL_STATUS_INTERVAL, enabled: bool = True):
+        self.interval = interval
+        self.enabled = enabled
+        self.targets = {}
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self._callback = None
+
+    def configure(self, interval: int = None, enabled: bool = None):
+        self.interval = interval or self.interval
+        self.enabled = self.enabled if enabled is None else enabled
+
+    def start(self):
+        """
+        在IOLoop中启动定时采集，需在IOLoop启动前调用
+        :return:
+        """
+        if self.enabled and self._callback is None:
+            self._callback = PeriodicCallback(self._tick, self.interval * 1000, jitter=MYSQL_STATUS_JITTER)
+            self._callback.start()
+        return self
+
+    def stop(self):
+        self._callback and self._callback.stop()
+        self._callback = None
+
+    @staticmethod
+    def get_key(service):
+        return service.pool.conn_info['host'], int(service.pool.conn_info['port']), service.pool.conn_info['user']
+
+    def register(self, service):
+        """
+        注册需要采集的数据库，尚未采集过时在当前线程（执行层）中采集一次
+        :param service: MysqlMonitorService
+        :return: 采集目标
+        """
+        _key = self.get_key(service)
+        with self._lock:
+            _target = self.targets.get(_key)
+            if _target is None:
+                _target = self.targets[_key] = {'service': service, 'history': MysqlStatusHistory(),
+                                                'processlist': [], 'sampled_at': None, 'error': None,
+                                                'lock': threading.Lock()}
+            _target['requested_at'] = time.time()
+        if _target['sampled_at'] is None or not self.enabled:
+            self.sample(_target)
+        return _target
+
+    def _tick(self):
+        _now = time.time()
+        for _key, _target in list(self.targets.items()):
+            if _now - _target['requested_at'] > MYSQL_STATUS_IDLE:
+                logging.info(f'stop sampling status of idle mysql {_key[0]}:{_key[1]}')
+                self.targets.pop(_key, None)
+                continue
+            if _key not in self._tasks:
+                self._tasks[_key] = asyncio.ensure_future(BLOCKING_EXECUTOR.run(
+                    _target['service'].concurrency_key, self.sample, _target))
+                self._tasks[_key].add_done_callback(lambda _, _k=_key: self._tasks.pop(_k, None))
+
+    def sample(self, target: dict):
+        """
+        采集一次global status、max_connections及运行中的语句
+        :param target:
+        :return:
+        """
+        _service = target['service']
+        _start = time.time()
+        try:
+            _status = {_['Variable_name']: _['Value'] for _ in _service.execute_sql('show global status;')['data']}
+            _status.update({_['Variable_name']: _['Value'] for _ in _service.execute_sql(
+                "show global variables like 'max_connections';")['data']})
+            _processlist = _service.execute_sql(MYSQL_PROCESSLIST_SQL)['data']
+        except Exception as e:
+            logging.error(f'sample mysql status failed:{e}')
+            target['error'] = str(e)
+            return
+        _values = {}
+        for _name in MYSQL_STATUS_VARIABLES:
+            try:
+                _values[_name] = float(_status[_name])
+            except (KeyError, TypeError, ValueError):
+                continue
+        with target['lock']:
+            target['history'].append(_start, _values)
+            target['processlist'] = _processlist
+            target['sampled_at'], target['error'] = _start, None
+
+    def rates(self, service):
+        """
+        最近一个区间的每秒速率及各时间窗口的移动平均
+        :param service:
+        :return: {'current': {指标: 值}, 'avg': {'1m': {}, '5m': {}, '15m': {}}, 'sampled_at':, 'samples':, 'error':}
+        """
+        _target = self.register(service)
+        with _target['lock']:
+            _history = _target['history']
+            _times, _series = _history.series()
+            _current = {_metric: _values[-1] for _metric, _values in _series.items()} if len(_times) else \
+                dict.fromkeys(MYSQL_STATUS_METRICS, np.nan)
+            if not len(_times) and _history.count:
+                # 只有一次采样时，状态值仍可返回
+                _current.update({_k: _v[-1] for _k, _v in _history.gauges(_history.ordered()[1]).items()})
+            _average = {_name: _json_metrics(_history.window_average(_seconds)) if len(_times) else None
+                        for _name, _seconds in MYSQL_STATUS_WINDOWS}
+            return {
+                'current': _json_metrics(_current),
+                'avg': _average,
+                'sampled_at': _target['sampled_at'],
+                'interval': self.interval,
+                'samples': min(_history.count, len(_history.times)),
+                'error': _target['error']
+            }
+
+    def history(self, service, metrics: list = None, seconds: float = None):
+        """
+        每个采样区间的速率序列
+        :param service:
+        :param metrics: 默认全部指标
+        :param seconds: 最近多少秒，默认全部
+        :return: {'times': [], 'series': {指标: []}}
+        """
+        _unknown = [_ for _ in metrics or [] if _ not in MYSQL_STATUS_METRICS]
+        if _unknown:
+            raise ValueError(f'unknown metrics {_unknown}, must be in {MYSQL_STATUS_METRICS}')
+        _target = self.register(service)
+        with _target['lock']:
+            _times, _series = _target['history'].series()
+        _selected = _times >= _times[-1] - seconds if seconds and len(_times) else np.ones(len(_times), dtype=bool)
+        return {
+            'times': np.round(_times[_selected], 3).tolist(),
+            'series': {_metric: to_json_array(_series[_metric][_selected]).tolist()
+                       for _metric in metrics or MYSQL_STATUS_METRICS}
+        }
+
+    def long_queries(self, service, limit: int = 10, min_time: float = 0):
+        """
+        最近一次采集中运行时间最长的语句
+        :param service:
+        :param limit:
+        :param min_time: 最短运行时间（秒）
+        :return: {'queries': [], 'sampled_at':}
+        """
+        _target = self.register(service)
+        _processlist = _target['processlist']
+        return {
+            'queries': [_ for _ in _processlist if (_.get('time') or 0) >= min_time][:limit],
+            'sampled_at': _target['sampled_at'],
+            'error': _target['error']
+        }
+
+
+MYSQL_STATUS_SAMPLER = MysqlStatusSampler()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+NODE_AGGREGATE_METRICS = ('cpu', 'memory', 'disk')
+NODE_AGGREGATE_PERCENTILES = (50, 90, 99)
+NODE_GROUP_LABELS = ('topology.kubernetes.io/zone', 'node.kubernetes.io/instance-type')  # 默认的节点分组标签
+NODE_OUTLIER_FENCE = 1.5  # Tukey fence系数，超过Q3 + k * IQR的节点视为异常
+
+
+def _round(value):
+    return None if value is None or np.isnan(value) else round(float(value), 6)
+
+
+def _ratio(used, total):
+    return np.divide(used, total, out=np.zeros_like(used, dtype=np.float64), where=total > 0)
+
+
+def aggregate_node_usage(nodes: list, labels: dict = None, group_by=NODE_GROUP_LABELS):
+    """
+    汇总节点使用信息：集群合计、按节点标签分组合计、cpu/内存/磁盘使用率的百分位数及异常节点
+    :param nodes: /statistics格式的节点使用信息
+    :param labels: {node_ip: 节点标签}，来自list_node
+    :param group_by: 分组使用的标签
+    :return:
+    """
+    _nodes = [_ for _ in nodes if not _.get('error') and 'cpu' in _]
+    _ips = [_['node_ip'] for _ in _nodes]
+    # Summary API采集的节点cpu.percentage为核数，使用归一化的cpu.ratio
+    _usage = np.array([[_['cpu'].get('ratio', _['cpu']['percentage']), _['memory']['percentage'],
+                        _['disk']['percentage']] for _ in _nodes], dtype=np.float64).reshape(-1, len(NODE_AGGREGATE_METRICS))
+    # [内存总量, 内存已用, 磁盘总量, 磁盘已用]
+    _capacity = np.array([[_['memory']['total'], _['memory']['used'], _['disk']['total'], _['disk']['used']]
+                          for _ in _nodes], dtype=np.float64).reshape(-1, 4)
+    _sum = _capacity.sum(axis=0)
+    _result = {
+        'totals': {
+            'nodes': len(nodes),
+            'sampled': len(_nodes),
+            'errors': len(nodes) - len(_nodes),
+            'pods': sum([len(_.get('pods') or []) for _ in nodes]),
+            'cpu': {'percentage': _round(_usage[:, 0].mean()) if len(_nodes) else None},
+            'memory': {'total': int(_sum[0]), 'used': int(_sum[1]), 'percentage': _round(_ratio(_sum[1], _sum[0]))},
+            'disk': {'total': int(_sum[2]), 'used': int(_sum[3]), 'percentage': _round(_ratio(_sum[3], _sum[2]))}
+        },
+        'percentiles': {},
+        'groups': {},
+        'outliers': []
+    }
+    if not len(_nodes):
+        return _result
+
+    _percentiles = np.percentile(_usage, NODE_AGGREGATE_PERCENTILES, axis=0)
+    _result['percentiles'] = {
+        _metric: {f'p{_p}': _round(_percentiles[_i, _j]) for _i, _p in enumerate(NODE_AGGREGATE_PERCENTILES)}
+        for _j, _metric in enumerate(NODE_AGGREGATE_METRICS)
+    }
+
+    for _label in group_by or []:
+        _values = [((labels or {}).get(_ip) or {}).get(_label, '') for _ip in _ips]
+        _groups, _inverse = np.unique(np.array(_values, dtype=object).astype(str), return_inverse=True)
+        _count = np.bincount(_inverse, minlength=len(_groups))
+        _cpu = np.bincount(_inverse, weights=_usage[:, 0], minlength=len(_groups)) / _count
+        _sums = np.stack([np.bincount(_inverse, weights=_capacity[:, _i], minlength=len(_groups))
+                          for _i in range(4)], axis=1)
+        _memory, _disk = _ratio(_sums[:, 1], _sums[:, 0]), _ratio(_sums[:, 3], _sums[:, 2])
+        _result['groups'][_label] = {
+            _group: {
+                'nodes': int(_count[_i]),
+                'cpu': {'percentage': _round(_cpu[_i])},
+                'memory': {'total': int(_sums[_i, 0]), 'used': int(_sums[_i, 1]), 'percentage': _round(_memory[_i])},
+                'disk': {'total': int(_sums[_i, 2]), 'used': int(_sums[_i, 3]), 'percentage': _round(_disk[_i])}
+            }
+            for _i, _group in enumerate(_groups.tolist())
+        }
+
+    # Tukey fence：使用率高于Q3 + 1.5 * IQR的节点
+    _q1, _q3 = np.percentile(_usage, [25, 75], axis=0)
+    _fence = _q3 + NODE_OUTLIER_FENCE * (_q3 - _q1)
+    _row, _column = np.nonzero(_usage > _fence)
+    _result['outliers'] = sorted([
+        {'node_ip': _ips[_r], 'metric': NODE_AGGREGATE_METRICS[_c], 'value': _round(_usage[_r, _c]),
+         'fence': _round(_fence[_c])}
+        for _r, _c in zip(_row.tolist(), _column.tolist())
+    ], key=lambda _: (_['metric'], -_['value']))
+    return _result
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import time
+
+from tornado.ioloop import PeriodicCallback
+
+from service.executor import BLOCKING_EXECUTOR
+from service.node_service import NodeService
+from service.usage_history import USAGE_HISTORY
+
+NODE_SAMPLE_INTERVAL = 30  # 后台采集节点使用信息的间隔（秒）
+NODE_SAMPLE_JITTER = 0.1  # 采集间隔的随机抖动比例，避免多个实例同时采集
+NODE_SAMPLE_IDLE = 600  # 集群超过该时间（秒）没有被查询时停止采集
+
+
+class NodeUsageSampler(object):
+    """
+    后台节点使用信息采集：按固定间隔（带抖动）采集已注册集群的所有节点，内存中保存每个节点的最新快照
+    集群在首次查询/statistics时注册，长时间无人查询时自动移除
+    """
+
+    def __init__(self, interval: int = NODE_SAMPLE_INTERVAL, enabled: bool = True):
+        self.interval = interval
+        self.enabled = enabled
+        self.targets = {}
+        self.snapshots = {}
+        self._tasks = {}
+        self._callback = None
+
+    def configure(self, interval: int = None, enabled: bool = None):
+        self.interval = interval or self.interval
+        self.enabled = self.enabled if enabled is None else enabled
+
+    def start(self):
+        """
+        在IOLoop中启动定时采集，需在IOLoop启动前调用
+        :return:
+        """
+        if self.enabled and self._callback is None:
+            self._callback = PeriodicCallback(self._tick, self.interval * 1000, jitter=NODE_SAMPLE_JITTER)
+            self._callback.start()
+        return self
+
+    def stop(self):
+        self._callback and self._callback.stop()
+        self._callback = None
+
+    def register(self, config, monitor_list: list = None, monitor_port: int = 8000):
+        """
+        注册需要采集的集群，有monitor_list时通过节点监控服务采集，否则通过kubelet Summary API采集
+        :param config: kubeconfig
+        :param monitor_list:
+        :param monitor_port:
+        :return: 集群标识
+        """
+        _key = NodeService(config).client.key
+        _target = self.targets.get(_key)
+        if _target is None:
+            _target = self.targets[_key] = {'monitor_list': monitor_list, 'monitor_port': monitor_port}
+        # 只保存kubeconfig，每次采集时从K8sClientRegistry获取client，已被淘汰（关闭）的client会重建
+        _target.update(config=config, requested_at=time.time())
+        return _key
+
+    def _tick(self):
+        _now = time.time()
+        for _key, _target in list(self.targets.items()):
+            if _now - _target['requested_at'] > NODE_SAMPLE_IDLE:
+                logging.info(f'stop sampling idle cluster {_key[:8]}')
+                self.targets.pop(_key, None)
+                self.snapshots.pop(_key, None)
+                continue
+            self.refresh(_key)
+
+    def refresh(self, key: str):
+        """
+        采集一次集群的节点，同一集群同时只有一次采集在进行，并发的刷新请求共用同一次采集
+        :param key:
+        :return: 可await的采集任务
+        """
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.ensure_future(self._sample(key))
+            self._tasks[key].add_done_callback(lambda _: self._tasks.pop(key, None))
+        return self._tasks[key]
+
+    async def _sample(self, key: str):
+        _target = self.targets.get(key)
+        if _target is None:
+            return
+        _start = time.time()
+        try:
+            _service = NodeService(_target['config'])
+            if _target['monitor_list']:
+                _data = await BLOCKING_EXECUTOR.run(
+                    _service.concurrency_key, _service.get_node_hard_usage,
+                    monitor_list=_target['monitor_list'], monitor_port=_target['monitor_port'])
+            else:
+                _data = await BLOCKING_EXECUTOR.run(_service.concurrency_key, _service.get_node_info)
+        except Exception as e:
+            logging.error(f'sample nodes of cluster {key[:8]} failed:{e}')
+            _snapshot = self.snapshots.setdefault(key, {'nodes': {}, 'sampled_at': None})
+            _snapshot['error'] = str(e)
+            return
+        self._update(key, _data, _start)
+        try:
+            # 写入历史（含分段文件）在执行层中进行
+            await BLOCKING_EXECUTOR.run(('usage', key), USAGE_HISTORY.record_nodes, key, _data, _start)
+        except Exception as e:
+            logging.error(f'record usage history of cluster {key[:8]} failed:{e}')
+
+    def _update(self, key: str, data: list, sampled_at: float):
+        """
+        更新集群快照，采集失败的节点保留上一次成功的数据并标记错误
+        :param key:
+        :param data: 节点使用信息列表
+        :param sampled_at:
+        :return:
+        """
+        _old = self.snapshots.get(key, {}).get('nodes', {})
+        _nodes = {}
+        for _node in data:
+            _previous = _old.get(_node['node_ip'])
+            if _node.get('error') and _previous and 'cpu' in _previous:
+                _nodes[_node['node_ip']] = dict(_previous, error=_node['error'], latency=_node.get('latency'))
+            else:
+                _nodes[_node['node_ip']] = dict(_node, sampled_at=sampled_at)
+        self.snapshots[key] = {'nodes': _nodes, 'sampled_at': sampled_at, 'error': None}
+
+    async def get(self, config, monitor_list: list = None, monitor_port: int = 8000, max_age: float = None):
+        """
+        从快照获取集群所有节点的使用信息，没有快照或快照超过max_age时先采集一次
+        :param config: kubeconfig
+        :param monitor_list:
+        :param monitor_port:
+        :param max_age: 快照的最大可接受时间（秒），为空时只要有快照即返回
+        :return: {'data': 节点列表, 'sampled_at':, 'age':, 'error':}
+        """
+        _key = self.register(config, monitor_list=monitor_list, monitor_port=monitor_port)
+        _snapshot = self.snapshots.get(_key)
+        if _snapshot is None or _snapshot['sampled_at'] is None \
+                or (max_age is not None and time.time() - _snapshot['sampled_at'] > max_age):
+            await self.refresh(_key)
+            _snapshot = self.snapshots.get(_key) or {'nodes': {}, 'sampled_at': None, 'error': None}
+        _now = time.time()
+        return {
+            'data': [_snapshot['nodes'][_] for _ in sorted(_snapshot['nodes'])],
+            'sampled_at': _snapshot['sampled_at'],
+            'age': round(_now - _snapshot['sampled_at'], 3) if _snapshot['sampled_at'] else None,
+            'error': _snapshot.get('error')
+        }
+
+
+NODE_SAMPLER = NodeUsageSampler()
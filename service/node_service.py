@@ -1,137 +1,684 @@
 # -*- coding: utf-8 -*-
 
+import hmac
+import json
 import logging
+import re
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 import requests
-from utils import get_client, get_timestamp
+from requests.adapters import HTTPAdapter
+from utils import get_client, get_timestamp, k8s_quantity
+from service.informer import INFORMER_MANAGER
+from service.usage_history import USAGE_HISTORY
+
+NODE_SCRAPE_TIMEOUT = 5  # 单个节点的请求超时时间（秒）
+NODE_SCRAPE_DEADLINE = 8  # 一次采集所有节点的总截止时间（秒）
+NODE_SCRAPE_CONCURRENCY = 32  # 并发采集的节点数，同时也是连接池大小
+NODE_BREAKER_BACKOFF = 5  # 节点失败后的初始熔断时间（秒），连续失败时翻倍
+NODE_BREAKER_MAX_BACKOFF = 300  # 最大熔断时间（秒）
+NODE_POD_SORT_KEYS = ('cpu', 'memory')  # 节点下pod可按使用量排序的指标
+NODE_SUMMARY_CONCURRENCY = 16  # 通过api-server代理并发读取kubelet Summary API的节点数
+NODE_SUMMARY_TIMEOUT = 10  # 单个节点Summary API的超时时间（秒）
+NODE_DEVICE_TTL = 3600  # 节点文件系统设备名的缓存时间（秒）
+# kubelet cAdvisor指标中根cgroup各文件系统的容量，用于将Summary API的文件系统对应到设备名
+NODE_DEVICE_METRIC = 'container_fs_limit_bytes{'
+NODE_DEVICE_PATTERN = re.compile(r'device="([^"]+)"')
+NODE_LABEL_CACHE_TTL = 60  # 节点标签的缓存时间（秒）
+NODE_PUSH_INTERVAL = 15  # 节点监控服务未上报推送间隔时的默认值（秒）
+NODE_PUSH_HEARTBEAT_MISSES = 3  # 超过该次数的推送间隔没有收到推送时标记为stale
+NODE_PUSH_FORGET = 3600  # 超过该时间（秒）没有推送的节点恢复为拉取
+NODE_PUSH_TOKEN_HEADER = 'X-Node-Push-Token'  # 推送请求携带共享token的请求头
+
+# 节点监控服务（scripts/HardInfoMonitor.py）的紧凑二进制格式，结构说明见该脚本
+AGENT_BINARY_CONTENT_TYPE = 'application/x-hardinfo'
+AGENT_ACCEPT = f'{AGENT_BINARY_CONTENT_TYPE}, application/json;q=0.5'
+AGENT_BINARY_MAGIC = b'HI'
+AGENT_BINARY_HEADER = struct.Struct('<2sBBIdHf3f')
+AGENT_BINARY_MEMORY = struct.Struct('<4Qf3Qf')
+AGENT_BINARY_COUNT = struct.Struct('<H')
+AGENT_BINARY_DISK = struct.Struct('<3QfB')
+
+
+def iter_lines(response, chunk_size: int = 65536):
+    """
+    逐行读取urllib3响应（_preload_content=False），不要求chunked编码
+    :param response:
+    :param chunk_size:
+    :return: generator
+    """
+    _rest = b''
+    for _chunk in response.stream(chunk_size):
+        _lines = (_rest + _chunk).split(b'\n')
+        _rest = _lines.pop()
+        for _line in _lines:
+            yield _line.decode('utf-8', 'ignore')
+    if _rest:
+        yield _rest.decode('utf-8', 'ignore')
+
+
+def unpack_hard_info(data: bytes):
+    """
+    解码节点监控服务的二进制响应，结构与json响应一致（不含cpu detail）
+    :param data:
+    :return:
+    """
+    _magic, _version, _, _seq, _timestamp, _cpu_count, _cpu_usage, *_loadavg = \
+        AGENT_BINARY_HEADER.unpack_from(data, 0)
+    if _magic != AGENT_BINARY_MAGIC:
+        raise ValueError('invalid hard info payload')
+    _offset = AGENT_BINARY_HEADER.size
+    _memory = AGENT_BINARY_MEMORY.unpack_from(data, _offset)
+    _offset += AGENT_BINARY_MEMORY.size
+    _disk_count, = AGENT_BINARY_COUNT.unpack_from(data, _offset)
+    _offset += AGENT_BINARY_COUNT.size
+    _disk = {}
+    for _ in range(_disk_count):
+        _length, = AGENT_BINARY_COUNT.unpack_from(data, _offset)
+        _offset += AGENT_BINARY_COUNT.size
+        _mountpoint = data[_offset:_offset + _length].decode('utf-8')
+        _offset += _length
+        _total, _used, _free, _percent, _stale = AGENT_BINARY_DISK.unpack_from(data, _offset)
+        _offset += AGENT_BINARY_DISK.size
+        _disk[_mountpoint] = {'total': _total, 'used': _used, 'free': _free, 'percent': round(_percent, 6)}
+        _stale and _disk[_mountpoint].update(stale=True)
+    return {
+        'CPU': {'total': _cpu_count, 'usage': round(_cpu_usage, 6), 'loadavg': [round(_, 6) for _ in _loadavg]},
+        'MEMORY': {
+            'total': _memory[0], 'used': _memory[1], 'free': _memory[2], 'available': _memory[3],
+            'percent': round(_memory[4], 6), 'swap_total': _memory[5], 'swap_used': _memory[6],
+            'swap_free': _memory[7], 'swap_percent': round(_memory[8], 6)
+        },
+        'DISK': _disk,
+        'TIMESTAMP': _timestamp,
+        'SEQ': _seq
+    }
+
+
+class HostCircuitBreaker(object):
+    """
+    按主机的熔断器：主机请求失败后在退避时间内直接跳过，到期后放行一次探测请求，
+    探测成功则恢复，失败则退避时间翻倍
+    """
+
+    def __init__(self, backoff: float = NODE_BREAKER_BACKOFF, max_backoff: float = NODE_BREAKER_MAX_BACKOFF):
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def allow(self, host: str):
+        """
+        是否允许请求该主机，熔断到期后只放行一个探测请求
+        :param host:
+        :return:
+        """
+        with self._lock:
+            _state = self._hosts.get(host)
+            if _state is None:
+                return True
+            if _state['probing'] or time.time() < _state['retry_at']:
+                return False
+            _state['probing'] = True
+            return True
+
+    def success(self, host: str):
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def failure(self, host: str, error: str = None):
+        with self._lock:
+            _state = self._hosts.get(host)
+            _backoff = min(_state['backoff'] * 2, self.max_backoff) if _state else self.backoff
+            self._hosts[host] = {
+                'failures': (_state['failures'] if _state else 0) + 1,
+                'backoff': _backoff,
+                'retry_at': time.time() + _backoff,
+                'probing': False,
+                'error': error
+            }
+
+    def state(self, host: str):
+        with self._lock:
+            _state = self._hosts.get(host)
+            return dict(_state) if _state else None
+
+
+def _build_session(pool_size: int = NODE_SCRAPE_CONCURRENCY):
+    """
+    节点采集共用的keep-alive连接池，按主机复用连接
+    :param pool_size:
+    :return:
+    """
+    _session = requests.Session()
+    _adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    _session.mount('http://', _adapter)
+    _session.mount('https://', _adapter)
+    return _session
+
+
+class CpuSampleCache(object):
+    """
+    节点cpu累计使用时间的上一次采样，用于计算两次采样间的cpu使用核数
+    """
+
+    def __init__(self):
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def rate(self, key, timestamp: float, usage_core_nano_seconds):
+        """
+        记录本次采样并返回与上一次采样之间的平均使用核数，没有可用的上一次采样时返回None
+        :param key: (集群标识, 节点名称)
+        :param timestamp: 采样时间（秒）
+        :param usage_core_nano_seconds: 累计使用的cpu纳秒数
+        :return:
+        """
+        if usage_core_nano_seconds is None:
+            return None
+        with self._lock:
+            _previous = self._samples.get(key)
+            if _previous is None or timestamp > _previous[0]:
+                self._samples[key] = (timestamp, usage_core_nano_seconds)
+        if _previous is None or timestamp <= _previous[0] or usage_core_nano_seconds < _previous[1]:
+            # 首次采样、kubelet尚未更新统计或kubelet重启后计数归零
+            return None
+        return (usage_core_nano_seconds - _previous[1]) / ((timestamp - _previous[0]) * 1e9)
+
+
+class NodePushRegistry(object):
+    """
+    节点监控服务的推送模式：节点批量推送采样，保存每个节点的最新采样，采集时直接使用而不再拉取
+    推送心跳（推送间隔 * 3）过期的节点标记为stale，采集时返回错误；长时间没有推送的节点恢复为拉取
+    节点被集群采集后绑定到该集群，之后推送的每个采样都写入该集群的使用历史
+    推送需携带配置的共享token，未配置token时不接收推送
+    """
+
+    def __init__(self, heartbeat: float = None, token: str = None):
+        # 固定的心跳超时（秒），为空时按节点上报的推送间隔计算
+        self.heartbeat = heartbeat
+        self.token = token
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def configure(self, heartbeat: float = None, token: str = None):
+        self.heartbeat = heartbeat or self.heartbeat
+        self.token = token or self.token
+
+    def authorize(self, token: str):
+        """
+        校验推送请求携带的token
+        :param token:
+        :return:
+        """
+        return bool(self.token and token) and hmac.compare_digest(self.token.encode('utf-8'), token.encode('utf-8'))
+
+    def ingest(self, host: str, samples: list, interval: float = None, sent_at: float = None):
+        """
+        接收一批采样，整批解析成功后才写入；按节点时间去重，重发的采样忽略
+        :param host: 节点ip，与monitor_list及节点InternalIP一致
+        :param samples: 节点监控服务的采样列表
+        :param interval: 节点的推送间隔（秒）
+        :param sent_at: 节点发送时的时间，用于修正节点与服务端的时钟偏差
+        :return: 写入的采样数
+        """
+        _now = time.time()
+        _skew = _now - float(sent_at) if sent_at else 0
+        _parsed = sorted([(float(_['TIMESTAMP']), NodeService.parse_hard_usage(host, _)) for _ in samples],
+                         key=lambda _: _[0])
+        with self._lock:
+            _state = self.hosts.get(host) or {'clusters': set(), 'last_timestamp': 0, 'stale': False}
+            _parsed = [_ for _ in _parsed if _[0] > _state['last_timestamp']]
+            if _state['stale']:
+                logging.info(f'node {host} resumed pushing')
+            _state.update(received_at=_now, interval=float(interval or NODE_PUSH_INTERVAL), stale=False)
+            if _parsed:
+                _state.update(usage=_parsed[-1][1], sampled_at=_parsed[-1][0] + _skew,
+                              last_timestamp=_parsed[-1][0])
+            self.hosts[host] = _state
+            _clusters = list(_state['clusters'])
+        for _cluster in _clusters:
+            [USAGE_HISTORY.record_nodes(_cluster, [_usage], _timestamp + _skew) for _timestamp, _usage in _parsed]
+        return len(_parsed)
+
+    def get(self, host: str, cluster: str = None):
+        """
+        节点最新的推送结果，并将节点绑定到集群
+        :param host:
+        :param cluster: 集群标识
+        :return: 节点使用信息，心跳过期时包含error；节点没有推送或长时间没有推送时返回None，由调用方拉取
+        """
+        _now = time.time()
+        with self._lock:
+            _state = self.hosts.get(host)
+            if _state is None:
+                return None
+            if _now - _state['received_at'] > NODE_PUSH_FORGET:
+                logging.warning(f'node {host} stopped pushing, fall back to pull')
+                self.hosts.pop(host, None)
+                return None
+            cluster and _state['clusters'].add(cluster)
+            _age = round(_now - _state['received_at'], 1)
+            if _age > (self.heartbeat or _state['interval'] * NODE_PUSH_HEARTBEAT_MISSES):
+                if not _state['stale']:
+                    logging.warning(f'push heartbeat of node {host} expired, last push {_age}s ago')
+                    _state['stale'] = True
+                return {"node_ip": host, "pods": [], "latency": 0, "source": "push", "stale": True,
+                        "error": f"push heartbeat expired, last push {_age}s ago"}
+            if 'usage' not in _state:
+                return {"node_ip": host, "pods": [], "latency": 0, "source": "push", "error": "no samples pushed"}
+            return dict(_state['usage'], latency=0, error=None, source='push', pushed_at=_state['received_at'],
+                        node_sampled_at=_state['sampled_at'])
+
+
+NODE_SESSION = _build_session()
+NODE_BREAKER = HostCircuitBreaker()
+NODE_CPU_SAMPLES = CpuSampleCache()
+NODE_PUSH = NodePushRegistry()
+# 节点监控服务上次的响应：{(ip, port): (ETag, 数据)}
+NODE_AGENT_CACHE = {}
+# 节点文件系统容量对应的设备名：{(集群, 节点名称): (获取时间, {容量: 设备名})}
+NODE_DEVICES = {}
 
 
 class NodeService(object):
     def __init__(self, kubeconfig):
         self.client = get_client(kubeconfig=kubeconfig)
         self.api = self.client.CoreV1Api()
+        self.concurrency_key = ('k8s', self.client.key)
+
+    def _request_json(self, _func, *args, **kwargs):
+        _response = _func(*args, _preload_content=False, **kwargs)
+        try:
+            return json.loads(_response.data)
+        finally:
+            _response.release_conn()
+
+    def list_nodes(self):
+        """
+        所有节点的原始json，开启informer时从本地缓存读取
+        :return:
+        """
+        _informer = INFORMER_MANAGER.get_informer(self.client, 'nodes', self.api.list_node)
+        return _informer.list() if _informer else self._request_json(self.api.list_node)['items']
+
+    @staticmethod
+    def node_address(node: dict):
+        return [_['address'] for _ in node['status'].get('addresses') or [] if _['type'] == 'InternalIP'][0]
+
+    def get_node_addresses(self):
+        """
+        节点名称与InternalIP的对应关系
+        :return: {节点名称: InternalIP}
+        """
+        return {_node['metadata']['name']: self.node_address(_node) for _node in self.list_nodes()}
+
+    def get_node_labels(self):
+        """
+        节点标签，用于汇总时分组，按集群缓存
+        :return: {InternalIP: 节点标签}
+        """
+        return self.client.get_cached(
+            'node_labels', lambda: {self.node_address(_node): _node['metadata'].get('labels') or {}
+                                    for _node in self.list_nodes()}, ttl=NODE_LABEL_CACHE_TTL)
+
+    def get_pod_metrics(self):
+        """
+        从metrics.k8s.io获取所有pod的使用量，一次集群级别的查询
+        metrics-server不可用时返回空，pod的使用量为None
+        :return: {(namespace, name): {'cpu': 核数, 'memory': 字节数}}
+        """
+        try:
+            _metrics = self._request_json(
+                self.client.CustomObjectsApi().list_cluster_custom_object, 'metrics.k8s.io', 'v1beta1', 'pods')
+        except Exception as e:
+            logging.error(f'get pod metrics failed:{e}')
+            return {}
+        return {
+            (_['metadata']['namespace'], _['metadata']['name']): {
+                'cpu': sum([k8s_quantity(_c['usage']['cpu']) for _c in _['containers']]),
+                'memory': sum([k8s_quantity(_c['usage']['memory']) for _c in _['containers']])
+            }
+            for _ in _metrics.get('items') or []
+        }
+
+    @staticmethod
+    def _pod_resources(pod: dict, resource: str, kind: str):
+        _values = [k8s_quantity(((_c.get('resources') or {}).get(kind) or {}).get(resource))
+                   for _c in pod['spec'].get('containers') or []]
+        _values = [_ for _ in _values if _ is not None]
+        return sum(_values) if _values else None
+
+    def get_pods_by_node(self, sort_by: str = 'cpu'):
+        """
+        获取每个节点上运行的pod及其使用量
+        一次集群级别的pod查询（开启informer时读本地缓存）加一次metrics查询，按节点名称建立哈希索引后关联
+        :param sort_by: cpu、memory，节点下的pod按使用量从大到小排序
+        :return: {节点名称: [pod]}
+        """
+        _informer = INFORMER_MANAGER.get_informer(self.client, 'pods', self.api.list_pod_for_all_namespaces)
+        _pods = _informer.list() if _informer else self._request_json(
+            self.api.list_pod_for_all_namespaces, field_selector='status.phase!=Succeeded,status.phase!=Failed')['items']
+        _metrics = self.get_pod_metrics()
+        _pods_by_node = {}
+        for _pod in _pods:
+            _node = _pod['spec'].get('nodeName')
+            if not _node or (_pod.get('status') or {}).get('phase') in ('Succeeded', 'Failed'):
+                continue
+            _key = (_pod['metadata']['namespace'], _pod['metadata']['name'])
+            _usage = _metrics.get(_key) or {}
+            _pods_by_node.setdefault(_node, []).append({
+                'name': _key[1],
+                'namespace': _key[0],
+                'phase': (_pod.get('status') or {}).get('phase'),
+                'cpu': {
+                    'usage': _usage.get('cpu'),
+                    'request': self._pod_resources(_pod, 'cpu', 'requests'),
+                    'limit': self._pod_resources(_pod, 'cpu', 'limits')
+                },
+                'memory': {
+                    'usage': _usage.get('memory'),
+                    'request': self._pod_resources(_pod, 'memory', 'requests'),
+                    'limit': self._pod_resources(_pod, 'memory', 'limits')
+                }
+            })
+        return {_node: sort_pods(_list, sort_by) for _node, _list in _pods_by_node.items()}
+
+    @staticmethod
+    def parse_hard_usage(node_ip: str, data: dict):
+        """
+        将节点监控服务返回的数据转换为统一的节点使用信息
+        :param node_ip:
+        :param data: 节点8000端口服务返回的json
+        :return:
+        """
+        _disk = data['DISK']
+        _disk_total = sum([_disk[x]['total'] for x in _disk.keys()])
+        _disk_used = sum([_disk[x]['used'] for x in _disk.keys()])
+        return {
+            "node_ip": node_ip,
+            "cpu": {
+                "percentage": data['CPU']['usage']
+            },
+            "memory": {
+                "total": data['MEMORY']['total'],
+                "used": data['MEMORY']['used'],
+                "percentage": data['MEMORY']['percent']
+            },
+            "disk": {
+                "name": '+'.join(_disk.keys()),
+                "total": _disk_total,
+                "used": _disk_used,
+                "percentage": _disk_used / _disk_total,
+                "disk_list": [dict({'name': x, 'percentage': _disk[x]['percent']}, **_disk[x]) for x in _disk]
+            },
+            "pods": []
+        }
+
+    def scrape_node(self, node_ip: str, monitor_port: int = 8000, deadline: float = None):
+        """
+        采集单个节点，推送模式的节点使用最新的推送结果，熔断中的节点直接跳过
+        :param node_ip:
+        :param monitor_port:
+        :param deadline: 总截止时间点（time.time()），请求超时不超过剩余时间
+        :return: 节点使用信息，失败时包含error
+        """
+        _pushed = NODE_PUSH.get(node_ip, cluster=self.client.key)
+        if _pushed is not None:
+            return _pushed
+        _start = time.time()
+        if deadline is not None and _start >= deadline:
+            # 排队到截止时间后才开始的请求不再发出，也不计入熔断
+            return {"node_ip": node_ip, "pods": [], "latency": 0, "error": "deadline exceeded"}
+        if not NODE_BREAKER.allow(node_ip):
+            _state = NODE_BREAKER.state(node_ip) or {}
+            return {"node_ip": node_ip, "pods": [], "latency": 0,
+                    "error": f"circuit open, retry in {max(round(_state.get('retry_at', _start) - _start, 1), 0)}s: "
+                             f"{_state.get('error')}"}
+        _timeout = NODE_SCRAPE_TIMEOUT if deadline is None else max(min(NODE_SCRAPE_TIMEOUT, deadline - _start), 0.1)
+        try:
+            _node_usage = self.parse_hard_usage(node_ip, self.fetch_hard_info(node_ip, monitor_port, _timeout))
+        except Exception as e:
+            # ADD alter
+            logging.error(f'scrape node {node_ip} failed:{e}')
+            NODE_BREAKER.failure(node_ip, error=str(e))
+            return {"node_ip": node_ip, "pods": [], "latency": round(time.time() - _start, 3), "error": str(e)}
+        NODE_BREAKER.success(node_ip)
+        _node_usage.update(latency=round(time.time() - _start, 3), error=None)
+        return _node_usage
+
+    @staticmethod
+    def fetch_hard_info(node_ip: str, monitor_port: int = 8000, timeout: float = NODE_SCRAPE_TIMEOUT):
+        """
+        请求节点监控服务，优先协商紧凑二进制格式，旧版本服务返回json
+        带上次响应的ETag，节点没有新采样时返回304，直接使用上次的结果
+        :param node_ip:
+        :param monitor_port:
+        :param timeout:
+        :return: 节点监控服务的原始数据
+        """
+        _key = (node_ip, monitor_port)
+        _cached = NODE_AGENT_CACHE.get(_key)
+        _headers = {'Accept': AGENT_ACCEPT}
+        _cached and _headers.update({'If-None-Match': _cached[0]})
+        _response = NODE_SESSION.get(f'http://{node_ip}:{monitor_port}/', timeout=timeout, headers=_headers)
+        if _response.status_code == 304 and _cached:
+            return _cached[1]
+        _response.raise_for_status()
+        if _response.headers.get('Content-Type', '').startswith(AGENT_BINARY_CONTENT_TYPE):
+            _data = unpack_hard_info(_response.content)
+        else:
+            _data = _response.json()
+        if _response.headers.get('ETag'):
+            NODE_AGENT_CACHE[_key] = (_response.headers['ETag'], _data)
+        return _data
 
-    def get_node_hard_usage(self, monitor_list: list = None, monitor_port: int = 8000):
+    def get_node_hard_usage(self, monitor_list: list = None, monitor_port: int = 8000,
+                            deadline: float = NODE_SCRAPE_DEADLINE, sort_by: str = 'cpu'):
         """
         获取所有节点硬件资源使用信息
-        monitor会和list_node合并拿到所有节点
+        monitor会和list_node合并拿到所有节点，所有节点并发采集，超过总截止时间的节点返回错误
+        节点上的pod及使用量与节点采集同时查询
         :param monitor_list: Mysql、NFS节点
         :param monitor_port: 默认所有节点都在宿主机的8000端口启动服务
-        :return:
+        :param deadline: 总截止时间（秒）
+        :param sort_by: 节点下pod的排序指标，cpu、memory
+        :return: 节点使用信息列表，采集失败的节点包含error，每个节点包含latency
         """
-        _node_list = self.api.list_node()
-        _node_list = [[_.address for _ in x.status.addresses if _.type == 'InternalIP'][0] for x in _node_list.items]
-        _node_list = list(set(_node_list + monitor_list))
+        _addresses = self.get_node_addresses()
+        _node_list = sorted(set(list(_addresses.values()) + (monitor_list or [])))
+        if not _node_list:
+            return []
+        _deadline = time.time() + deadline
+        _executor = ThreadPoolExecutor(max_workers=min(NODE_SCRAPE_CONCURRENCY, len(_node_list)) + 1,
+                                       thread_name_prefix='node-scrape')
+        try:
+            _pods_future = _executor.submit(self.get_pods_by_node, sort_by)
+            _futures = [_executor.submit(self.scrape_node, _, monitor_port, _deadline) for _ in _node_list]
+            wait(_futures + [_pods_future], timeout=max(_deadline - time.time(), 0))
+        finally:
+            # 取消尚未开始的请求，不等待超时的请求，其超时时间不超过剩余时间
+            [_.cancel() for _ in _futures + [_pods_future] if not _.done()]
+            _executor.shutdown(wait=False)
+        _pods = {}
+        if _pods_future.cancelled() or not _pods_future.done():
+            logging.error('get pods by node deadline exceeded')
+        elif not _pods_future.exception():
+            _pods = {_addresses[_node]: _list for _node, _list in _pods_future.result().items() if _node in _addresses}
+        else:
+            logging.error(f'get pods by node failed:{_pods_future.exception()}')
         _usage_list = []
-        for _ in _node_list:
-            try:
-                _url = f'http://{_}:{monitor_port}/'
-                _response = requests.request(method='GET', url=_url, timeout=5)
-                _data = _response.json()
-                _node_usage = {
-                    "node_ip": _,
-                    "cpu": {
-                        "percentage": _data['CPU']['usage']
-                    },
-                    "memory": {
-                        "total": _data['MEMORY']['total'],
-                        "used": _data['MEMORY']['used'],
-                        "percentage": _data['MEMORY']['percent']
-                    },
-                    "disk": {
-                        "name": '+'.join(_data['DISK'].keys()),
-                        "total": sum([_data['DISK'][x]['total'] for x in _data['DISK'].keys()]),
-                        "used": sum([_data['DISK'][x]['used'] for x in _data['DISK'].keys()]),
-                        "percentage": sum([_data['DISK'][x]['used'] for x in _data['DISK'].keys()]) / sum(
-                            [_data['DISK'][x]['total'] for x in _data['DISK'].keys()]),
-                        "disk_list": [dict({'name': x, 'percentage': _data['DISK'][x]['percent']}, **_data['DISK'][x])
-                                      for x in _data['DISK']]
-                    },
-                    "pods": []
-                }
-                _usage_list.append(_node_usage)
-            except Exception as e:
-                # ADD alter
-                logging.error(e)
-                continue
+        for _node_ip, _future in zip(_node_list, _futures):
+            if _future.done() and not _future.cancelled():
+                _usage_list.append(dict(_future.result(), pods=_pods.get(_node_ip, [])))
+            else:
+                _usage_list.append({"node_ip": _node_ip, "pods": _pods.get(_node_ip, []), "latency": deadline,
+                                    "error": "deadline exceeded"})
         return _usage_list
 
-    def get_node_info(self):
+    def get_node_devices(self, name: str):
         """
-        通过cAdvisor API获取节点监控信息
+        节点文件系统的设备名，从kubelet cAdvisor指标中根cgroup的container_fs_limit_bytes读取，按NODE_DEVICE_TTL缓存
+        指标按名称分组输出，读完该指标后即停止读取
+        :param name: 节点名称
+        :return: {容量: 设备名}，获取失败时为空
         """
-        node_list = []
-        ret = self.api.list_node()
-
-        for node in ret.items:
-            address = node.status.addresses
-            node_ip = [item for item in address if item.type == 'InternalIP'][0].address
-            # Get machine infos
-            machine_url = "http://%s:4194/api/v1.2/containers/" % node_ip
+        _key = (self.client.key, name)
+        _cached = NODE_DEVICES.get(_key)
+        if _cached and time.time() - _cached[0] < NODE_DEVICE_TTL:
+            return _cached[1]
+        _devices = {}
+        try:
+            _response = self.api.connect_get_node_proxy_with_path(
+                name, 'metrics/cadvisor', _preload_content=False, _request_timeout=NODE_SUMMARY_TIMEOUT)
             try:
-                response = requests.get(machine_url, timeout=10)
-                if response.status_code != 200:
-                    raise Exception
-                node_info = response.json()
-            except Exception as e:
-                logging.error("fetch url:{} failed {}".format(machine_url, str(e)))
-                node_info = None
+                _found = False
+                for _line in iter_lines(_response):
+                    if not _line.startswith(NODE_DEVICE_METRIC):
+                        if _found:
+                            break
+                        continue
+                    _found = True
+                    _labels, _, _value = _line.rpartition('} ')
+                    _device = NODE_DEVICE_PATTERN.search(_labels)
+                    if 'id="/"' in _labels and _device and _device.group(1).startswith('/'):
+                        _devices[int(float(_value.split()[0]))] = _device.group(1)
+            finally:
+                _response.close()
+                _response.release_conn()
+        except Exception as e:
+            logging.warning(f'get filesystem devices of node {name} failed:{e}')
+        NODE_DEVICES[_key] = (time.time(), _devices)
+        return _devices
+
+    def get_node_summary(self, node: dict):
+        """
+        通过api-server代理读取kubelet Summary API，转换为与节点使用信息相同的结构
+        cpu.percentage与原cAdvisor接口一致为使用的核数，由本次与上一次采样的usageCoreNanoSeconds差值计算，
+        没有上一次采样时使用kubelet计算的usageNanoCores；cpu.ratio为按节点cpu容量归一化的使用率
+        磁盘名称与原接口一致为设备名，无法获取设备名时为文件系统类型，disk_list[].fs为nodefs、imagefs
+        :param node: 节点原始json
+        :return:
+        """
+        _name = node['metadata']['name']
+        _summary = self._request_json(self.api.connect_get_node_proxy_with_path, _name, 'stats/summary',
+                                      _request_timeout=NODE_SUMMARY_TIMEOUT)['node']
+        _capacity = node['status'].get('capacity') or {}
+        _cpu = _summary['cpu']
+        _cores = NODE_CPU_SAMPLES.rate((self.client.key, _name), get_timestamp(_cpu['time']),
+                                       _cpu.get('usageCoreNanoSeconds'))
+        if _cores is None:
+            _cores = (_cpu.get('usageNanoCores') or 0) / 1e9
+        _cpu_capacity = k8s_quantity(_capacity.get('cpu')) or 1
+
+        _memory_total = int(k8s_quantity(_capacity.get('memory')) or _summary['memory'].get('availableBytes', 0) +
+                            _summary['memory'].get('workingSetBytes', 0))
+        _memory_usage = _summary['memory'].get('workingSetBytes') or 0
 
-            if not node_info:
+        # nodefs为kubelet根目录所在文件系统，imagefs为容器运行时镜像所在文件系统，两者可能是同一个
+        _disk_list = []
+        _devices = self.get_node_devices(_name)
+        _filesystems = [('nodefs', _summary.get('fs')), ('imagefs', (_summary.get('runtime') or {}).get('imageFs'))]
+        for _fs_name, _fs in _filesystems:
+            if not _fs or not _fs.get('capacityBytes'):
                 continue
+            if any([(_['total'], _['used']) == (_fs['capacityBytes'], _fs.get('usedBytes')) for _ in _disk_list]):
+                continue
+            _disk_list.append({
+                "name": _devices.get(_fs['capacityBytes'], _fs_name),
+                "fs": _fs_name,
+                "total": _fs['capacityBytes'],
+                "used": _fs.get('usedBytes') or 0,
+                "percentage": round(float(_fs.get('usedBytes') or 0) / _fs['capacityBytes'], 6)
+            })
+        _disk_total = sum([_['total'] for _ in _disk_list])
+        _disk_used = sum([_['used'] for _ in _disk_list])
+        return {
+            "node_ip": self.node_address(node),
+            "cpu": {
+                "percentage": round(_cores, 6),
+                "ratio": round(_cores / _cpu_capacity, 6)
+            },
+            "memory": {
+                "total": _memory_total,
+                "used": _memory_usage,
+                "percentage": round(float(_memory_usage) / _memory_total, 6) if _memory_total else 0
+            },
+            "disk": {
+                "name": '+'.join([_['name'] for _ in _disk_list]),
+                "total": _disk_total,
+                "used": _disk_used,
+                "percentage": round(float(_disk_used) / _disk_total, 6) if _disk_total else 0,
+                "disk_list": _disk_list
+            },
+            "pods": []
+        }
 
-            node_memory_total = node_info["spec"]["memory"]["limit"]
-
-            node_state = node_info["stats"][1]
-            node_memory_usage = node_state["memory"]["working_set"]
-            node_memory_percentage = round(float(node_memory_usage) / node_memory_total, 6)
-
-            node_time_diff = get_timestamp(node_info["stats"][1]["timestamp"]) - get_timestamp(node_info["stats"][0]["timestamp"])
-            # Gets the length of the interval in nanoseconds
-            node_time_diff = node_time_diff * 1000000000
-            node_cpu_percentage = round(float(
-                node_info["stats"][1]["cpu"]["usage"]["total"] - node_info["stats"][0]["cpu"]["usage"]["total"]) / node_time_diff,
-                                6)
-
-            node_disk_list = []
-            node_device_usage = 0
-            node_device_capacity = 0
-            node_device = []
-            for i in node_state["filesystem"]:
-                if not i["device"].startswith("/"):
-                    continue
-                node_device_usage += i["usage"]
-                node_device_capacity += i["capacity"]
-                node_device.append(i["device"])
-                node_disk_list.append({
-                    "name": i["device"],
-                    "total": i["capacity"],
-                    "used": i["usage"],
-                    "percentage": round(float(i["usage"]) / i["capacity"], 6)
-                })
-            node_device = "+".join(node_device)
-            node_disk_percentage = round(float(node_device_usage) / node_device_capacity, 6)
-
-            node_data = {
-                "node_ip": node_ip,
-                "cpu": {
-                    "percentage": node_cpu_percentage
-                },
-                "memory": {
-                    "total": node_memory_total,
-                    "used":  node_memory_usage,
-                    "percentage": node_memory_percentage
-                },
-                "disk": {
-                    "name": node_device,
-                    "total": node_device_capacity,
-                    "used": node_device_usage,
-                    "percentage": node_disk_percentage,
-                    "disk_list": node_disk_list
-                },
-                "pods": []
-            }
-            logging.info("ip:{} cpu:{} memory:{} disk:{}".format(node_ip, node_cpu_percentage, node_memory_percentage, node_disk_percentage))
+    def get_node_info(self, sort_by: str = 'cpu', deadline: float = NODE_SCRAPE_DEADLINE):
+        """
+        通过api-server代理并发读取各节点kubelet的Summary API获取节点监控信息
+        :param sort_by: 节点下pod的排序指标，cpu、memory
+        :param deadline: 总截止时间（秒）
+        :return: 节点使用信息列表，采集失败的节点包含error，每个节点包含latency
+        """
+        _nodes = self.list_nodes()
+        if not _nodes:
+            return []
+        _deadline = time.time() + deadline
 
-            node_list.append(node_data)
+        def summary(_node):
+            _start = time.time()
+            if _start >= _deadline:
+                return {"node_ip": self.node_address(_node), "pods": [], "latency": 0, "error": "deadline exceeded"}
+            try:
+                _result = self.get_node_summary(_node)
+                _result.update(error=None)
+            except Exception as e:
+                logging.error(f"get summary of node {_node['metadata']['name']} failed:{e}")
+                _result = {"node_ip": self.node_address(_node), "pods": [], "error": str(e)}
+            _result['latency'] = round(time.time() - _start, 3)
+            return _result
 
+        _executor = ThreadPoolExecutor(max_workers=min(NODE_SUMMARY_CONCURRENCY, len(_nodes)) + 1,
+                                       thread_name_prefix='node-summary')
+        try:
+            _pods_future = _executor.submit(self.get_pods_by_node, sort_by)
+            _futures = [_executor.submit(summary, _) for _ in _nodes]
+            wait(_futures + [_pods_future], timeout=max(_deadline - time.time(), 0))
+        finally:
+            # 取消尚未开始的请求
+            [_.cancel() for _ in _futures + [_pods_future] if not _.done()]
+            _executor.shutdown(wait=False)
+        _pods = {}
+        if _pods_future.cancelled() or not _pods_future.done():
+            logging.error('get pods by node deadline exceeded')
+        elif not _pods_future.exception():
+            _pods = _pods_future.result()
+        else:
+            logging.error(f'get pods by node failed:{_pods_future.exception()}')
+        node_list = []
+        for _node, _future in zip(_nodes, _futures):
+            _node_pods = _pods.get(_node['metadata']['name'], [])
+            if _future.done() and not _future.cancelled():
+                node_list.append(dict(_future.result(), pods=_node_pods))
+            else:
+                node_list.append({"node_ip": self.node_address(_node), "pods": _node_pods, "latency": deadline,
+                                  "error": "deadline exceeded"})
+            logging.info("ip:{} cpu:{} memory:{} disk:{}".format(
+                node_list[-1]['node_ip'], node_list[-1].get('cpu'), node_list[-1].get('memory', {}).get('percentage'),
+                node_list[-1].get('disk', {}).get('percentage')))
         return node_list
+
+
+def sort_pods(pods: list, sort_by: str = 'cpu'):
+    """
+    按使用量从大到小排序，没有使用量的pod排在最后
+    :param pods:
+    :param sort_by: cpu、memory
+    :return:
+    """
+    if sort_by not in NODE_POD_SORT_KEYS:
+        raise ValueError(f'sort_by must be one of {NODE_POD_SORT_KEYS}')
+    return sorted(pods, key=lambda _: (_[sort_by]['usage'] is None, -(_[sort_by]['usage'] or 0)))
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from tornado.ioloop import PeriodicCallback
+
+from service.executor import BLOCKING_EXECUTOR
+from service.mysql_monitor_service import MysqlMonitorService
+
+REPLICATION_INTERVAL = 15  # 后台检查主从同步的间隔（秒）
+REPLICATION_JITTER = 0.1
+REPLICATION_DEADLINE = 5  # 一次检查所有节点的总截止时间（秒）
+REPLICATION_HISTORY = 240  # 每个节点保留的检查记录数，默认间隔下为1小时
+REPLICATION_TREND_WINDOW = 600  # 计算延迟趋势的时间窗口（秒）
+REPLICATION_TREND_THRESHOLD = 0.05  # 延迟变化率（秒/秒）超过该值时视为上升或下降
+
+
+def parse_gtid_set(gtid_set: str):
+    """
+    解析GTID集合，如"uuid:1-100:105,uuid2:1-5"
+    :param gtid_set:
+    :return: {uuid: [(开始, 结束)]}
+    """
+    _result = {}
+    for _item in (gtid_set or '').replace('\n', '').split(','):
+        _parts = _item.strip().split(':')
+        if len(_parts) < 2:
+            continue
+        _intervals = _result.setdefault(_parts[0].lower(), [])
+        for _interval in _parts[1:]:
+            _start, _, _end = _interval.partition('-')
+            _intervals.append((int(_start), int(_end or _start)))
+    return _result
+
+
+def gtid_pending(retrieved: str, executed: str):
+    """
+    已接收（relay log中）但尚未执行的事务数
+    :param retrieved: Retrieved_Gtid_Set
+    :param executed: Executed_Gtid_Set
+    :return:
+    """
+    _executed = parse_gtid_set(executed)
+    _pending = 0
+    for _uuid, _intervals in parse_gtid_set(retrieved).items():
+        for _start, _end in _intervals:
+            _overlap = sum([max(min(_end, _e) - max(_start, _s) + 1, 0) for _s, _e in _executed.get(_uuid, [])])
+            _pending += _end - _start + 1 - _overlap
+    return _pending
+
+
+def lag_trend(history, now: float, window: float = REPLICATION_TREND_WINDOW):
+    """
+    时间窗口内的延迟统计及变化趋势，变化率为最小二乘拟合的斜率
+    :param history: [(检查时间, 延迟秒数, 是否正常)]
+    :param now:
+    :param window:
+    :return:
+    """
+    _points = [(_t, _lag) for _t, _lag, _ in history if now - _t <= window and _lag is not None]
+    if not _points:
+        return {'min': None, 'max': None, 'avg': None, 'slope': None, 'trend': None, 'samples': 0}
+    _lags = [_lag for _, _lag in _points]
+    _t_mean = sum([_t for _t, _ in _points]) / len(_points)
+    _lag_mean = sum(_lags) / len(_lags)
+    _variance = sum([(_t - _t_mean) ** 2 for _t, _ in _points])
+    _slope = sum([(_t - _t_mean) * (_lag - _lag_mean) for _t, _lag in _points]) / _variance if _variance else 0.0
+    return {
+        'min': min(_lags),
+        'max': max(_lags),
+        'avg': round(_lag_mean, 3),
+        'slope': round(_slope, 4),
+        'trend': 'rising' if _slope > REPLICATION_TREND_THRESHOLD else
+        'falling' if _slope < -REPLICATION_TREND_THRESHOLD else 'stable',
+        'samples': len(_points)
+    }
+
+
+def check_node(host: str, port: int, user_name: str, password: str):
+    """
+    检查单个节点的主从同步状态，多源复制时每个channel一条记录
+    没有slave status的节点为主库
+    :param host:
+    :param port:
+    :param user_name:
+    :param password:
+    :return:
+    """
+    _start = time.time()
+    _rows = MysqlMonitorService(host=host, port=port, user_name=user_name, password=password,
+                                db_name='mysql').execute_sql('show slave status;')['data']
+    _channels = [{
+        'channel': _.get('Channel_Name') or '',
+        'master': f"{_.get('Master_Host')}:{_.get('Master_Port')}",
+        'io_running': _.get('Slave_IO_Running'),
+        'sql_running': _.get('Slave_SQL_Running'),
+        'last_errno': _.get('Last_Errno'),
+        'last_io_errno': _.get('Last_IO_Errno'),
+        'last_sql_errno': _.get('Last_SQL_Errno'),
+        'last_error': _.get('Last_Error') or _.get('Last_IO_Error') or _.get('Last_SQL_Error') or None,
+        'seconds_behind_master': _.get('Seconds_Behind_Master'),
+        'master_log_file': _.get('Master_Log_File'),
+        'read_master_log_pos': _.get('Read_Master_Log_Pos'),
+        'exec_master_log_pos': _.get('Exec_Master_Log_Pos'),
+        'retrieved_gtid_set': _.get('Retrieved_Gtid_Set') or None,
+        'executed_gtid_set': _.get('Executed_Gtid_Set') or None,
+        'gtid_pending': gtid_pending(_.get('Retrieved_Gtid_Set'), _.get('Executed_Gtid_Set'))
+        if _.get('Retrieved_Gtid_Set') else None
+    } for _ in _rows]
+    _lags = [_['seconds_behind_master'] for _ in _channels if _['seconds_behind_master'] is not None]
+    return {
+        'node': f'{host}:{port}',
+        'role': 'slave' if _channels else 'master',
+        'healthy': all([_['io_running'] == 'Yes' and _['sql_running'] == 'Yes' and not _['last_errno']
+                        and not _['last_sql_errno'] for _ in _channels]) if _channels else None,
+        'seconds_behind_master': max(_lags) if _lags else None,
+        'channels': _channels,
+        'latency': round(time.time() - _start, 3),
+        'error': None
+    }
+
+
+def check_replication(db_cluster: dict, deadline: float = REPLICATION_DEADLINE):
+    """
+    并发检查集群所有节点，超过总截止时间的节点返回错误
+    :param db_cluster: get_mysql_cluster_info的结果
+    :param deadline: 总截止时间（秒）
+    :return: 节点状态列表，失败的节点包含error
+    """
+    _nodes = [(_[0], int(_[1])) for _ in db_cluster['mysql_node_list']]
+    if not _nodes:
+        return []
+    _deadline = time.time() + deadline
+    _executor = ThreadPoolExecutor(max_workers=len(_nodes), thread_name_prefix='replication-check')
+    try:
+        _futures = [_executor.submit(check_node, _host, _port, db_cluster['mysql_cluster_user'],
+                                     db_cluster['mysql_cluster_password']) for _host, _port in _nodes]
+        wait(_futures, timeout=max(_deadline - time.time(), 0))
+    finally:
+        # 不等待无响应的节点，其连接超时后线程自行结束
+        _executor.shutdown(wait=False)
+    _result = []
+    for (_host, _port), _future in zip(_nodes, _futures):
+        _node = {'node': f'{_host}:{_port}', 'role': None, 'healthy': False, 'seconds_behind_master': None,
+                 'channels': [], 'latency': deadline}
+        if not _future.done():
+            _node['error'] = 'deadline exceeded'
+        elif _future.exception():
+            logging.error(f'{_host}:{_port} DB connect error!!!')
+            _node.update(error=str(_future.exception()))
+        else:
+            _node = _future.result()
+        _result.append(_node)
+    return _result
+
+
+def summarize(nodes: list):
+    """
+    兼容原有的返回格式：success为同步正常的从库，error为检查失败的节点
+    :param nodes:
+    :return:
+    """
+    return {
+        'success': [_['node'] for _ in nodes if _['healthy']],
+        'error': [f"{_['node'].replace(':', '')}@{_['error']}" for _ in nodes if _['error']],
+        'nodes': nodes
+    }
+
+
+class ReplicationMonitor(object):
+    """
+    后台主从同步监控：按固定间隔并发检查所有节点，保存每个节点最近的检查记录，
+    /db_cluster_monitor直接从最新结果返回，并给出延迟的变化趋势
+    """
+
+    def __init__(self, interval: int = REPLICATION_INTERVAL, enabled: bool = True):
+        self.interval = interval
+        self.enabled = enabled
+        self.db_cluster = None
+        self.nodes = []
+        self.checked_at = None
+        self.history = {}
+        self._task = None
+        self._callback = None
+
+    def configure(self, db_cluster: dict = None, interval: int = None, enabled: bool = None):
+        self.db_cluster = db_cluster
+        self.interval = interval or self.interval
+        self.enabled = self.enabled if enabled is None else enabled
+
+    @property
+    def active(self):
+        return self.enabled and bool(self.db_cluster)
+
+    def start(self):
+        """
+        在IOLoop中启动定时检查，需在IOLoop启动前调用
+        :return:
+        """
+        if self.active and self._callback is None:
+            self._callback = PeriodicCallback(self.refresh, self.interval * 1000, jitter=REPLICATION_JITTER)
+            self._callback.start()
+        return self
+
+    def stop(self):
+        self._callback and self._callback.stop()
+        self._callback = None
+
+    def refresh(self):
+        """
+        检查一次所有节点，同时只有一次检查在进行
+        :return: 可await的检查任务
+        """
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._check())
+            self._task.add_done_callback(lambda _: setattr(self, '_task', None))
+        return self._task
+
+    async def _check(self):
+        _start = time.time()
+        try:
+            _nodes = await BLOCKING_EXECUTOR.run(('db', 'replication'), check_replication, self.db_cluster)
+        except Exception as e:
+            logging.error(f'check replication failed:{e}')
+            return
+        for _node in _nodes:
+            self.history.setdefault(_node['node'], deque(maxlen=REPLICATION_HISTORY)).append(
+                (_start, _node['seconds_behind_master'], _node['healthy']))
+        self.nodes, self.checked_at = _nodes, _start
+
+    async def get(self, max_age: float = None):
+        """
+        最新的检查结果，没有结果或结果超过max_age时先检查一次
+        :param max_age: 可接受的最大结果时间（秒）
+        :return: {'success':, 'error':, 'nodes': [含lag趋势], 'checked_at':, 'age':}
+        """
+        if self.checked_at is None or (max_age is not None and time.time() - self.checked_at > max_age):
+            await self.refresh()
+        _now = time.time()
+        _nodes = [dict(_node, lag=lag_trend(self.history.get(_node['node']) or [], _now),
+                       availability=self.availability(_node['node'], _now))
+                  for _node in self.nodes]
+        return dict(summarize(_nodes), checked_at=self.checked_at,
+                    age=round(_now - self.checked_at, 3) if self.checked_at else None)
+
+    def availability(self, node: str, now: float, window: float = REPLICATION_TREND_WINDOW):
+        """
+        时间窗口内同步正常的检查次数占比，主库为None
+        :param node:
+        :param now:
+        :param window:
+        :return:
+        """
+        _checks = [_healthy for _t, _, _healthy in self.history.get(node) or [] if now - _t <= window
+                   and _healthy is not None]
+        return round(sum(_checks) / len(_checks), 4) if _checks else None
+
+
+REPLICATION_MONITOR = ReplicationMonitor()
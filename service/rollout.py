@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import threading
+import time
+
+from kubernetes.client.rest import ApiException
+from kubernetes.watch.watch import iter_resp_lines
+
+ROLLOUT_TIMEOUT = 300  # 单个deployment的默认超时时间（秒）
+ROLLOUT_DEADLINE = 600  # 整个请求的默认截止时间（秒）
+ROLLOUT_STATE_PROGRESSING = 'progressing'
+ROLLOUT_STATE_COMPLETE = 'complete'
+ROLLOUT_STATE_FAILED = 'failed'
+ROLLOUT_STATE_TIMEOUT = 'timeout'
+
+
+def rollout_status(deploy: dict):
+    """
+    根据deployment（原始json）判断发布状态，规则与kubectl rollout status一致：
+    比较generation与observedGeneration，以及updatedReplicas、availableReplicas与期望副本数
+    :param deploy:
+    :return:
+    """
+    _spec, _status = deploy.get('spec') or {}, deploy.get('status') or {}
+    _replicas = _spec.get('replicas', 1)
+    _updated = _status.get('updatedReplicas') or 0
+    _available = _status.get('availableReplicas') or 0
+    _current = _status.get('replicas') or 0
+    _info = {
+        'name': deploy['metadata']['name'],
+        'namespace': deploy['metadata'].get('namespace'),
+        'generation': deploy['metadata'].get('generation'),
+        'observed_generation': _status.get('observedGeneration'),
+        'replicas': _replicas,
+        'updated_replicas': _updated,
+        'available_replicas': _available,
+        'ready_replicas': _status.get('readyReplicas') or 0
+    }
+    if (_info['generation'] or 0) > (_info['observed_generation'] or 0):
+        return dict(_info, state=ROLLOUT_STATE_PROGRESSING, msg='waiting for deployment spec update to be observed')
+    for _condition in _status.get('conditions') or []:
+        if _condition.get('type') == 'Progressing' and _condition.get('reason') == 'ProgressDeadlineExceeded':
+            return dict(_info, state=ROLLOUT_STATE_FAILED, msg=_condition.get('message'))
+    if _updated < _replicas:
+        _msg = f'{_updated} out of {_replicas} new replicas have been updated'
+    elif _current > _updated:
+        _msg = f'{_current - _updated} old replicas are pending termination'
+    elif _available < _updated:
+        _msg = f'{_available} of {_updated} updated replicas are available'
+    else:
+        return dict(_info, state=ROLLOUT_STATE_COMPLETE, msg='successfully rolled out')
+    return dict(_info, state=ROLLOUT_STATE_PROGRESSING, msg=_msg)
+
+
+class RolloutTracker(object):
+    """
+    通过deployment watch跟踪多个deployment的发布进度（不轮询）
+    每个命名空间一个watch线程，状态变化时通过on_event回调推送事件，全部结束后推送done事件
+    """
+
+    def __init__(self, api, deployments: list, on_event, deadline: float = ROLLOUT_DEADLINE):
+        """
+        :param api: AppsV1Api或ExtensionsV1beta1Api
+        :param deployments: [{'name':, 'namespace':, 'timeout':}]
+        :param on_event: 事件回调，在watch线程中调用
+        :param deadline: 整个跟踪过程的截止时间（秒）
+        """
+        self.api = api
+        self.on_event = on_event
+        self.started_at = time.time()
+        self.deadline = self.started_at + deadline
+        self.targets = {
+            (_.get('namespace', 'default'), _['name']): {
+                'deadline': min(self.started_at + float(_.get('timeout') or ROLLOUT_TIMEOUT), self.deadline),
+                'state': None,
+                'msg': None
+            }
+            for _ in deployments
+        }
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._done = False
+        self._responses = set()
+
+    def start(self):
+        for _namespace in {_ns for _ns, _ in self.targets}:
+            threading.Thread(target=self._run, args=(_namespace,), name=f'rollout-{_namespace}', daemon=True).start()
+        threading.Thread(target=self._check_timeout, name='rollout-timeout', daemon=True).start()
+        return self
+
+    def stop(self):
+        """
+        停止跟踪，关闭进行中的watch连接以便watch线程及时退出
+        :return:
+        """
+        self._stopped.set()
+        for _response in list(self._responses):
+            try:
+                _response.close()
+            except Exception:
+                pass
+
+    def _pending(self, namespace: str = None):
+        return [_key for _key, _target in self.targets.items()
+                if _target['state'] not in (ROLLOUT_STATE_COMPLETE, ROLLOUT_STATE_FAILED, ROLLOUT_STATE_TIMEOUT)
+                and (namespace is None or _key[0] == namespace)]
+
+    def _selector(self, namespace: str):
+        """
+        命名空间下只跟踪一个deployment时按名称过滤，否则watch整个命名空间
+        :param namespace:
+        :return:
+        """
+        _names = [_name for _ns, _name in self.targets if _ns == namespace]
+        return {'field_selector': f'metadata.name={_names[0]}'} if len(_names) == 1 else {}
+
+    def _run(self, namespace: str):
+        while not self._stopped.is_set() and self._pending(namespace):
+            try:
+                _response = self.api.list_namespaced_deployment(
+                    namespace=namespace, _preload_content=False, **self._selector(namespace))
+                try:
+                    _result = json.loads(_response.data)
+                finally:
+                    _response.release_conn()
+                [self._update(_) for _ in _result['items']]
+                self._watch(namespace, _result['metadata']['resourceVersion'])
+            except Exception as e:
+                logging.error(f'watch rollout of {namespace} failed:{e}')
+                self._stopped.wait(1)
+
+    def _watch(self, namespace: str, resource_version: str):
+        while not self._stopped.is_set() and self._pending(namespace):
+            _timeout = int(max(self.deadline - time.time(), 1))
+            try:
+                _response = self.api.list_namespaced_deployment(
+                    namespace=namespace, watch=True, resource_version=resource_version, timeout_seconds=_timeout,
+                    _preload_content=False, _request_timeout=(10, _timeout + 10), **self._selector(namespace))
+            except ApiException as e:
+                if e.status == 410:
+                    return
+                raise
+            self._responses.add(_response)
+            try:
+                for _line in iter_resp_lines(_response):
+                    _event = json.loads(_line)
+                    if _event['type'] == 'ERROR':
+                        # 410 Gone等错误时重新list
+                        return
+                    resource_version = _event['object']['metadata']['resourceVersion']
+                    _event['type'] != 'DELETED' and self._update(_event['object'])
+                    if self._stopped.is_set() or not self._pending(namespace):
+                        return
+            finally:
+                self._responses.discard(_response)
+                _response.release_conn()
+
+    def _update(self, deploy: dict):
+        _key = (deploy['metadata'].get('namespace'), deploy['metadata']['name'])
+        _status = rollout_status(deploy)
+        with self._lock:
+            _target = self.targets.get(_key)
+            if _target is None or _target['state'] in (ROLLOUT_STATE_COMPLETE, ROLLOUT_STATE_FAILED,
+                                                       ROLLOUT_STATE_TIMEOUT):
+                return
+            if (_target['state'], _target['msg']) == (_status['state'], _status['msg']):
+                return
+            _target.update(state=_status['state'], msg=_status['msg'])
+        self._emit(dict(_status, type=_status['state']))
+
+    def _check_timeout(self):
+        while not self._stopped.is_set() and not self._done:
+            _now = time.time()
+            with self._lock:
+                _expired = [_key for _key in self._pending() if self.targets[_key]['deadline'] <= _now]
+                [self.targets[_key].update(state=ROLLOUT_STATE_TIMEOUT, msg='rollout timeout') for _key in _expired]
+            [self._emit({'type': ROLLOUT_STATE_TIMEOUT, 'namespace': _ns, 'name': _name, 'state': ROLLOUT_STATE_TIMEOUT,
+                         'msg': 'rollout timeout'}) for _ns, _name in _expired]
+            self._stopped.wait(0.5)
+
+    def _emit(self, event: dict):
+        event['elapsed'] = round(time.time() - self.started_at, 3)
+        self.on_event(event)
+        with self._lock:
+            if self._done or self._pending():
+                return
+            self._done = True
+        self.on_event({
+            'type': 'done',
+            'success': all([_['state'] == ROLLOUT_STATE_COMPLETE for _ in self.targets.values()]),
+            'data': [{'namespace': _ns, 'name': _name, 'state': _target['state'], 'msg': _target['msg']}
+                     for (_ns, _name), _target in self.targets.items()],
+            'elapsed': round(time.time() - self.started_at, 3)
+        })
+        self.stop()
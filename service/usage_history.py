@@ -0,0 +1,461 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import threading
+import time
+import warnings
+
+import numpy as np
+from tornado.ioloop import PeriodicCallback
+
+from service.executor import BLOCKING_EXECUTOR
+from service.usage_segments import UsageSegmentStore, USAGE_DATA_PATH, USAGE_SEGMENT_RETENTION
+
+USAGE_METRICS = ('cpu', 'memory', 'disk')  # 节点为使用率，pod为cpu核数、内存字节数（无disk）
+USAGE_KINDS = ('node', 'pod')
+USAGE_TIERS = (
+    ('raw', 10, 1080),  # 10秒精度保留3小时
+    ('1m', 60, 1440),  # 1分钟精度保留24小时
+    ('10m', 600, 1008)  # 10分钟精度保留7天
+)
+USAGE_AGGREGATIONS = ('avg', 'max', 'p95')
+USAGE_INITIAL_SERIES = 64  # 初始分配的序列数，不够时成倍扩容
+USAGE_QUERY_POINTS = 360  # 未指定step时每个序列最多返回的点数
+USAGE_QUERY_MAX_CELLS = 4000000  # 一次查询读取的最大点数（序列数 * 时间点数）
+USAGE_ROLLUP_INTERVAL = 60  # 降采样的执行间隔（秒）
+USAGE_COMPACT_INTERVAL = 600  # 分段文件压缩、过期清理的执行间隔（秒）
+
+
+class UsageTier(object):
+    """
+    单个精度的环形缓冲：所有序列共用按时间对齐的槽位，槽位号 = (时间 // step) % slots
+    ts记录槽位对应的时间，用于判断槽位中的数据是否属于查询的时间点；value为均值，peak为最大值
+    """
+
+    def __init__(self, name: str, step: int, slots: int, series: int = USAGE_INITIAL_SERIES):
+        self.name = name
+        self.step = step
+        self.slots = slots
+        self.ts = np.zeros((series, slots), dtype=np.int64)
+        self.value = np.full((series, slots, len(USAGE_METRICS)), np.nan, dtype=np.float32)
+        self.peak = np.full((series, slots, len(USAGE_METRICS)), np.nan, dtype=np.float32)
+        # 已完成降采样的时间点，仅非raw精度使用
+        self.rolled_until = None
+
+    @property
+    def retention(self):
+        return self.step * self.slots
+
+    def grow(self, series: int):
+        _pad = series - self.ts.shape[0]
+        self.ts = np.concatenate([self.ts, np.zeros((_pad, self.slots), dtype=np.int64)])
+        self.value = np.concatenate([self.value, np.full((_pad, self.slots, len(USAGE_METRICS)), np.nan, np.float32)])
+        self.peak = np.concatenate([self.peak, np.full((_pad, self.slots, len(USAGE_METRICS)), np.nan, np.float32)])
+
+    def clear(self, row: int):
+        self.ts[row] = 0
+        self.value[row] = np.nan
+        self.peak[row] = np.nan
+
+    def write(self, row: int, timestamp: float, values):
+        """
+        写入一个采样点，同一槽位内后写入的覆盖先写入的
+        :param row:
+        :param timestamp:
+        :param values: 按USAGE_METRICS顺序的值
+        :return:
+        """
+        _t = int(timestamp) - int(timestamp) % self.step
+        _i = (_t // self.step) % self.slots
+        self.ts[row, _i] = _t
+        self.value[row, _i] = values
+        self.peak[row, _i] = values
+
+    def window(self, rows, start: int, end: int):
+        """
+        读取[start, end)内按step对齐的所有时间点，缺失的点为nan
+        :param rows: 序列行号
+        :param start:
+        :param end:
+        :return: (时间点, 均值[序列, 时间点, 指标], 最大值[序列, 时间点, 指标])
+        """
+        _times = np.arange(start - start % self.step, end, self.step, dtype=np.int64)[-self.slots:]
+        _index = (_times // self.step) % self.slots
+        _grid = np.ix_(rows, _index)
+        _missing = (self.ts[_grid] != _times)[..., None]
+        return _times, np.where(_missing, np.nan, self.value[_grid]), np.where(_missing, np.nan, self.peak[_grid])
+
+    def rollup(self, source, now: float):
+        """
+        将高精度缓冲中已结束的时间段降采样到本缓冲，所有序列一次完成
+        :param source: 高精度的UsageTier
+        :param now:
+        :return: 本次写入的(行号, 时间点, 均值, 最大值)，没有新数据时为None
+        """
+        _end = int(now) - int(now) % self.step
+        _start = max(self.rolled_until or 0, _end - source.retention)
+        _start += -_start % self.step
+        if _start >= _end:
+            return None
+        _rows = np.arange(self.ts.shape[0])
+        _times, _value, _peak = source.window(_rows, _start, _end)
+        _per = self.step // source.step
+        _shape = (len(_rows), len(_times) // _per, _per, len(USAGE_METRICS))
+        _value, _peak = _value.reshape(_shape), _peak.reshape(_shape)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            _mean, _max = np.nanmean(_value, axis=2), np.nanmax(_peak, axis=2)
+        _row, _bucket = np.nonzero(~np.isnan(_mean).all(axis=2))
+        _bucket_times = _times[::_per]
+        _index = (_bucket_times // self.step) % self.slots
+        self.ts[_row, _index[_bucket]] = _bucket_times[_bucket]
+        self.value[_row, _index[_bucket]] = _mean[_row, _bucket]
+        self.peak[_row, _index[_bucket]] = _max[_row, _bucket]
+        self.rolled_until = _end
+        return _row, _bucket_times[_bucket], _mean[_row, _bucket], _max[_row, _bucket]
+
+    def load(self, rows, records):
+        """
+        将持久化的记录写回环形缓冲
+        :param rows: 每条记录对应的行号
+        :param records: 持久化的记录，同一槽位后面的覆盖前面的
+        :return:
+        """
+        _ts = records['ts'] - records['ts'] % self.step
+        _index = (_ts // self.step) % self.slots
+        self.ts[rows, _index] = _ts
+        self.value[rows, _index] = records['value']
+        self.peak[rows, _index] = records['peak']
+
+
+class UsageHistory(object):
+    """
+    节点及pod资源使用历史：按集群、类型、名称分配序列行号，raw ==> 1m ==> 10m 定时降采样
+    内存占用固定，与序列数成正比，不随时间增长；长时间无数据的序列回收后复用
+    开启持久化时同时写入内存映射的分段文件，重启后从分段文件恢复，超过内存保留时间的查询直接读取分段文件
+    """
+
+    def __init__(self):
+        self.tiers = [UsageTier(_name, _step, _slots) for _name, _step, _slots in USAGE_TIERS]
+        self.rows = {}
+        self.last_write = np.zeros(USAGE_INITIAL_SERIES, dtype=np.float64)
+        # 行号对应的持久化序列号
+        self.series_ids = np.full(USAGE_INITIAL_SERIES, -1, dtype=np.int32)
+        self.persistence = None
+        self.last_compact = 0
+        self._free = list(range(USAGE_INITIAL_SERIES - 1, -1, -1))
+        self._lock = threading.RLock()
+        self._callback = None
+        self._task = None
+
+    def configure(self, persist: bool = None, path: str = None):
+        """
+        开启持久化并从已有的分段文件恢复，数据目录不可用时只记录日志，继续使用内存
+        :param persist:
+        :param path: 默认/var/data/usage
+        :return:
+        """
+        if not persist or self.persistence is not None:
+            return
+        try:
+            self.persistence = UsageSegmentStore(path or USAGE_DATA_PATH, metrics=len(USAGE_METRICS)).open()
+            self.load()
+        except (OSError, ValueError, IndexError, TypeError) as e:
+            logging.error(f'usage history persistence disabled:{e!r}')
+            self.persistence = None
+
+    def start(self):
+        if self._callback is None:
+            self._callback = PeriodicCallback(self._schedule_downsample, USAGE_ROLLUP_INTERVAL * 1000)
+            self._callback.start()
+        return self
+
+    def _schedule_downsample(self):
+        """
+        降采样及分段文件的flush、压缩在执行层中进行，不阻塞IOLoop，同时只有一次在进行
+        :return:
+        """
+        if self._task is None:
+            self._task = asyncio.ensure_future(BLOCKING_EXECUTOR.run(('usage', 'downsample'), self.downsample))
+            self._task.add_done_callback(self._downsample_done)
+
+    def _downsample_done(self, task):
+        self._task = None
+        task.exception() and logging.error(f'usage history downsample failed:{task.exception()}')
+
+    def _row(self, cluster: str, kind: str, name: str):
+        _key = (cluster, kind, name)
+        if _key not in self.rows:
+            if not self._free:
+                _size = len(self.last_write)
+                [_tier.grow(_size * 2) for _tier in self.tiers]
+                self.last_write = np.concatenate([self.last_write, np.zeros(_size, dtype=np.float64)])
+                self.series_ids = np.concatenate([self.series_ids, np.full(_size, -1, dtype=np.int32)])
+                self._free = list(range(_size * 2 - 1, _size - 1, -1))
+            self.rows[_key] = self._free.pop()
+            if self.persistence:
+                self.series_ids[self.rows[_key]] = self.persistence.series_id(_key)
+        return self.rows[_key]
+
+    def record(self, cluster: str, kind: str, name: str, timestamp: float, values: dict):
+        """
+        记录一个采样点
+        :param cluster: 集群标识
+        :param kind: node、pod
+        :param name: 节点ip或namespace/pod名称
+        :param timestamp:
+        :param values: {'cpu':, 'memory':, 'disk':}，缺少的指标记为nan
+        :return:
+        """
+        _values = [np.nan if values.get(_) is None else values[_] for _ in USAGE_METRICS]
+        with self._lock:
+            _row = self._row(cluster, kind, name)
+            self.tiers[0].write(_row, timestamp, _values)
+            self.last_write[_row] = max(self.last_write[_row], timestamp)
+            self.persistence and self.persistence.append(
+                self.tiers[0].name, [self.series_ids[_row]], [int(timestamp)], [_values], [_values])
+
+    def record_nodes(self, cluster: str, nodes: list, timestamp: float):
+        """
+        记录/statistics格式的节点使用信息，节点的pods中带有使用量时同时记录pod
+        :param cluster:
+        :param nodes:
+        :param timestamp:
+        :return:
+        """
+        for _node in nodes:
+            if _node.get('error') or 'cpu' not in _node:
+                continue
+            self.record(cluster, 'node', _node['node_ip'], timestamp, {
+                'cpu': _node['cpu'].get('ratio', _node['cpu']['percentage']),
+                'memory': _node['memory']['percentage'],
+                'disk': _node['disk']['percentage']
+            })
+            for _pod in _node.get('pods') or []:
+                if 'cpu' in _pod and 'memory' in _pod:
+                    self.record(cluster, 'pod', f"{_pod['namespace']}/{_pod['name']}", timestamp,
+                                {'cpu': _pod['cpu']['usage'], 'memory': _pod['memory']['usage']})
+
+    def downsample(self, now: float = None):
+        """
+        定时执行：raw ==> 1m ==> 10m降采样，并回收超过最长保留时间没有数据的序列
+        :param now:
+        :return:
+        """
+        _now = now or time.time()
+        _start = time.time()
+        with self._lock:
+            for _source, _tier in zip(self.tiers, self.tiers[1:]):
+                _rollup = _tier.rollup(_source, _now)
+                if _rollup and self.persistence:
+                    _row, _times, _mean, _max = _rollup
+                    self.persistence.append(_tier.name, self.series_ids[_row], _times, _mean, _max)
+            _retention = max([_.retention for _ in self.tiers])
+            for _key, _row in list(self.rows.items()):
+                if _now - self.last_write[_row] > _retention:
+                    [_tier.clear(_row) for _tier in self.tiers]
+                    self.last_write[_row] = 0
+                    self.series_ids[_row] = -1
+                    self._free.append(self.rows.pop(_key))
+            if self.persistence:
+                self.persistence.flush()
+                if _now - self.last_compact > USAGE_COMPACT_INTERVAL:
+                    self.persistence.compact(_now, {_tier.name: _tier.step for _tier in self.tiers})
+                    self.last_compact = _now
+        logging.debug(f'usage history downsampled in {round(time.time() - _start, 3)}s')
+
+    def load(self, now: float = None):
+        """
+        从分段文件恢复内存保留时间内的数据，记录直接从映射的文件中读取后按行号批量写入环形缓冲
+        :param now:
+        :return:
+        """
+        _now = now or time.time()
+        _start = time.time()
+        # 序列文件中丢失的序列（异常退出时未写完的行）没有对应的key，其记录丢弃
+        _known = np.array([_ is not None for _ in self.persistence.keys] + [False], dtype=bool)
+        with self._lock:
+            for _tier in self.tiers:
+                for _records in self.persistence.read(_tier.name, int(_now) - _tier.retention, int(_now) + 1):
+                    _records = _records[_known[np.minimum(_records['series'], len(_known) - 1)]]
+                    if not len(_records):
+                        continue
+                    _ids, _inverse = np.unique(_records['series'], return_inverse=True)
+                    _rows = np.array([self._row(*self.persistence.keys[_id]) for _id in _ids], dtype=np.int64)
+                    _tier.load(_rows[_inverse], _records)
+                    np.maximum.at(self.last_write, _rows[_inverse], _records['ts'])
+                    if _tier is not self.tiers[0]:
+                        _tier.rolled_until = max(_tier.rolled_until or 0, int(_records['ts'].max()) + _tier.step)
+        logging.info(f'usage history loaded {len(self.rows)} series in {round(time.time() - _start, 3)}s')
+
+    def series(self, cluster: str, kind: str, names: list = None):
+        with self._lock:
+            _series = sorted([(_name, _row) for (_cluster, _kind, _name), _row in self.rows.items()
+                              if _cluster == cluster and _kind == kind and (not names or _name in names)])
+        return [_name for _name, _ in _series], np.array([_row for _, _row in _series], dtype=np.int64)
+
+    def _select_tier(self, start: int, now: float):
+        for _tier in self.tiers:
+            if start >= now - _tier.retention:
+                return _tier
+        return self.tiers[-1]
+
+    @staticmethod
+    def _aggregate(value, peak, agg: str, axis: int):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            if agg == 'max':
+                return np.nanmax(peak, axis=axis)
+            if agg == 'p95':
+                return nan_percentile(value, 95, axis=axis)
+            if agg == 'avg':
+                return np.nanmean(value, axis=axis)
+        raise ValueError(f'agg must be one of {USAGE_AGGREGATIONS}')
+
+    def _window(self, cluster: str, kind: str, names: list, start: float, end: float, step: int = None):
+        _now = time.time()
+        _end = int(end or _now)
+        _start = int(start if start is not None else _end - 3600)
+        if _start >= _end:
+            raise ValueError('start must be earlier than end')
+        with self._lock:
+            _tier = self._select_tier(_start, _now)
+            # 起始时间不早于所用精度的保留时间，避免按任意start分配时间点
+            _retention = max(_tier.retention, USAGE_SEGMENT_RETENTION[_tier.name] if self.persistence else 0)
+            _start = max(_start, _end - _retention)
+            _step = max(int(step or (_end - _start) / USAGE_QUERY_POINTS), _tier.step)
+            _step += -_step % _tier.step
+            # 按输出step对齐起始时间，保证每个输出点包含完整的step
+            _start -= _start % _step
+            if self.persistence and _start < _now - _tier.retention:
+                # 超过内存保留时间，从分段文件读取
+                _names, _times, _value, _peak = self._segment_window(cluster, kind, names, _tier, _start, _end)
+            else:
+                _names, _rows = self.series(cluster, kind, names)
+                self._check_size(len(_rows), _tier, _start, _end)
+                _times, _value, _peak = _tier.window(_rows, _start, _end)
+        return _names, _tier, _step, _times, _value, _peak
+
+    @staticmethod
+    def _check_size(series: int, tier, start: int, end: int):
+        if series * ((end - start) // tier.step + 1) > USAGE_QUERY_MAX_CELLS:
+            raise ValueError(f'too many points ({series} series from {start} to {end} at {tier.step}s), '
+                             f'narrow the time range or names')
+
+    def _segment_window(self, cluster: str, kind: str, names: list, tier, start: int, end: int):
+        """
+        从分段文件读取[start, end)内的数据，格式与UsageTier.window一致
+        :param cluster:
+        :param kind:
+        :param names:
+        :param tier:
+        :param start:
+        :param end:
+        :return: (名称, 时间点, 均值, 最大值)
+        """
+        _series = sorted([(_name, _id) for (_cluster, _kind, _name), _id in self.persistence.series.items()
+                          if _cluster == cluster and _kind == kind and (not names or _name in names)])
+        self._check_size(len(_series), tier, start, end)
+        _times = np.arange(start - start % tier.step, end, tier.step, dtype=np.int64)
+        _value = np.full((len(_series), len(_times), len(USAGE_METRICS)), np.nan, dtype=np.float32)
+        _peak = np.full((len(_series), len(_times), len(USAGE_METRICS)), np.nan, dtype=np.float32)
+        # 序列号 ==> 结果中的行
+        _position = np.full(len(self.persistence.keys) + 1, -1, dtype=np.int64)
+        _position[[_id for _, _id in _series]] = np.arange(len(_series))
+        for _records in self.persistence.read(tier.name, int(_times[0]) if len(_times) else start, end):
+            _row = _position[np.minimum(_records['series'], len(_position) - 1)]
+            _selected = _row >= 0
+            _row, _records = _row[_selected], _records[_selected]
+            _column = (_records['ts'] - _times[0]) // tier.step
+            _value[_row, _column] = _records['value']
+            _peak[_row, _column] = _records['peak']
+        return [_name for _name, _ in _series], _times, _value, _peak
+
+    def query(self, cluster: str, kind: str = 'node', names: list = None, start: float = None, end: float = None,
+              step: int = None, agg: str = 'avg', metrics: list = None):
+        """
+        查询时间范围内的使用历史，按step聚合
+        :param cluster: 集群标识
+        :param kind: node、pod
+        :param names: 为空时返回该类型的全部序列
+        :param start: 开始时间戳，默认end前1小时
+        :param end: 结束时间戳，默认当前时间
+        :param step: 输出的时间间隔（秒），向上取整为所用精度的整数倍
+        :param agg: avg、max、p95
+        :param metrics: 默认全部指标
+        :return: {'tier':, 'step':, 'times': [], 'series': {名称: {指标: []}}}
+        """
+        _names, _tier, _step, _times, _value, _peak = self._window(cluster, kind, names, start, end, step)
+        _per = _step // _tier.step
+        # 丢弃开头不足一个step的点
+        _count = len(_times) // _per
+        _offset = len(_times) - _count * _per
+        _shape = (len(_names), _count, _per, len(USAGE_METRICS))
+        _result = to_json_array(self._aggregate(
+            _value[:, _offset:].reshape(_shape), _peak[:, _offset:].reshape(_shape), agg, axis=2))
+        _metrics = [_ for _ in USAGE_METRICS if not metrics or _ in metrics]
+        return {
+            'tier': _tier.name,
+            'step': _step,
+            'agg': agg,
+            'times': _times[_offset::_per].tolist(),
+            'series': {
+                _name: {_metric: _result[_i, :, USAGE_METRICS.index(_metric)].tolist() for _metric in _metrics}
+                for _i, _name in enumerate(_names)
+            }
+        }
+
+    def top(self, cluster: str, kind: str = 'node', metric: str = 'cpu', start: float = None, end: float = None,
+            agg: str = 'avg', k: int = 10):
+        """
+        时间范围内按指标聚合值排序的前k个序列
+        :param cluster:
+        :param kind:
+        :param metric:
+        :param start:
+        :param end:
+        :param agg:
+        :param k:
+        :return: [{'name':, 'value':}]
+        """
+        _names, _tier, _step, _times, _value, _peak = self._window(cluster, kind, None, start, end)
+        _i = USAGE_METRICS.index(metric)
+        _result = self._aggregate(_value[:, :, _i], _peak[:, :, _i], agg, axis=1) if len(_times) else \
+            np.full(len(_names), np.nan)
+        _order = [_ for _ in np.argsort(-_result, kind='stable') if not np.isnan(_result[_])][:k]
+        return [{'name': _names[_], 'value': round(float(_result[_]), 6)} for _ in _order]
+
+
+def nan_percentile(values, q: float, axis: int):
+    """
+    忽略nan的百分位数（线性插值，与np.nanpercentile一致）
+    np.nanpercentile在含nan时逐行计算，数据量大时很慢，这里排序后按有效个数一次取值
+    :param values:
+    :param q: 0-100
+    :param axis:
+    :return:
+    """
+    _sorted = np.sort(values, axis=axis)
+    _count = (~np.isnan(values)).sum(axis=axis, keepdims=True)
+    _rank = (np.maximum(_count, 1) - 1) * (q / 100.0)
+    _low = np.floor(_rank).astype(np.int64)
+    _high = np.minimum(_low + 1, np.maximum(_count - 1, 0))
+    _low_value = np.take_along_axis(_sorted, _low, axis=axis)
+    _high_value = np.take_along_axis(_sorted, _high, axis=axis)
+    _result = _low_value + (_high_value - _low_value) * (_rank - _low)
+    return np.where(_count > 0, _result, np.nan).squeeze(axis=axis)
+
+
+def to_json_array(values):
+    """
+    numpy数组转为可json序列化的object数组，nan转为None
+    :param values:
+    :return:
+    """
+    _result = np.round(values.astype(np.float64), 6).astype(object)
+    _result[np.isnan(values)] = None
+    return _result
+
+
+USAGE_HISTORY = UsageHistory()
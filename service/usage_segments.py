@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+USAGE_DATA_PATH = '/var/data/usage'  # Dockerfile中声明的数据卷
+USAGE_SEGMENT_SPAN = {'raw': 3600, '1m': 6 * 3600, '10m': 86400}  # 每个分段文件覆盖的时间（秒）
+USAGE_SEGMENT_RETENTION = {'raw': 3 * 3600, '1m': 86400, '10m': 30 * 86400}  # 分段文件的保留时间（秒）
+USAGE_SEGMENT_RECORDS = 1 << 14  # 新分段文件预分配的记录数，写满时翻倍
+USAGE_SERIES_FILE = 'series.ndjson'
+
+
+def record_dtype(metrics: int):
+    """
+    定长记录：时间戳、序列号、各指标均值及最大值
+    :param metrics: 指标个数
+    :return:
+    """
+    return np.dtype([('ts', '<i8'), ('series', '<i4'), ('value', '<f4', (metrics,)), ('peak', '<f4', (metrics,))])
+
+
+class UsageSegment(object):
+    """
+    单个分段文件，通过np.memmap映射
+    写入中的分段（<start>.seg）按写入顺序追加，未使用的记录ts为0；
+    压缩后的分段（<start>.sorted.seg）按(ts, series)排序且去重，只读，范围查询直接返回映射的切片
+    """
+
+    def __init__(self, path: str, dtype, compacted: bool = False):
+        self.path = path
+        self.dtype = dtype
+        self.compacted = compacted
+        self.data = None
+        self.count = 0
+
+    def open(self, capacity: int = USAGE_SEGMENT_RECORDS):
+        if not os.path.exists(self.path):
+            with open(self.path, 'wb') as _f:
+                _f.truncate(capacity * self.dtype.itemsize)
+        _size = os.path.getsize(self.path) // self.dtype.itemsize
+        if _size == 0:
+            self.data, self.count = np.zeros(0, dtype=self.dtype), 0
+            return self
+        self.data = np.memmap(self.path, dtype=self.dtype, mode='r' if self.compacted else 'r+', shape=(_size,))
+        if self.compacted:
+            self.count = _size
+        else:
+            _empty = np.flatnonzero(self.data['ts'] == 0)
+            self.count = int(_empty[0]) if len(_empty) else _size
+        return self
+
+    def _grow(self, size: int):
+        self.data.flush()
+        self.data = None
+        with open(self.path, 'r+b') as _f:
+            _f.truncate(size * self.dtype.itemsize)
+        self.data = np.memmap(self.path, dtype=self.dtype, mode='r+', shape=(size,))
+
+    def append(self, records):
+        if self.count + len(records) > len(self.data):
+            self._grow(max(len(self.data) * 2, self.count + len(records)))
+        self.data[self.count:self.count + len(records)] = records
+        self.count += len(records)
+
+    def flush(self):
+        self.compacted or self.data is None or self.data.flush()
+
+    def close(self):
+        self.flush()
+        self.data = None
+
+    def records(self):
+        return self.data[:self.count]
+
+    def read(self, start: int, end: int):
+        """
+        读取[start, end)内的记录，压缩后的分段返回映射的切片，不复制数据
+        :param start:
+        :param end:
+        :return:
+        """
+        _records = self.records()
+        if self.compacted:
+            _ts = _records['ts']
+            return _records[np.searchsorted(_ts, start):np.searchsorted(_ts, end)]
+        return _records[(_records['ts'] >= start) & (_records['ts'] < end)]
+
+
+class UsageSegmentStore(object):
+    """
+    使用历史的磁盘持久化：每个精度按时间切分为定长记录的分段文件，内存映射读写
+    已结束的分段定期压缩（排序、去重、截断），超过保留时间的分段删除
+    序列号与(集群, 类型, 名称)的对应关系追加写入series.ndjson，序列号不复用
+    """
+
+    def __init__(self, path: str = USAGE_DATA_PATH, metrics: int = 3):
+        self.path = path
+        self.dtype = record_dtype(metrics)
+        self.series = {}
+        self.keys = []
+        self.segments = {}
+        # 下一个分配的序列号，不小于分段文件中出现过的最大序列号 + 1
+        self.next_id = 0
+        self._lock = threading.RLock()
+
+    def open(self):
+        """
+        打开数据目录，加载序列及已有的分段文件
+        :return:
+        """
+        for _tier in USAGE_SEGMENT_SPAN:
+            os.makedirs(os.path.join(self.path, _tier), exist_ok=True)
+        _series_file = os.path.join(self.path, USAGE_SERIES_FILE)
+        if os.path.exists(_series_file):
+            with open(_series_file, 'r+b') as _f:
+                _content = _f.read()
+                # 异常退出时最后一行可能不完整，截断到最后一个完整的行，之后追加的行不会接在残行后面
+                _end = _content.rfind(b'\n') + 1
+                if _end < len(_content):
+                    logging.warning(f'truncate incomplete line at the end of {_series_file}')
+                    _f.truncate(_end)
+            for _line in _content[:_end].decode('utf-8', 'ignore').splitlines():
+                try:
+                    _id, _cluster, _kind, _name = json.loads(_line)
+                except ValueError:
+                    continue
+                self.series[(_cluster, _kind, _name)] = _id
+                self.keys.extend([None] * (_id + 1 - len(self.keys)))
+                self.keys[_id] = (_cluster, _kind, _name)
+        for _tier in USAGE_SEGMENT_SPAN:
+            for _name in os.listdir(os.path.join(self.path, _tier)):
+                _start, _, _suffix = _name.partition('.')
+                if _suffix not in ('seg', 'sorted.seg') or not _start.isdigit():
+                    continue
+                self.segments[(_tier, int(_start), _suffix == 'sorted.seg')] = UsageSegment(
+                    os.path.join(self.path, _tier, _name), self.dtype, compacted=_suffix == 'sorted.seg').open()
+        # 丢失的序列行对应的序列号已被分段记录使用，不再分配
+        self.next_id = max([len(self.keys)] + [int(_.records()['series'].max()) + 1
+                                               for _ in self.segments.values() if _.count])
+        logging.info(f'usage segments loaded from {self.path}: {len(self.keys)} series, {len(self.segments)} segments')
+        return self
+
+    def series_id(self, key: tuple):
+        """
+        获取序列号，新序列追加写入序列文件
+        :param key: (集群, 类型, 名称)
+        :return:
+        """
+        with self._lock:
+            if key not in self.series:
+                _id = self.next_id
+                with open(os.path.join(self.path, USAGE_SERIES_FILE), 'a') as _f:
+                    _f.write(json.dumps([_id] + list(key)) + '\n')
+                self.series[key] = _id
+                self.keys.extend([None] * (_id + 1 - len(self.keys)))
+                self.keys[_id] = key
+                self.next_id = _id + 1
+            return self.series[key]
+
+    def append(self, tier: str, series, ts, value, peak):
+        """
+        批量写入记录，按时间分配到对应的分段文件
+        :param tier: raw、1m、10m
+        :param series: 序列号数组
+        :param ts: 时间戳数组
+        :param value: 均值[记录, 指标]
+        :param peak: 最大值[记录, 指标]
+        :return:
+        """
+        _records = np.zeros(len(ts), dtype=self.dtype)
+        _records['ts'], _records['series'], _records['value'], _records['peak'] = ts, series, value, peak
+        _span = USAGE_SEGMENT_SPAN[tier]
+        _starts = _records['ts'] - _records['ts'] % _span
+        with self._lock:
+            for _start in np.unique(_starts):
+                _key = (tier, int(_start), False)
+                if _key not in self.segments:
+                    self.segments[_key] = UsageSegment(
+                        os.path.join(self.path, tier, f'{int(_start)}.seg'), self.dtype).open()
+                self.segments[_key].append(_records[_starts == _start])
+
+    def read(self, tier: str, start: int, end: int):
+        """
+        读取[start, end)内的记录，按分段时间顺序返回，同一时间点后写入的在后
+        :param tier:
+        :param start:
+        :param end:
+        :return: 记录数组的列表
+        """
+        _span = USAGE_SEGMENT_SPAN[tier]
+        with self._lock:
+            _segments = sorted([(_start, _compacted, _segment) for (_tier, _start, _compacted), _segment
+                                in self.segments.items() if _tier == tier and _start < end and _start + _span > start],
+                               key=lambda _: (_[0], not _[1]))
+            return [_segment.read(start, end) for _, _, _segment in _segments]
+
+    def flush(self):
+        with self._lock:
+            [_segment.flush() for _segment in self.segments.values()]
+
+    def compact(self, now: float, steps: dict):
+        """
+        删除超过保留时间的分段；已结束的写入中分段与已压缩的同时间分段合并，按(ts, series)排序去重后写为压缩分段
+        :param now:
+        :param steps: {精度: 采样间隔}，分段结束后还可能写入一个间隔内的降采样数据
+        :return:
+        """
+        _start_time = time.time()
+        with self._lock:
+            for (_tier, _start, _compacted), _segment in list(self.segments.items()):
+                _span = USAGE_SEGMENT_SPAN[_tier]
+                if _start + _span < now - USAGE_SEGMENT_RETENTION[_tier]:
+                    _segment.close()
+                    os.remove(_segment.path)
+                    self.segments.pop((_tier, _start, _compacted))
+                elif not _compacted and _start + _span + 2 * steps.get(_tier, 0) <= now:
+                    self._compact(_tier, _start)
+        logging.debug(f'usage segments compacted in {round(time.time() - _start_time, 3)}s')
+
+    def _compact(self, tier: str, start: int):
+        _active = self.segments.pop((tier, start, False))
+        _sorted = self.segments.pop((tier, start, True), None)
+        _records = np.concatenate(([_sorted.records()] if _sorted else []) + [_active.records()])
+        # 同一(ts, series)保留最后写入的记录
+        _order = np.lexsort((np.arange(len(_records)), _records['series'], _records['ts']))
+        _records = _records[_order]
+        _last = np.ones(len(_records), dtype=bool)
+        _last[:-1] = (_records['ts'][1:] != _records['ts'][:-1]) | (_records['series'][1:] != _records['series'][:-1])
+        _path = os.path.join(self.path, tier, f'{start}.sorted.seg')
+        _records[_last].tofile(_path + '.tmp')
+        _sorted and _sorted.close()
+        _active.close()
+        os.replace(_path + '.tmp', _path)
+        os.remove(_active.path)
+        self.segments[(tier, start, True)] = UsageSegment(_path, self.dtype, compacted=True).open()
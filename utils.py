@@ -8,9 +8,15 @@ import urllib
 import os
 import logging
 import tempfile
+import threading
+import hashlib
+import functools
+from collections import OrderedDict, Counter
 from kubernetes import client, config
+from kubernetes.config import kube_config
 import json
 import traceback
+from dateutil import parser as dateutil_parser
 
 K8S_CLUSTER_V1API_VERSION = 16  # 强制使用apps/v1的版本 1.16
 K8S_CLUSTER_LOWEST_VERSION = 1.9  # 支持最低k8s版本
@@ -18,40 +24,200 @@ K8S_SOURCE_TYPE_DEPLOY = 'DEPLOYMENT'
 K8S_SOURCE_TYPE = 'DEPLOYMENT'
 K8S_OBJ_NODE = 'nodes'
 K8S_OBJ_POD = 'pods'
+K8S_CLIENT_CACHE_TTL = 1800  # 集群客户端缓存时间（秒）
+K8S_CLIENT_CACHE_SIZE = 32  # 最多缓存的集群客户端数量
+K8S_CLUSTER_CACHE_TTL = 600  # 集群版本等信息的缓存时间（秒）
+K8S_LIST_PAGE_SIZE = 500  # list接口分页大小
+K8S_ROLLOUT_CONCURRENCY = 10  # 批量更新镜像的并发数
+K8S_IMAGE_INDEX_TTL = 60  # 镜像索引的缓存时间（秒）
+
+
+class K8sClient(object):
+    """
+    单个集群的客户端，持有独立的ApiClient及其连接池，不再修改kubernetes全局默认配置
+    兼容原先直接返回kubernetes.client模块时的用法：self.client.CoreV1Api()
+    """
+
+    def __init__(self, key: str, api_client, temp_files: list = None):
+        self.key = key
+        self.api_client = api_client
+        self.temp_files = temp_files or []
+        self.created_at = time.time()
+        # 集群级别的缓存，如集群版本、api对象等，随客户端一起在请求间共享
+        self._cache = {}
+        self._cache_lock = threading.RLock()
+        # 客户端被淘汰时的回调，如停止该集群的informer
+        self.close_callbacks = []
+
+    def __getattr__(self, item):
+        _attr = getattr(client, item)
+        # XxxApi类自动绑定本集群的ApiClient
+        return functools.partial(_attr, self.api_client) \
+            if isinstance(_attr, type) and item.endswith('Api') else _attr
+
+    def expired(self, ttl: int):
+        return time.time() - self.created_at > ttl
+
+    def get_cached(self, name: str, loader, ttl: int = K8S_CLUSTER_CACHE_TTL):
+        """
+        获取集群级别缓存的值，不存在或超过ttl时调用loader重新加载
+        :param name:
+        :param loader: 无参函数
+        :param ttl:
+        :return:
+        """
+        _item = self._cache.get(name)
+        if _item and time.time() - _item[0] <= ttl:
+            return _item[1]
+        with self._cache_lock:
+            _item = self._cache.get(name)
+            if _item and time.time() - _item[0] <= ttl:
+                return _item[1]
+            _value = loader()
+            self._cache[name] = (time.time(), _value)
+            return _value
+
+    def invalidate(self, name: str = None):
+        """
+        清除集群级别缓存，name为空时全部清除
+        :param name:
+        :return:
+        """
+        self._cache.pop(name, None) if name else self._cache.clear()
+
+    def close(self):
+        """
+        关闭连接池
+        :return:
+        """
+        for _callback in self.close_callbacks:
+            try:
+                _callback()
+            except Exception as e:
+                logging.error(f'close callback of k8s client {self.key} failed:{e}')
+        try:
+            self.api_client.rest_client.pool_manager.clear()
+            self.api_client.__del__()
+        except Exception as e:
+            logging.error(f'close k8s client {self.key} failed:{e}')
+
+
+class K8sClientRegistry(object):
+    """
+    按kubeconfig/ServiceAccount内容的hash缓存K8sClient，TTL过期后重建，超过容量按LRU淘汰
+    淘汰时关闭连接池并删除生成的临时文件
+    """
+
+    def __init__(self, ttl: int = K8S_CLIENT_CACHE_TTL, max_size: int = K8S_CLIENT_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._clients = OrderedDict()
+        self._temp_file_refs = Counter()
+        self._lock = threading.RLock()
+
+    def configure(self, ttl: int = None, max_size: int = None):
+        self.ttl = ttl or self.ttl
+        self.max_size = max_size or self.max_size
+
+    @staticmethod
+    def get_key(kubeconfig: str):
+        """
+        本地文件以路径+修改时间作为key，文件变更后自动重建
+        :param kubeconfig:
+        :return:
+        """
+        _content = f'{kubeconfig}:{os.path.getmtime(kubeconfig)}' if os.path.isfile(kubeconfig) else kubeconfig
+        return hashlib.sha256(_content.encode('utf-8')).hexdigest()
+
+    def get(self, kubeconfig: str) -> K8sClient:
+        """
+        获取缓存的客户端，不存在或已过期则新建
+        :param kubeconfig:
+        :return:
+        """
+        _key = self.get_key(kubeconfig)
+        with self._lock:
+            _client = self._clients.get(_key)
+            if _client and not _client.expired(self.ttl):
+                self._clients.move_to_end(_key)
+                return _client
+            _client and self._evict(_key)
+            _client = self._build(_key, kubeconfig)
+            self._clients[_key] = _client
+            self._temp_file_refs.update(_client.temp_files)
+            while len(self._clients) > self.max_size:
+                self._evict(next(iter(self._clients)))
+            return _client
+
+    def evict(self, key: str):
+        with self._lock:
+            key in self._clients and self._evict(key)
+
+    def clear(self):
+        with self._lock:
+            [self._evict(_key) for _key in list(self._clients)]
+
+    def _evict(self, key: str):
+        _client = self._clients.pop(key)
+        _client.close()
+        for _file in _client.temp_files:
+            self._temp_file_refs[_file] -= 1
+            if self._temp_file_refs[_file] > 0:
+                continue
+            del self._temp_file_refs[_file]
+            # 证书临时文件由kube_config按内容缓存，删除后需同步移出其缓存
+            [kube_config._temp_files.pop(_k) for _k, _v in list(kube_config._temp_files.items()) if _v == _file]
+            try:
+                os.remove(_file)
+            except OSError:
+                pass
+        logging.info(f'k8s client {key} evicted')
+
+    @staticmethod
+    def _build(key: str, kubeconfig: str) -> K8sClient:
+        """
+        Loads configuration
+        :param key:
+        :param kubeconfig: file or string
+        :return:
+        """
+        _config = client.Configuration()
+        _temp_files = []
+        if os.path.isfile(kubeconfig):
+            # this only work for local file
+            config.load_kube_config(config_file=kubeconfig, client_configuration=_config)
+        else:
+            try:
+                # 增加对ServiceAccount的支持，传入api-server的地址和指定serviceAccount的token来生成一个kubelet客户端
+                _c_info = json.loads(kubeconfig)
+                _config.verify_ssl = False
+                _config.host = _c_info['api_server']
+                _config.api_key['authorization'] = _c_info['token']
+            except Exception:
+                _, config_file = tempfile.mkstemp()
+                with open(config_file, 'w') as fd:
+                    fd.write(kubeconfig)
+                _temp_files.append(config_file)
+                config.load_kube_config(config_file=config_file, client_configuration=_config)
+                _temp_files.extend([_ for _ in (_config.ssl_ca_cert, _config.cert_file, _config.key_file)
+                                    if _ and _ in kube_config._temp_files.values()])
+        return K8sClient(key=key, api_client=client.ApiClient(configuration=_config), temp_files=_temp_files)
+
+
+K8S_CLIENT_REGISTRY = K8sClientRegistry()
 
 
 def get_client(kubeconfig):
     """
     Loads configuration
     :param kubeconfig: file or string
-    :returns ApiClient
+    :returns K8sClient
     """
 
     if not kubeconfig:
         raise Exception
 
-    if os.path.isfile(kubeconfig):
-        # this only work for local file
-        config_file = kubeconfig
-    else:
-        try:
-            # 增加对ServiceAccount的支持，传入api-server的地址和指定serviceAccount的token来生成一个kubelet客户端
-            _c_info = json.loads(kubeconfig)
-            _config = client.Configuration()
-            _config.verify_ssl = False
-            _config.host = _c_info['api_server']
-            _config.api_key['authorization'] = _c_info['token']
-            client.configuration.debug = True
-            return client
-        except Exception as e:
-            # logging.error(traceback.format_exc())
-            # logging.info(f'Not ServiceAccount:{e.msg}')
-            _, config_file = tempfile.mkstemp()
-            with open(config_file, 'w') as fd:
-                fd.write(kubeconfig)
-    config.load_kube_config(config_file=config_file)
-    client.configuration.debug = True
-    return client
+    return K8S_CLIENT_REGISTRY.get(kubeconfig)
 
 
 def get_timestamp(time_str):
@@ -194,6 +360,92 @@ def k8s_object_dict(_obj):
     } if hasattr(_obj, 'attribute_map') else _obj
 
 
+K8S_NATIVE_TYPES = {'int': int, 'long': int, 'float': float, 'str': str, 'bool': bool}
+
+
+@functools.lru_cache(maxsize=None)
+def _k8s_model_fields(_type: str):
+    """
+    获取k8s资源对象的(属性别名, 属性类型)列表，与反序列化时使用的swagger_types一致
+    :param _type: 模型名称，如V1Pod
+    :return:
+    """
+    _klass = getattr(client.models, _type)
+    return tuple((_klass.attribute_map[_attr], _attr_type) for _attr, _attr_type in _klass.swagger_types.items()) \
+        if _klass.swagger_types else None
+
+
+def k8s_timestamp(_value, _format: str = '%Y-%m-%d %H:%M:%S'):
+    """
+    转换k8s接口返回的时间字符串，与反序列化成datetime后strftime的结果一致
+    eg: 2018-07-17T14:26:13Z ==> 2018-07-17 14:26:13
+    :param _value:
+    :param _format:
+    :return:
+    """
+    if not _value:
+        return None
+    if _format == '%Y-%m-%d %H:%M:%S' and len(_value) >= 19 and _value[10] == 'T':
+        return f'{_value[:10]} {_value[11:19]}'
+    return dateutil_parser.parse(_value).strftime(_format)
+
+
+def k8s_raw_dict(_value, _type: str):
+    """
+    将k8s接口返回的原始json按资源类型投影成与k8s_object_dict相同的结构，跳过OpenAPI模型的反序列化
+    缺失的属性补None，时间格式化，数值按模型类型转换
+    :param _value: json.loads后的值
+    :param _type: 模型类型，如V1Pod、list[V1Container]、dict(str, str)
+    :return:
+    """
+    if _value is None:
+        return None
+    if _type.startswith('list['):
+        return [k8s_raw_dict(_, _type[5:-1]) for _ in _value]
+    if _type.startswith('dict('):
+        _sub_type = _type[5:-1].split(', ', 1)[1]
+        return {_k: k8s_raw_dict(_v, _sub_type) for _k, _v in _value.items()}
+    if _type in K8S_NATIVE_TYPES:
+        try:
+            return K8S_NATIVE_TYPES[_type](_value)
+        except TypeError:
+            return _value
+    if _type == 'object':
+        return _value
+    if _type == 'datetime':
+        return k8s_timestamp(_value)
+    if _type == 'date':
+        return k8s_timestamp(_value, '%Y-%m-%d')
+    _fields = _k8s_model_fields(_type)
+    if _fields is None or not isinstance(_value, dict):
+        return _value
+    return {_label: k8s_raw_dict(_value.get(_label), _attr_type) for _label, _attr_type in _fields}
+
+
+K8S_QUANTITY_SUFFIX = {
+    'n': 1e-9, 'u': 1e-6, 'm': 1e-3, 'k': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12, 'P': 1e15, 'E': 1e18,
+    'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30, 'Ti': 2 ** 40, 'Pi': 2 ** 50, 'Ei': 2 ** 60
+}
+
+
+def k8s_quantity(_value):
+    """
+    解析k8s资源数量，cpu转为核数，内存转为字节数
+    eg: 250m ==> 0.25, 12345678n ==> 0.012345678, 128Mi ==> 134217728, 1e3 ==> 1000
+    :param _value:
+    :return:
+    """
+    if _value is None or isinstance(_value, (int, float)):
+        return _value
+    _value = _value.strip()
+    try:
+        return float(_value)
+    except ValueError:
+        pass
+    _suffix = _value[-2:] if _value[-2:] in K8S_QUANTITY_SUFFIX else _value[-1:]
+    return float(_value[:-len(_suffix)]) * K8S_QUANTITY_SUFFIX[_suffix]
+
+
 def get_mysql_monitor_config(config_obj):
     return {
         'host': config_obj.get_conf(_section='ops', _key='db_host', default='127.0.0.1'),